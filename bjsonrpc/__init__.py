@@ -16,34 +16,65 @@ __release__ = '0.2.1'
 __all__ = [
     "createserver",
     "connect",
+    "socketpair",
     "server",
     "connection",
     "request",
     "handlers",
     "proxies",
+    "pollers",
+    "ioloop",
+    "compression",
     "jsonlib",
+    "msgpacklib",
+    "table",
+    "streaming",
+    "workers",
     "exceptions"
 ]
 
 bjsonrpc_options = {
-    'threaded' : False
+    'threaded' : False,
+    'write_mode' : 'thread',
+    'codec' : 'json',
 }
 """
 Dictionary with global options for the library. 
 
 **threaded**
-    (Default: False) When is set to True, threads will be created for handling 
-    each incoming item.
+    (Default: False) When is set to True, each incoming item is handled in 
+    a thread of a bounded pool (see *bjsonrpc.workers.WorkerPool*).
+
+**write_mode**
+    (Default: 'thread') When is set to 'thread', each connection creates its
+    own thread to write to the socket. When is set to 'ioloop', outgoing 
+    messages are buffered and sent without blocking; server connections are
+    flushed by the server loop and client connections share a single I/O 
+    thread (*bjsonrpc.ioloop.IOLoop.instance()*).
+
+**codec**
+    (Default: 'json') Name of the codec used by new connections to encode
+    and decode messages (see *bjsonrpc.jsonlib.codecs*): 'json' (simplejson
+    or the standard module), 'orjson', 'ujson', 'msgspec' when installed, or 
+    'auto' for the fastest one available. 'msgpack' (binary) can't be set 
+    here, as it has to be negotiated with the other end (see *connect*).
 
 """
 
-from bjsonrpc.main import createserver, connect
+from bjsonrpc.main import createserver, connect, socketpair
 
 import bjsonrpc.server
 import bjsonrpc.connection
 import bjsonrpc.request
 import bjsonrpc.handlers
 import bjsonrpc.proxies
+import bjsonrpc.pollers
+import bjsonrpc.ioloop
+import bjsonrpc.compression
 import bjsonrpc.jsonlib
+import bjsonrpc.msgpacklib
+import bjsonrpc.table
+import bjsonrpc.streaming
+import bjsonrpc.workers
 import bjsonrpc.exceptions
 
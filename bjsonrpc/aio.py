@@ -0,0 +1,579 @@
+"""
+    bjson/aio.py
+
+    asyncio flavour of bjsonrpc: connections, servers and awaitable proxies
+    that run on a single event loop thread.
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+import asyncio
+import inspect
+import logging
+import sys
+import threading
+import traceback
+
+from bjsonrpc.connection import Connection, RemoteObject
+from bjsonrpc.connection import _BatchItem, _BatchReply
+from bjsonrpc.exceptions import EofError, ServerError
+import bjsonrpc.handlers
+import bjsonrpc.jsonlib as json
+import bjsonrpc.main
+from bjsonrpc.workers import submit_to_process
+
+__all__ = [
+    "AsyncConnection",
+    "AsyncServer",
+    "createserver",
+    "connect",
+]
+
+_log = logging.getLogger(__name__)
+
+def _stream_limit(max_frame_size):
+    """
+        Returns the limit of the *asyncio.StreamReader* for messages of up to
+        **max_frame_size** bytes, so longer lines fail without buffering 
+        them whole.
+    """
+    return max_frame_size + 1
+
+
+def _blocking(name, instead):
+    """
+        Replaces the blocking method **name** of *Connection*, which can't
+        work in the event loop, with one that raises TypeError.
+    """
+    def method(self, *args, **kwargs):
+        raise TypeError("%s.%s() would block the event loop: %s" 
+                        % (type(self).__name__, name, instead))
+    method.__name__ = name
+    method.__doc__ = "Not available in asyncio connections: %s." % instead
+    return method
+
+
+class AsyncProxy(object):
+    """
+        asyncio counterpart of *bjsonrpc.proxies.Proxy*. Depending on
+        **sync_type**, calling one of its attributes:
+
+        * 0 (call): returns a coroutine; ``await`` it to get the value.
+        * 1 (method): sends the call and returns an *AsyncRequest*, which can
+          be awaited later.
+        * 2 (notify): sends the notification and returns None.
+        * 3 (pipe): sends the call and returns an *AsyncRequest* to iterate
+          with ``async for``.
+    """
+    def __init__(self, conn, sync_type, obj = None):
+        self._conn = conn
+        self._obj = obj
+        self.sync_type = sync_type
+
+    def __getattr__(self, name):
+        if self._obj:
+            name = "%s.%s" % (self._obj, name)
+
+        def function(*args, **kwargs):
+            """
+                Forwards the call to the proxy method of the connection.
+            """
+            return self._conn.proxy(self.sync_type, name, args, kwargs)
+        function.__name__ = str(name)
+        function._conn = self._conn
+        return function
+
+
+class AsyncRemoteObject(RemoteObject):
+    """
+        *RemoteObject* whose proxies are *AsyncProxy* instances::
+
+            mylist = await conn.call.newList()
+            await mylist.call.add(5)
+    """
+    def __init__(self, conn, obj):
+        self._conn = conn
+        self.name = obj['__remoteobject__']
+
+        self.call = AsyncProxy(self._conn, obj=self.name, sync_type=0)
+        self.method = AsyncProxy(self._conn, obj=self.name, sync_type=1)
+        self.notify = AsyncProxy(self._conn, obj=self.name, sync_type=2)
+        self.pipe = AsyncProxy(self._conn, obj=self.name, sync_type=3)
+
+
+class AsyncRequest(object):
+    """
+        Pending call made through an *AsyncProxy*. Await it to get the value
+        of the first response, or iterate it with ``async for`` to get every
+        response of a pipe. Errors are raised as *ServerError*.
+
+        Pipe requests stay registered until *close* is called.
+    """
+    def __init__(self, conn, request_id, pipe = False):
+        self.conn = conn
+        self.request_id = request_id
+        self.auto_close = not pipe
+        self._responses = asyncio.Queue()
+        self.conn.addrequest(self)
+
+    def setresponse(self, value):
+        """
+            Called by the connection when a response arrives.
+        """
+        self._responses.put_nowait(value)
+        if self.auto_close:
+            self.close()
+
+    async def get(self):
+        """
+            Waits for the next response and returns its value.
+        """
+        response = await self._responses.get()
+        if isinstance(response, BaseException):
+            raise response
+        err = response.get('error', None)
+        if err is not None:
+            raise ServerError(err)
+        return response['result']
+
+    def __await__(self):
+        return self.get().__await__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    def close(self):
+        reqid, self.request_id, self.auto_close = self.request_id, None, False
+        if reqid is not None:
+            self.conn.delrequest(reqid)
+
+
+class AsyncConnection(Connection):
+    """
+        Connection over asyncio streams. It speaks the same protocol (and
+        uses the same class hinting) as *bjsonrpc.connection.Connection*,
+        but everything runs in the event loop: there are no threads and
+        thousands of calls can be in flight at the same time.
+
+        Handler methods can be normal functions, generators, ``async def``
+        coroutines or async generators. Each incoming call is run in its
+        own task, so a slow coroutine does not delay the next messages.
+
+        Usually created with *bjsonrpc.aio.connect* or by *AsyncServer*.
+
+        Parameters:
+
+        **reader**, **writer**
+            *asyncio.StreamReader* and *asyncio.StreamWriter* of the socket.
+
+        **address**
+            Address of the other peer. Only used to inform handlers.
+
+        **handler_factory**
+            Class inherited from BaseHandler which holds the public methods.
+
+        As in *Connection*, a message longer than *max_frame_size* closes 
+        the connection.
+    """
+    _remote_object_class = AsyncRemoteObject
+
+    def __init__(self, reader, writer, address = None, handler_factory = None):
+        self._debug_socket = False
+        self._debug_dispatch = False
+        self._reader = reader
+        self._writer = writer
+        self._sck = writer.get_extra_info("socket")
+        self._address = address
+        self._handler = handler_factory
+        self.connection_status = "open"
+        self.threaded = False
+        self._write_codec = self._read_codec = json.get_codec()
+        self._init_hints()
+        self._id = 0
+        self._requests = {}
+        self._objects = {}
+        self._tasks = set()
+        self._reader_task = None
+        self._background_reader = None # read by the task of start()
+        self.getid_lock = threading.Lock()
+        # Never filled: calls that keep their result are refused, but the
+        # releases of those results still arrive.
+        self._promises = {}
+        self._promise_lock = threading.Lock()
+        if self._handler:
+            self.handler = self._handler(self)
+
+        self.call = AsyncProxy(self, sync_type=0)
+        self.method = AsyncProxy(self, sync_type=1)
+        self.notify = AsyncProxy(self, sync_type=2)
+        self.pipe = AsyncProxy(self, sync_type=3)
+
+    def start(self):
+        """
+            Starts the task that reads and dispatches incoming messages.
+        """
+        if self._reader_task is None:
+            self._reader_task = asyncio.ensure_future(self.serve())
+        return self._reader_task
+
+    def addrequest(self, request):
+        assert(request.request_id not in self._requests)
+        self._requests[request.request_id] = request
+
+    def proxy(self, sync_type, name, args, kwargs, callback = None):
+        """
+            Sends a call to the other end. See *AsyncProxy* for the meaning
+            of **sync_type**.
+        """
+        data = {}
+        data['method'] = name
+        if sync_type in [0, 1, 3]:
+            data['id'] = self.get_id()
+        if len(args) > 0:
+            data['params'] = args
+        if len(kwargs) > 0:
+            if len(args) == 0:
+                data['params'] = kwargs
+            else:
+                data['kwparams'] = kwargs
+
+        if sync_type == 2:
+            self.write(json.dumps(data, self))
+            return None
+
+        req = AsyncRequest(self, data['id'], pipe = (sync_type == 3))
+        self.write(json.dumps(data, self))
+        if sync_type == 0:
+            return req.get()
+        return req
+
+    def write(self, data, timeout = None):
+        """
+            Appends the line *data* to the transport buffer. Never blocks;
+            use *drain* to wait for the buffer to be flushed.
+        """
+        if self.connection_status != "open":
+            raise EofError(0)
+        try:
+            data = data.encode('utf-8')
+        except AttributeError:
+            pass
+        if self._debug_socket:
+            _log.debug("<:%d: %s", len(data), data.decode('utf-8')[:130])
+        self._writer.write(data + b'\n')
+
+    async def drain(self):
+        """
+            Waits until the transport buffer is below its high-water mark.
+        """
+        await self._writer.drain()
+
+    async def serve(self):
+        """
+            Reads and dispatches messages until the other end closes the
+            connection. Then closes this one.
+        """
+        try:
+            while True:
+                try:
+                    data = await self._reader.readuntil(b'\n')
+                    self._check_frame_size(len(data) - 1)
+                except asyncio.IncompleteReadError:
+                    break
+                except (asyncio.LimitOverrunError, ValueError) as exc:
+                    # Over max_frame_size: the rest can't be followed.
+                    _log.error("Closing connection: %s", exc)
+                    break
+                except (ConnectionError, OSError):
+                    break
+                if self._debug_socket:
+                    _log.debug(">:%d: %s", len(data), data[:130])
+                self._dispatch_data(data)
+        finally:
+            await self.aclose()
+
+    def _dispatch_data(self, data):
+        try:
+            item = json.loads(data, self)
+        except Exception:
+            _log.debug(traceback.format_exc())
+            return
+        if type(item) is list:
+            if not item:
+                return
+            # The responses to the calls are sent together (see 
+            # Connection._dispatch_batch).
+            reply = _BatchReply(self, item)
+            reply.hold()
+            try:
+                for i in reply.items:
+                    self._dispatch_item(i)
+            finally:
+                reply.release()
+        elif type(item) is dict:
+            self._dispatch_item(item)
+        else:
+            _log.debug("Received message with unknown format type: %s",
+                       type(item))
+
+    def _dispatch_item(self, item):
+        if 'method' in item:
+            task = asyncio.ensure_future(self.dispatch_call(item))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif 'result' in item:
+            request = self._requests.get(item.get('id'))
+            if request is None:
+                _log.debug("Response for unknown request %r", item.get('id'))
+                return
+            request.setresponse(item)
+        else:
+            self._send_error(item, 'Unknown format')
+
+    async def dispatch_call(self, item):
+        """
+            Runs the handler method of one incoming call and sends its
+            response(s).
+        """
+        try:
+            await self._dispatch_call(item)
+        finally:
+            if type(item) is _BatchItem:
+                item.batch.release()
+
+    async def _dispatch_call(self, item):
+        item.setdefault('id', None)
+        if 'resultname' in item:
+            return self._send_error(item, 
+                "Promises are not supported by this connection")
+        if item['method'] == '__map__':
+            # Only the methods that are not coroutines can be mapped.
+            return self._dispatch_map(item)
+        method, args, kw = self._extract_params(item)
+        obj = self._find_object(method, args, kw)
+        if obj is None: return
+        fn = self._find_method(obj, method, args, kw)
+        try:
+            if inspect.isasyncgenfunction(fn):
+                async for response in fn(*args, **kw):
+                    self._send_response(item, response)
+                    await self.drain()
+            elif inspect.isgeneratorfunction(fn):
+                for response in fn(*args, **kw):
+                    self._send_response(item, response)
+                    await self.drain()
+            elif getattr(fn, '_run_in_process', None) is not None:
+                response = await asyncio.wrap_future(
+                    submit_to_process(fn._run_in_process, args, kw))
+                self._send_response(item, response)
+                await self.drain()
+            elif callable(fn):
+                response = fn(*args, **kw)
+                if inspect.isawaitable(response):
+                    response = await response
+                self._send_response(item, response)
+                await self.drain()
+            elif fn:
+                self._send_error(item, fn)
+        except ServerError as exc:
+            self._send_error(item, str(exc))
+        except (EofError, ConnectionError):
+            pass
+        except Exception:
+            err = self._format_exception(obj, method, args, kw,
+                                         sys.exc_info())
+            self._send_error(item, err)
+
+    def _send_stream(self, item, stream):
+        # The transport buffers the whole message anyway: send it as a list.
+        self._send_response(item, list(stream))
+
+    def _send(self, response):
+        try:
+            Connection._send(self, response)
+        except EofError:
+            pass
+
+    def _send_batch(self, responses):
+        try:
+            Connection._send_batch(self, responses)
+        except EofError:
+            pass
+
+    def close(self):
+        """
+            Closes the connection. Pending requests fail with *EofError*.
+        """
+        if self.connection_status == "closed": return
+        self.connection_status = "closed"
+        for request in list(self._requests.values()):
+            request.setresponse(EofError(0))
+        self._requests.clear()
+        try:
+            self.handler._shutdown()
+        except Exception:
+            _log.error("Error when shutting down the handler: %s",
+                       traceback.format_exc())
+        self._writer.close()
+        if self._reader_task is not None and not self._reader_task.done():
+            if self._reader_task is not asyncio.current_task():
+                self._reader_task.cancel()
+
+    async def aclose(self):
+        """
+            Closes the connection and waits for the socket to be closed.
+        """
+        self.close()
+        try:
+            await self._writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    _dispatched = "incoming messages are dispatched by the task of start()"
+    dispatch_until_empty = _blocking("dispatch_until_empty", _dispatched)
+    read_and_dispatch = _blocking("read_and_dispatch", _dispatched)
+    read = _blocking("read", _dispatched)
+    read_line = _blocking("read_line", _dispatched)
+    start_reader = _blocking("start_reader", _dispatched)
+    _buffered = "use write(), and await drain()"
+    write_now = _blocking("write_now", _buffered)
+    write_line = _blocking("write_line", _buffered)
+    write_lines = _blocking("write_lines", _buffered)
+    async_ = _blocking("async_", "use method, whose requests can be awaited")
+    batch = _blocking("batch", "its requests can't be awaited")
+    negotiate = _blocking("negotiate", 
+                          "options can't be negotiated on this connection")
+    del _dispatched, _buffered
+
+
+class AsyncServer(object):
+    """
+        asyncio counterpart of *bjsonrpc.server.Server*. It creates an
+        *AsyncConnection* (with its reader task) for each client.
+
+        Usually created with *bjsonrpc.aio.createserver*.
+
+        Parameters:
+
+        **handler_factory**
+            Class to instantiate to publish methods for incoming connections.
+
+        **max_frame_size** = None
+            If given, the *max_frame_size* of the connections: the most bytes
+            a message received may have before the connection is closed. It
+            defaults to that of *AsyncConnection*.
+    """
+    def __init__(self, handler_factory, max_frame_size = None):
+        self._handler = handler_factory
+        if max_frame_size is None:
+            max_frame_size = AsyncConnection.max_frame_size
+        self._max_frame_size = max_frame_size
+        self._server = None
+        self._connections = set()
+        self._debug_socket = False
+
+    def debug_socket(self, value = None):
+        """
+            Sets or retrieves the internal debug_socket value.
+        """
+        retval = self._debug_socket
+        if type(value) is bool:
+            self._debug_socket = value
+        return retval
+
+    async def _client_connected(self, reader, writer):
+        conn = AsyncConnection(reader, writer,
+                               address = writer.get_extra_info("peername"),
+                               handler_factory = self._handler)
+        conn._debug_socket = self._debug_socket
+        conn.max_frame_size = self._max_frame_size
+        self._connections.add(conn)
+        try:
+            await conn.serve()
+        finally:
+            self._connections.discard(conn)
+
+    async def listen(self, host = "127.0.0.1", port = 10123, path = None,
+                     **kwargs):
+        """
+            Starts listening on **host**:**port**, or on the Unix domain
+            socket **path** if given. Extra keyword arguments are passed to
+            *asyncio.start_server* (or *asyncio.start_unix_server*).
+        """
+        kwargs.setdefault("limit", _stream_limit(self._max_frame_size))
+        if path is not None:
+            bjsonrpc.main._remove_stale_socket(path)
+            self._server = await asyncio.start_unix_server(
+                self._client_connected, path, **kwargs)
+        else:
+            self._server = await asyncio.start_server(
+                self._client_connected, host, port, **kwargs)
+        return self
+
+    @property
+    def sockets(self):
+        """
+            Listening sockets of the server.
+        """
+        return self._server.sockets
+
+    async def serve(self):
+        """
+            Serves until *stop* is called or the task is cancelled.
+        """
+        async with self._server:
+            await self._server.serve_forever()
+
+    def stop(self):
+        """
+            Stops accepting connections and closes the current ones.
+        """
+        self._server.close()
+        for conn in list(self._connections):
+            conn.close()
+
+
+async def createserver(host = "127.0.0.1", port = 10123,
+    handler_factory = bjsonrpc.handlers.NullHandler, path = None,
+    max_frame_size = None):
+    """
+        Creates an *AsyncServer* listening on **host**:**port** (or on the 
+        Unix domain socket **path**). Use ``await server.serve()`` to run it::
+
+            server = await bjsonrpc.aio.createserver(handler_factory=MyHandler)
+            await server.serve()
+    """
+    server = AsyncServer(handler_factory = handler_factory,
+                         max_frame_size = max_frame_size)
+    return await server.listen(host, port, path)
+
+
+async def connect(host = "127.0.0.1", port = 10123,
+    handler_factory = bjsonrpc.handlers.NullHandler, path = None):
+    """
+        Connects to a bjsonrpc server (or to the Unix domain socket **path**)
+        and returns an *AsyncConnection* which is already reading from the
+        socket::
+
+            conn = await bjsonrpc.aio.connect("rpc.host.net")
+            print(await conn.call.some_method_in_server_side())
+    """
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path,
+            limit = _stream_limit(AsyncConnection.max_frame_size))
+    else:
+        reader, writer = await asyncio.open_connection(host, port,
+            limit = _stream_limit(AsyncConnection.max_frame_size))
+    conn = AsyncConnection(reader, writer,
+                           address = writer.get_extra_info("peername"),
+                           handler_factory = handler_factory)
+    conn.start()
+    return conn
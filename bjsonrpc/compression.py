@@ -0,0 +1,156 @@
+"""
+    bjson/compression.py
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+import zlib
+
+__all__ = [
+    "compressors",
+    "DeflateCompressor",
+    "DeflateDecompressor",
+]
+
+RAW = b'\x00'
+"""Marker byte of a message sent without compression"""
+
+COMPRESSED = b'\x01'
+"""Marker byte of a compressed message"""
+
+_SYNC_TAIL = b'\x00\x00\xff\xff' # every Z_SYNC_FLUSH block ends with this
+
+
+class DeflateCompressor(object):
+    """
+        Compresses the messages sent through a connection as a single deflate
+        stream, so each message can refer to the data of the previous ones
+        (keys, class hints...) for the life of the connection. Every message
+        is flushed with Z_SYNC_FLUSH, so the peer can decode it as soon as it
+        is received.
+
+        Messages shorter than **threshold** bytes are sent raw, as they would
+        hardly shrink. Each message starts with a marker byte (*RAW* or
+        *COMPRESSED*).
+
+        Calls must be made in the same order the messages are sent.
+
+        **Members:**
+
+        **messages**, **compressed**
+            Number of messages sent, and how many of them were compressed.
+
+        **raw_bytes**, **wire_bytes**
+            Size of the messages before and after compression (markers
+            included).
+    """
+    def __init__(self, threshold=256, level=6):
+        self.threshold = threshold
+        self._compressobj = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.messages = 0
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def compress(self, data):
+        """
+            Returns a list of buffers with the marker byte and the payload
+            for the message **data**.
+        """
+        self.messages += 1
+        self.raw_bytes += len(data)
+        if len(data) < self.threshold:
+            self.wire_bytes += len(data) + 1
+            return [ RAW, data ]
+        body = (self._compressobj.compress(data) +
+                self._compressobj.flush(zlib.Z_SYNC_FLUSH))
+        # The tail is the same for every message: the decompressor adds it.
+        body = body[:-len(_SYNC_TAIL)]
+        self.compressed += 1
+        self.wire_bytes += len(body) + 1
+        return [ COMPRESSED, body ]
+
+    def compress_pieces(self, pieces):
+        """
+            Generator of the payload of one message given as an iterable of
+            **pieces** (*bytes*), compressed while they are produced: the
+            marker byte and then the compressed data, in parts that may be 
+            empty. Used for streamed messages, which are always compressed.
+            None pieces (not produced yet) are passed along.
+        """
+        self.messages += 1
+        self.compressed += 1
+        self.wire_bytes += 1
+        yield COMPRESSED
+        compressobj = self._compressobj
+        for piece in pieces:
+            if piece is None:
+                yield None
+                continue
+            self.raw_bytes += len(piece)
+            body = compressobj.compress(piece)
+            self.wire_bytes += len(body)
+            yield body
+        body = compressobj.flush(zlib.Z_SYNC_FLUSH)[:-len(_SYNC_TAIL)]
+        self.wire_bytes += len(body)
+        yield body
+
+    @property
+    def ratio(self):
+        """
+            Size before compression divided by size on the wire (1.0 until
+            something is sent).
+        """
+        if not self.wire_bytes:
+            return 1.0
+        return float(self.raw_bytes) / self.wire_bytes
+
+
+class DeflateDecompressor(object):
+    """
+        Decodes the messages produced by a *DeflateCompressor*, in the same
+        order.
+
+        A message that would decompress to more than **max_size** bytes
+        (None: no limit) raises ValueError instead of being expanded in
+        memory, as a few kilobytes of deflate data can expand to gigabytes.
+        Invalid deflate data raises ValueError too. The stream can't be 
+        decoded after that.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self._decompressobj = zlib.decompressobj(-15)
+
+    def decompress(self, data):
+        """
+            Returns the original message for the payload **data** (marker
+            byte included).
+        """
+        marker = data[:1]
+        if marker == RAW:
+            return data[1:]
+        if marker != COMPRESSED:
+            raise ValueError("Unknown compression marker %r" % bytes(marker))
+        decompressobj = self._decompressobj
+        try:
+            data = decompressobj.decompress(bytes(data[1:]) + _SYNC_TAIL,
+                                            self.max_size or 0)
+            # Output stopped at max_size: fine only if nothing else comes out.
+            if (decompressobj.unconsumed_tail and
+                    decompressobj.decompress(decompressobj.unconsumed_tail, 1)):
+                raise ValueError("Message decompresses to more than %d bytes"
+                                 % self.max_size)
+        except zlib.error as exc:
+            raise ValueError("Invalid deflate data: %s" % exc)
+        return data
+
+
+compressors = {
+    'deflate' : (DeflateCompressor, DeflateDecompressor),
+}
+"""Compression methods that can be negotiated, by name"""
@@ -36,21 +36,145 @@
 import errno
 import logging
 import inspect
-import socket, traceback, sys, threading
+import socket, traceback, sys, threading, time, struct
+from collections import deque
+from itertools import islice, repeat
 from types import MethodType, FunctionType
 
 from bjsonrpc.proxies import Proxy
-from bjsonrpc.request import Request
-from bjsonrpc.exceptions import EofError, ServerError
+from bjsonrpc.request import Request, PipeRequest, StreamRequest, Batch
+from bjsonrpc.request import PromiseRequest
+from bjsonrpc.exceptions import EofError, ServerError, ServerBusyError
 from bjsonrpc import bjsonrpc_options
 
 import bjsonrpc.jsonlib as json
-import select
+from bjsonrpc.table import Table
+from bjsonrpc.streaming import StreamDecoder, ResultStream, StreamPipe
+from bjsonrpc.pollers import wait_readable, wait_writable
+from bjsonrpc.compression import compressors
+from bjsonrpc.workers import WorkerPool, submit_to_process
 
 
 _log = logging.getLogger(__name__)
 _log.setLevel(40)
 
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+_IOV_MAX = 1024 # maximum number of buffers in a single sendmsg call.
+
+_FRAME_HEADER = struct.Struct("!I")
+_MAX_FRAME_SIZE = 0x7FFFFFFF
+_FRAGMENT = 0x80000000 # high bit of the length header: more fragments follow.
+
+def _frame_size(frame):
+    """ Returns the (uncompressed) size of a frame built by *_frame* """
+    if not frame: return 0
+    return len(frame[2]) + _FRAME_HEADER.size
+
+
+def _hint_loader(hint, decode):
+    """ Returns a function that decodes the hinted object of a registered type """
+    return lambda obj: decode(obj[hint])
+
+
+class _BatchItem(dict):
+    """ A call received in a batch: its responses go to **batch** """
+    __slots__ = ('batch',)
+
+
+class _PromiseRef(object):
+    """ Reference received to a promise (see *Connection.promise*) """
+    __slots__ = ('name',)
+    
+    def __init__(self, name):
+        self.name = name
+
+
+class _Promise(object):
+    """ 
+        Result of a call kept for the calls that refer to it, and the calls
+        that wait for it.
+    """
+    __slots__ = ('done', 'value', 'error', 'waiting')
+    
+    def __init__(self):
+        self.done = False
+        self.value = None
+        self.error = None
+        self.waiting = []
+
+
+def _promise_refs(value, names):
+    """ Appends to **names** the promises referenced in **value** """
+    cls = type(value)
+    if cls is _PromiseRef:
+        names.append(value.name)
+    elif cls is list:
+        for element in value:
+            _promise_refs(element, names)
+    elif cls is dict:
+        for element in value.values():
+            _promise_refs(element, names)
+            
+def _substitute(value, values):
+    """ Returns **value** with the references replaced by **values** """
+    cls = type(value)
+    if cls is _PromiseRef:
+        return values[value.name]
+    elif cls is list:
+        return [ _substitute(element, values) for element in value ]
+    elif cls is dict:
+        return dict((key, _substitute(element, values)) 
+                    for key, element in value.items())
+    return value
+
+
+class _BatchReply(object):
+    """
+        Gathers the responses to the calls of a batch received, and sends 
+        them as a single message (a list) when every call has finished.
+    """
+    def __init__(self, conn, items):
+        self.conn = conn
+        self.responses = []
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.items = []
+        for item in items:
+            if type(item) is dict and 'method' in item:
+                item = _BatchItem(item)
+                item.batch = self
+                self.pending += 1
+            self.items.append(item)
+        
+    def add(self, response):
+        self.lock.acquire()
+        try:
+            self.responses.append(response)
+        finally:
+            self.lock.release()
+            
+    def hold(self):
+        """ One more call to wait for (e.g. sent to the process pool) """
+        self.lock.acquire()
+        try:
+            self.pending += 1
+        finally:
+            self.lock.release()
+        
+    def release(self):
+        """ Called when a call has finished: the last one sends the reply """
+        self.lock.acquire()
+        try:
+            self.pending -= 1
+            if self.pending:
+                return
+            responses, self.responses = self.responses, []
+        finally:
+            self.lock.release()
+        if responses:
+            self.conn._send_batch(responses)
+
 
 class RemoteObject(object):
     """
@@ -94,6 +218,19 @@ class RemoteObject(object):
             method but you can check request.value multiple times, and must
             call request.close() when you're done.
 
+        **stream**
+            Asynchronous Proxy like method, for calls that return large lists:
+            iterating the *request.StreamRequest* returned yields the elements of
+            the result as they are decoded (see *Connection.stream_threshold*).
+
+        **map**
+            Proxy that calls a method once for each element of an iterable
+            (see *Connection.map*).
+
+        **promise**
+            Asynchronous Proxy like method, whose result can be used before 
+            it is received (see *Connection.promise*).
+
         **notify**
             Notification Proxy. It forwards your calls to it to the other end and
             tells the server to not response even if there's any error in the call.
@@ -107,6 +244,9 @@ class RemoteObject(object):
     method = None 
     notify = None
     pipe = None
+    stream = None
+    map = None
+    promise = None
 
     @property
     def connection(self): 
@@ -123,6 +263,9 @@ class RemoteObject(object):
         self.method = Proxy(self._conn, obj=self.name, sync_type=1)
         self.notify = Proxy(self._conn, obj=self.name, sync_type=2)
         self.pipe = Proxy(self._conn, obj=self.name, sync_type=3)
+        self.stream = Proxy(self._conn, obj=self.name, sync_type=4)
+        self.map = Proxy(self._conn, obj=self.name, sync_type=5)
+        self.promise = Proxy(self._conn, obj=self.name, sync_type=6)
     
     def __del__(self):
         self._close()
@@ -132,7 +275,9 @@ class RemoteObject(object):
             Internal close method called both by __del__() and public 
             method close()
         """
-        self.call.__delete__()
+        if self.name is not None and self._conn.connection_status == "open":
+            # The other end never answers to __delete__, don't wait for it.
+            self.notify.__delete__()
         self.name = None
         
     def close(self):
@@ -162,6 +307,12 @@ class Connection(object): # TODO: Split this class in simple ones
             Class type inherited from BaseHandler which holds the public methods.
             It defaults to *NullHandler* meaning no public methods will be 
             avaliable to the other end.
+            
+        **ioloop**
+            Optional *bjsonrpc.ioloop.IOLoop*. When given, no writer thread is
+            created: outgoing messages are appended to an output buffer that
+            is sent without blocking, and the loop sends whatever is left 
+            when the socket becomes writable.
 
         **Members:**
 
@@ -173,17 +324,146 @@ class Connection(object): # TODO: Split this class in simple ones
             Asynchronous Proxy. It forwards your calls to it to the other end and
             inmediatelly returns a *request.Request* instance.
     
+        **pipe**
+            Asynchronous Proxy like *method*, for methods that send several
+            responses: returns a *request.PipeRequest*.
+    
+        **stream**
+            Asynchronous Proxy like *method*. Iterating the 
+            *request.StreamRequest* returned yields the elements of the result list, as they are
+            decoded when the response is streamed (see *stream_threshold*).
+    
         **notify**
             Notification Proxy. It forwards your calls to it to the other end and
             tells the server to not response even if there's any error in the call.
             Returns *None*.
         
+        **map**
+            Proxy that calls a method once for each element of an iterable,
+            sending the calls in chunks::
+            
+                for name in conn.map.lookup(keys, chunk_size=500):
+                    print(name)
+            
+            Each element is the tuple of arguments of one call, or its only
+            argument if it is not a tuple. Returns an iterator over the 
+            results, in order. Each chunk is a single message with the 
+            method name and the arguments by columns, whose response is the
+            list of results; up to **window** (default 4) chunks are sent 
+            ahead of the one being iterated. If a call fails, the results
+            before it are yielded and then its *exceptions.ServerError* is
+            raised. Arguments by keyword are not supported.
+        
+        **promise**
+            Asynchronous Proxy like *method*, whose *request.PromiseRequest*
+            can be used before the response arrives: as an argument of other
+            calls, and to call the methods of the object returned::
+            
+                cursor = conn.promise.Cursor("orders")
+                print(cursor.promise.filter(status="open").call.count())
+            
+            The calls that depend on it are sent right away, so the chain 
+            takes a single round trip. This end keeps the result (under the
+            *resultname* of the call) until the other end releases it, and 
+            dispatches the calls that depend on it when it is ready.
+        
+        **read_chunk_size**
+            Maximum number of bytes requested to the socket on each read 
+            (default 65536). Data is received directly into a growable 
+            buffer, and all the complete lines are split out at once.
+        
+        **max_frame_size**
+            The most bytes a received message may have as sent, before it is
+            decompressed (default 64 MiB). With length framing it applies to
+            the size announced in the header, and to all the fragments of a
+            message together. The connection is closed when the other end
+            exceeds it, as the stream can't be followed after that.
+        
+        **write_coalesce_bytes**
+            The writer thread sends all the messages queued at once with a 
+            single system call, up to this amount of bytes (default 256 KiB).
+        
+        **write_coalesce_delay**
+            Seconds that the writer thread waits for more messages before 
+            sending (default 0: send what is queued right away). A small 
+            delay (e.g. 0.001) packs bursts of notifications into fewer 
+            syscalls and TCP segments at the cost of that latency.
+        
+        **negotiation**
+            Options that this end accepts in a *negotiate* handshake, as a 
+            dictionary of option name to the supported values, in order of 
+            preference. Currently only 'framing' exists: 'newline' (the 
+            default, one JSON message per line) or 'length' (each message
+            is preceded by its size as a 4-byte big endian integer, so it 
+            can contain any byte and it is never scanned for delimiters).
+            And 'compression': 'none' or 'deflate' (see 
+            *bjsonrpc.compression*), which requires length framing. And 
+            'codec': the wire format of the messages, 'json' or 'msgpack'
+            (see *set_codec*), which also requires length framing.
+        
+        **table_min_rows**
+            If set, results that are lists of at least this number of
+            dictionaries with the same keys are sent as a 
+            *bjsonrpc.table.Table* (default None: never; see also 
+            *bjsonrpc.handlers.columnar*).
+        
+        **compression_threshold**, **compression_level**
+            With compression, messages shorter than this amount of bytes 
+            (default 256) are sent raw, and the rest are compressed with this
+            zlib level (default 6).
+        
+        **compression_max_size**
+            With compression, the most bytes a received message may 
+            decompress to (default 256 MiB). A bigger one raises ValueError
+            while it is read.
+        
+        **stream_threshold**
+            If set, messages bigger than this number of bytes are decoded 
+            while they are received with a *bjsonrpc.streaming.StreamDecoder*
+            (default None: never), instead of buffering the whole message 
+            first. This bounds the memory used by large messages to about
+            the size of the decoded objects, and lets the requests made 
+            with the *stream* proxy yield the elements of their result as
+            they arrive. Only for uncompressed JSON messages.
+        
+        **stream_chunk_size**
+            Approximate size in bytes of the parts in which the results of
+            the handlers decorated with *bjsonrpc.handlers.streamed* are 
+            encoded and sent (default 65536). With length framing each part
+            is sent as a fragment of the message.
+        
+        **worker_pool**
+            *bjsonrpc.workers.WorkerPool* that runs the incoming items in
+            threaded mode. Set by *bjsonrpc.server.Server* to its pool; when
+            None, *WorkerPool.instance()* is used.
+        
+        With *start_reader*, the connection is read in the background and
+        the threads that make calls only wait for their own responses.
+        
     """
     _maxtimeout = {
         'read' : 60,    # default maximum read timeout.
         'write' : 60,   # default maximum write timeout.
     }
     
+    read_chunk_size = 65536
+    max_frame_size = 1 << 26
+    write_coalesce_bytes = 262144
+    write_coalesce_delay = 0
+    
+    negotiation = {
+        'framing' : ('newline', 'length'),
+        'compression' : ('none', 'deflate'),
+        'codec' : ('json', 'msgpack'),
+    }
+    compression_threshold = 256
+    compression_level = 6
+    compression_max_size = 1 << 28
+    table_min_rows = None
+    stream_threshold = None
+    stream_chunk_size = 65536
+    worker_pool = None
+    
     _SOCKET_COMM_ERRORS = (errno.ECONNABORTED, errno.ECONNREFUSED, 
                         errno.ECONNRESET, errno.ENETDOWN,
                         errno.ENETRESET, errno.ENETUNREACH)
@@ -192,9 +472,22 @@ class Connection(object): # TODO: Split this class in simple ones
     method = None 
     notify = None
     pipe = None
+    stream = None
+    map = None
+    promise = None
+    
+    _remote_object_class = RemoteObject
+    
 
-    def async(self, callback):
-        return Proxy(self._conn, obj=self.name, sync_type=1, callback=callback)
+    def async_(self, callback):
+        """
+            Returns an asynchronous Proxy (like *method*) that calls 
+            **callback** with the *Request* when the response is received.
+            
+            (Named *async* before 0.3; renamed because *async* is a reserved
+            word since Python 3.7.)
+        """
+        return Proxy(self, sync_type=1, callback=callback)
     
     @classmethod
     def setmaxtimeout(cls, operation, value):
@@ -236,12 +529,35 @@ class Connection(object): # TODO: Split this class in simple ones
         return cls._maxtimeout[operation]
     
     
-    def __init__(self, sck, address = None, handler_factory = None):
+    def __init__(self, sck, address = None, handler_factory = None, 
+                 ioloop = None):
         self._debug_socket = False
         self._debug_dispatch = False
-        self._buffer = b''
+        self._rbuf = bytearray() # grows on first read
+        self._rstart = 0 # start of the first incomplete line
+        self._rend = 0 # end of the received data
+        self._rscan = 0 # bytes before this position have no newlines
+        self._rwant = 0 # bytes missing to complete the next frame
+        self._lines = deque()
+        self._rstream = None # StreamDecoder of the message being received
+        self._rleft = None # bytes of it still to receive (length framing)
+        self._rmore = False # and more fragments follow
+        self._rsink = None # Request that takes the result being streamed
+        self._rdelivered = False
+        self._fragments = [] # parts received of a fragmented message
+        self._fragments_size = 0 # bytes received of it, or of the streamed one
+        self._rerror = None # invalid data found after the lines received
+        self._wstream = None # buffers of the message being streamed (ioloop)
+        self._wdeferred = deque() # messages written while it is streamed
+        self._read_framing = 'newline'
+        self._write_framing = 'newline'
+        self._compressor = None
+        self._decompressor = None
+        self._write_codec = self._read_codec = json.get_codec()
+        self._init_hints()
         self._sck = sck
         self._address = address
+        self._set_nodelay()
         self._handler = handler_factory 
         self.connection_status = "open"
         if self._handler: 
@@ -249,24 +565,34 @@ class Connection(object): # TODO: Split this class in simple ones
             
         self._id = 0
         self._requests = {}
+        self._background_reader = None # thread or IOLoop of start_reader
+        self._reader_error = None # why it stopped
         self._objects = {}
+        self._promises = {} # resultname -> _Promise
+        self._promise_lock = threading.Lock()
 
         self.scklock = threading.Lock()
         self.call = Proxy(self, sync_type=0)
         self.method = Proxy(self, sync_type=1)
         self.notify = Proxy(self, sync_type=2)
         self.pipe = Proxy(self, sync_type=3)
-        self._wbuffer = b''
+        self.stream = Proxy(self, sync_type=4)
+        self.map = Proxy(self, sync_type=5)
+        self.promise = Proxy(self, sync_type=6)
+        self._wbuffer = deque()
+        self._wbuffer_size = 0
         self.write_lock = threading.RLock()
         self.read_lock = threading.RLock()
         self.getid_lock = threading.Lock()
         self.reading_event = threading.Event()
         self.threaded = bjsonrpc_options['threaded']
-        self.write_thread_queue = []
-        self.write_thread_semaphore = threading.Semaphore(0)
-        self.write_thread = threading.Thread(target=self.write_thread)
-        self.write_thread.daemon = True
-        self.write_thread.start()
+        self._ioloop = ioloop
+        if self._ioloop is None:
+            self.write_thread_queue = deque()
+            self.write_thread_semaphore = threading.Semaphore(0)
+            self.write_thread = threading.Thread(target=self.write_thread)
+            self.write_thread.daemon = True
+            self.write_thread.start()
 
     @property
     def socket(self): 
@@ -275,6 +601,17 @@ class Connection(object): # TODO: Split this class in simple ones
         """
         return self._sck
         
+    def _set_nodelay(self):
+        """
+            Disables Nagle's algorithm on TCP sockets. Outgoing messages are 
+            already coalesced before being sent, so letting the kernel wait 
+            for more data would only add latency to small messages.
+        """
+        try:
+            self._sck.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (socket.error, AttributeError):
+            pass # not a TCP socket.
+        
     def get_id(self):
         """
             Retrieves a new ID counter. Each connection has a exclusive ID counter.
@@ -295,6 +632,8 @@ class Connection(object): # TODO: Split this class in simple ones
             an apropiate object (a specific class) in certain cases.
             
             It is mainly used to convert JSON hinted classes back to real classes.
+            Hints are dictionaries with a single key found in *_loaders*, so
+            any other dictionary is returned after one length check.
             
             Parameters:
             
@@ -305,24 +644,32 @@ class Connection(object): # TODO: Split this class in simple ones
                 Either the same dictionary, or a class representing that object.
         """
         
-        if '__remoteobject__' in obj: 
-            return RemoteObject(self, obj)
-            
-        if '__objectreference__' in obj: 
-            return self._objects[obj['__objectreference__']]
-            
-        if '__functionreference__' in obj:
-            name = obj['__functionreference__']
-            if '.' in name:
-                objname, methodname = name.split('.')
-                obj = self._objects[objname]
-            else:
-                obj = self.handler
-                methodname = name
-            method = obj.get_method(methodname)
-            return method
+        if len(obj) != 1:
+            return obj # hints always have a single key.
+        (key,) = obj
+        loader = self._loaders.get(key)
+        if loader is None:
+            return obj
+        return loader(obj)
         
-        return obj
+    def _load_remoteobject(self, obj):
+        return self._remote_object_class(self, obj)
+        
+    def _load_objectreference(self, obj):
+        return self._objects[obj['__objectreference__']]
+        
+    def _load_promise(self, obj):
+        return _PromiseRef(obj['__promise__'])
+        
+    def _load_functionreference(self, obj):
+        name = obj['__functionreference__']
+        if '.' in name:
+            objname, methodname = name.split('.')
+            obj = self._objects[objname]
+        else:
+            obj = self.handler
+            methodname = name
+        return obj.get_method(methodname)
         
     def addrequest(self, request):
         """
@@ -345,6 +692,9 @@ class Connection(object): # TODO: Split this class in simple ones
             Given a incompatible object called *obj*, dump_object returns a 
             JSON hinted object that represents the original parameter.
             
+            The method used for each exact type is looked up once (see 
+            *_find_dumper*) and cached.
+            
             Parameters:
             
             **obj**
@@ -355,36 +705,85 @@ class Connection(object): # TODO: Split this class in simple ones
                 A valid serialization for that object using JSON class hinting.
                 
         """
-        # object of unknown type
-        if type(obj) is FunctionType or type(obj) is MethodType :
-            conn = getattr(obj, '_conn', None)
-            if conn != self: 
-                raise TypeError("Tried to serialize as JSON a handler for "
-                "another connection!")
-            return self._dump_functionreference(obj)
-            
-        if not isinstance(obj, object): 
-            raise TypeError("JSON objects must be new-style classes")
-            
-        if not hasattr(obj, '__class__'): 
-            raise TypeError("JSON objects must be instances, not types")
-            
-        if obj.__class__.__name__ == 'Decimal': # Probably is just a float.
-            return float(obj)
-            
-        if isinstance(obj, RemoteObject): 
-            return self._dump_objectreference(obj)
-            
+        cls = type(obj)
+        dumper = self._dumpers.get(cls)
+        if dumper is None:
+            dumper = self._find_dumper(cls)
+            if dumper is None:
+                return self._dump_unknown(obj)
+            self._dumpers[cls] = dumper
+        return dumper(obj)
+        
+    def _find_dumper(self, cls):
+        """
+            Returns the function that dumps the instances of *cls*, or None
+            if it is unknown. The result is cached in *_dumpers* by exact
+            type.
+        """
+        if cls is FunctionType or cls is MethodType:
+            return self._dump_functionreference
+        if issubclass(cls, PromiseRequest):
+            return self._dump_promise
+        registered = json.find_type(cls, self._types)
+        if registered is not None:
+            hint, encode = registered
+            return lambda obj: { hint : encode(obj) }
+        if issubclass(cls, RemoteObject): 
+            return self._dump_objectreference
+        if hasattr(cls, 'get_method'): 
+            return self._dump_remoteobject
+        return None
+        
+    def register_type(self, cls, hint_name, encode, decode):
+        """
+            Like *bjsonrpc.jsonlib.register_type*, but only for this 
+            connection. Both ends must register the same hint.
+        """
+        hint = json.hint_key(hint_name)
+        self._types[cls] = (hint, encode)
+        self._loaders[hint] = _hint_loader(hint, decode)
+        self._dumpers.clear()
+        
+    def _init_hints(self):
+        """
+            Prepares the tables used by *dump_object* and *load_object*:
+            *_types* (type -> (hint, encode)), *_dumpers* (type -> function,
+            filled on demand) and *_loaders* (hint -> function). The first
+            and the last start with the types registered in 
+            *bjsonrpc.jsonlib* when the connection is created.
+        """
+        self._types = json.registered_types()
+        self._dumpers = {}
+        self._loaders = {
+            '__remoteobject__' : self._load_remoteobject,
+            '__objectreference__' : self._load_objectreference,
+            '__functionreference__' : self._load_functionreference,
+            '__promise__' : self._load_promise,
+        }
+        for hint, decode in json.type_hints().items():
+            self._loaders[hint] = _hint_loader(hint, decode)
+        
+    def _dump_unknown(self, obj):
+        # The class has no get_method, but the instance may have one.
         if hasattr(obj, 'get_method'): 
             return self._dump_remoteobject(obj)
-            
         raise TypeError("Python object %s laks a 'get_method' and "
             "is not serializable!" % repr(obj))
-
+            
     def _dump_functionreference(self, obj):
         """ Converts obj to a JSON hinted-class functionreference"""
+        if getattr(obj, '_conn', None) != self: 
+            raise TypeError("Tried to serialize as JSON a handler for "
+            "another connection!")
         return { '__functionreference__' : obj.__name__ }
 
+    def _dump_promise(self, obj):
+        """ Converts a PromiseRequest to a JSON hinted-class promise """
+        if obj.name is None or obj.conn is not self:
+            raise TypeError("Tried to serialize a released promise or one "
+                            "of another connection!")
+        return { '__promise__' : obj.name }
+
     def _dump_objectreference(self, obj):
         """ Converts obj to a JSON hinted-class objectreference"""
         return { '__objectreference__' : obj.name }
@@ -459,7 +858,9 @@ class Connection(object): # TODO: Split this class in simple ones
     def _find_object(self, req_method, req_args, req_kwargs):
         if '.' in req_method: # local-object.
             objectname, req_method = req_method.split('.')[:2]
-            if objectname not in self._objects: 
+            if req_method == '__delete__' and objectname[:1] == '@':
+                self._forget_promise(objectname)
+            elif objectname not in self._objects: 
                 raise ValueError("Invalid object identifier")
             elif req_method == '__delete__':
                 self._dispatch_delete(objectname)
@@ -472,6 +873,8 @@ class Connection(object): # TODO: Split this class in simple ones
         """
             Finds the method to process one request.
         """
+        if '.' in req_method: # local-object.
+            req_method = req_method.split('.')[1]
         try:
             req_function = req_object.get_method(req_method)
             return req_function
@@ -483,6 +886,78 @@ class Connection(object): # TODO: Split this class in simple ones
                                          sys.exc_info())
             return err
 
+    def start_reader(self):
+        """
+            Starts reading the connection in the background: each response
+            is handed to its *request.Request* by id, and only the thread
+            waiting for it wakes up, instead of the calling threads taking 
+            turns to read (holding *read_lock*) for each other. Incoming 
+            calls are dispatched as *serve* does.
+            
+            Connections with an *ioloop* are read by the loop, the rest by
+            a new daemon thread, which closes the connection when the other
+            end does. The requests still waiting then raise *EofError*. 
+            Does nothing if the reader is already started.
+        """
+        if self._background_reader is not None: return
+        if self._ioloop is not None:
+            self._background_reader = self._ioloop
+            self._ioloop.add_reader(self._sck, self._reader_ready)
+        else:
+            thread = threading.Thread(target=self._reader_loop, 
+                                      name="bjsonrpc-reader")
+            thread.daemon = True
+            self._background_reader = thread
+            thread.start()
+            
+    def _reader_loop(self):
+        try:
+            while self.connection_status != "closed":
+                self.read_and_dispatch()
+        except Exception as exc:
+            if self._reader_error is not None:
+                return # stopped by close()
+            if not isinstance(exc, EofError):
+                _log.error("Unhandled error in reader: %s", 
+                           traceback.format_exc())
+            self._stop_reader(exc)
+            self.close()
+            
+    def _reader_ready(self):
+        """
+            Called by the IOLoop when the connection has data to read.
+        """
+        try:
+            self.dispatch_until_empty()
+        except EofError as exc:
+            self._ioloop.remove(self._sck)
+            self._stop_reader(exc)
+            
+    def _stop_reader(self, exc):
+        """
+            Records why the reader stopped and wakes up the threads waiting
+            for a response, which raise **exc**.
+        """
+        if self._reader_error is not None: return
+        self._reader_error = exc
+        for request in list(self._requests.values()):
+            request.wake()
+            
+    def reads_in_background(self):
+        """
+            Returns True if the responses for the calling thread are read
+            by the reader started with *start_reader*, so it must wait for 
+            them instead of reading.
+        """
+        reader = self._background_reader
+        if reader is None: 
+            return False
+        if reader is self._ioloop:
+            ident = reader._thread_ident
+        else:
+            ident = reader.ident
+        return ident != threading.current_thread().ident
+
     def dispatch_until_empty(self):
         """
             Calls *read_and_dispatch* method until there are no more messages to
@@ -493,21 +968,15 @@ class Connection(object): # TODO: Split this class in simple ones
             This method will never block waiting. If there aren't 
             any more messages that can be processed, it returns.
         """
-        ready_to_read = select.select( 
-                    [self._sck], # read
-                    [], [], # write, errors
-                    0 # timeout
-                    )[0]
-                    
-        if not ready_to_read: return 0
+        if not self._lines and not wait_readable(self._sck, 0): return 0
             
-        newline_idx = 0
         count = 0
-        while newline_idx != -1:
+        while True:
             if not self.read_and_dispatch(timeout=0): 
                 break
             count += 1
-            newline_idx = self._buffer.find(b'\n')
+            if not self._lines:
+                break
         return count
             
     def read_and_dispatch(self, timeout=None, thread=True, condition=None):
@@ -539,17 +1008,26 @@ class Connection(object): # TODO: Split this class in simple ones
             else:
                 dispatch_item = self.dispatch_item_single
             
-            data = self.read(timeout=timeout)
+            data = self._read_message(timeout=timeout)
             if not data: 
                 return False 
             try:
-                item = json.loads(data, self)
+                if isinstance(data, StreamDecoder):
+                    try:
+                        item = data.close()
+                    except ValueError as exc:
+                        self._fail_stream(data, exc)
+                        raise
+                else:
+                    item = json.loads(data, self)
                 if type(item) is list: # batch call
-                    for i in item: 
-                        dispatch_item(i)
+                    self._dispatch_batch(item, dispatch_item)
                 elif type(item) is dict: # std call
                     if 'result' in item:
                         self.dispatch_item_single(item)
+                    elif item.get('method') == '__negotiate__':
+                        # Must be applied before reading the next message.
+                        self._dispatch_negotiate(item)
                     else:
                         dispatch_item(item)
                 else: # Unknown format :-(
@@ -563,55 +1041,242 @@ class Connection(object): # TODO: Split this class in simple ones
             self.reading_event.clear()
             self.read_lock.release()
             
+    def _dispatch_batch(self, items, dispatch_item):
+        """
+            Dispatches the items of a batch. Responses are routed to their
+            requests right away; the responses to the calls are sent 
+            together, as a list, when all of them have finished.
+        """
+        if not items:
+            return
+        reply = _BatchReply(self, items)
+        reply.hold() # until all of them are dispatched
+        try:
+            for item in reply.items:
+                if type(item) is dict and 'result' in item:
+                    self.dispatch_item_single(item)
+                else:
+                    dispatch_item(item)
+        finally:
+            reply.release()
+
     def dispatch_item_threaded(self, item):
         """
-            If threaded mode is activated, this function creates a new thread per
-            each item received and returns without blocking.
+            If threaded mode is activated, this function queues each item 
+            received to be dispatched by a thread of the *worker_pool* and
+            returns (without blocking, unless the queue of the pool is full).
+            
+            The execution policies of the handlers are applied here (see
+            *bjsonrpc.handlers.BaseHandler.execution*): a call may be run
+            right away in this thread, or go through the 
+            *bjsonrpc.workers.ConcurrencyLimit* of its object or method.
         """
-        if self.threaded:
-            th1 = threading.Thread(target = self.dispatch_item_single, args = [ item ] )
-            th1.start()
+        if 'resultname' in item:
+            self._expect_promise(item)
+        if self._promises and self._check_promises(item):
+            return True
+        threaded, limit = self._execution_policy(item)
+        if threaded:
+            pool = self.worker_pool or WorkerPool.instance()
+            try:
+                if limit is not None:
+                    limit.submit(pool, self.dispatch_item_single, item)
+                else:
+                    pool.submit(self.dispatch_item_single, item)
+            except ServerBusyError as exc:
+                self._send_error(item, "ServerBusyError: %s" % exc)
+                if type(item) is _BatchItem:
+                    item.batch.release()
             return True
         else:
             return self.dispatch_item_single(item)
         
+    def _internal_error(self, response, e):
+        _log.error("An unexpected error ocurred when trying to create the message: %r", e)
+        return {
+            'id': response['id'],
+            'result': None,
+            'error': "InternalServerError: " + repr(e),
+            }
+
     def _send(self, response):
         txtResponse = None
         try:
             txtResponse = json.dumps(response, self)
         except Exception as e:
-            _log.error("An unexpected error ocurred when trying to create the message: %r", e)
-            response = {
-                'result': None,
-                'error': "InternalServerError: " + repr(e),
-                'id': item['id']
-                }
-            txtResponse = json.dumps(response, self)
+            txtResponse = json.dumps(self._internal_error(response, e), self)
         try:
             self.write(txtResponse)
         except TypeError:
             _log.debug("response was: %r", response)
             raise
 
+    def _send_batch(self, responses):
+        """
+            Sends the responses to a batch as a single message.
+        """
+        try:
+            data = json.dumps(responses, self)
+        except Exception:
+            # Find the ones that can't be encoded, and send them as errors.
+            checked = []
+            for response in responses:
+                try:
+                    json.dumps(response, self)
+                except Exception as e:
+                    response = self._internal_error(response, e)
+                checked.append(response)
+            data = json.dumps(checked, self)
+        self.write(data)
+
+    def _reply(self, item, response):
+        if type(item) is _BatchItem:
+            item.batch.add(response)
+        else:
+            self._send(response)
+
     def _send_response(self, item, response):
+        if 'resultname' in item:
+            if isinstance(response, ResultStream):
+                response = list(response)
+            self._resolve_promise(item, response, None)
+        if isinstance(response, ResultStream):
+            return self._send_stream(item, response)
+        if (self.table_min_rows is not None and type(response) is list 
+                and len(response) >= self.table_min_rows):
+            response = Table.from_rows(response) or response
         if item.get('id') is not None:
-            ret = { 'result': response, 'error': None, 'id': item['id'] }
-            self._send(ret)
+            # The id goes first, so a streamed result can be routed to its
+            # request before it is complete (see _stream_item).
+            ret = { 'id': item['id'], 'result': response, 'error': None }
+            self._reply(item, ret)
+
+    def _send_stream(self, item, stream):
+        """
+            Sends a *ResultStream* result with *write_stream*. The values 
+            are produced and encoded here, in the dispatching thread, which
+            waits while the writer is a few parts behind. Binary codecs get
+            it as a list, as msgpack needs the size of the list first.
+        """
+        if item.get('id') is None:
+            return
+        if self._write_codec.binary or type(item) is _BatchItem:
+            return self._send_response(item, list(stream))
+        ready = None
+        if self._ioloop is not None:
+            ready = self._stream_ready
+        pipe = StreamPipe(ready=ready, drain=self._stream_backpressure)
+        self.write_stream(pipe)
+        parts = self._encode_stream(item, stream)
+        try:
+            for part in parts:
+                if not pipe.put(part):
+                    _log.debug("Streamed response to %r interrupted", 
+                               item['id'])
+                    break
+        finally:
+            parts.close()
+            pipe.close()
+
+    def _stream_ready(self):
+        """
+            Sends the parts of a streamed message as they are produced, in
+            IOLoop mode.
+        """
+        if self.flush():
+            self._ioloop.want_write(self)
+
+    def _stream_backpressure(self, pipe):
+        """
+            Called by the producer of a streamed message while its 
+            *StreamPipe* is full. In IOLoop mode it sends what it can itself,
+            as it may be running in the loop thread.
+        """
+        if self.connection_status == "closed":
+            pipe.cancel()
+        elif self._ioloop is not None and self.flush():
+            wait_writable(self._sck, pipe.interval)
+
+    def _encode_stream(self, item, values):
+        """
+            Generator of the parts of the response to **item** whose result
+            is the list of the iterable **values**, encoded in batches of
+            about *stream_chunk_size* bytes. An exception raised by the 
+            iterable ends the list, and is sent in the *error* field.
+        """
+        codec = self._write_codec
+        def encode(obj):
+            data = codec.dumps(obj, self)
+            try:
+                return data.encode('utf-8')
+            except AttributeError:
+                return data
+        yield encode({ 'id' : item['id'] })[:-1] + b',"result":['
+        error = None
+        separator = b''
+        count = 16
+        values = iter(values)
+        while error is None:
+            batch = []
+            try:
+                for value in values:
+                    batch.append(value)
+                    if len(batch) >= count:
+                        break
+            except Exception:
+                error = self._stream_error(item)
+            if not batch:
+                break
+            try:
+                data = encode(batch)
+            except Exception:
+                error = self._stream_error(item)
+                break
+            yield separator + data[1:-1]
+            separator = b','
+            if len(batch) < count:
+                break
+            if len(data) < self.stream_chunk_size // 2:
+                count *= 2
+            elif len(data) > self.stream_chunk_size * 2 and count > 1:
+                count //= 2
+        yield b'],"error":' + encode(error) + b'}'
+
+    def _stream_error(self, item):
+        method, args, kw = self._extract_params(item)
+        return self._format_exception(self.handler, method, args, kw,
+                                      sys.exc_info())
 
     def _send_error(self, item, err):
+        if 'resultname' in item:
+            self._resolve_promise(item, None, err)
         if item.get('id') is not None:
-            ret = { 'result': None, 'error': err, 'id': item['id'] }
-            self._send(ret)
+            ret = { 'id': item['id'], 'result': None, 'error': err }
+            self._reply(item, ret)
 
     def dispatch_item_single(self, item):
         """
             Given a JSON item received from socket, determine its type and 
             process the message.
         """
-        assert(type(item) is dict)
+        assert(isinstance(item, dict))
         item.setdefault('id', None)
+        if 'resultname' in item:
+            self._expect_promise(item)
         
-        if 'method' in item:
+        if type(item) is _BatchItem:
+            try:
+                return self._dispatch_item_single(item)
+            finally:
+                item.batch.release()
+        return self._dispatch_item_single(item)
+        
+    def _dispatch_item_single(self, item):
+        if self._promises and self._check_promises(item, single=True):
+            return True
+        if item.get('method') == '__map__':
+            self._dispatch_map(item)
+        elif 'method' in item:
             method, args, kw = self._extract_params(item)
             obj = self._find_object(method, args, kw)
             if obj is None: return
@@ -620,6 +1285,9 @@ class Connection(object): # TODO: Split this class in simple ones
                 if inspect.isgeneratorfunction(fn):
                     for response in fn(*args, **kw):
                         self._send_response(item, response)
+                elif getattr(fn, '_run_in_process', None) is not None:
+                    self._dispatch_in_process(item, obj, method, 
+                                              fn._run_in_process, args, kw)
                 elif callable(fn):
                     self._send_response(item, fn(*args, **kw))
                 elif fn:
@@ -633,12 +1301,307 @@ class Connection(object): # TODO: Split this class in simple ones
         elif 'result' in item:
             assert(item['id'] in self._requests)
             request = self._requests[item['id']]
+            if (request.data.get('method') == '__negotiate__' 
+                    and item.get('error') is None):
+                # Everything the peer sends after this response uses the
+                # options it has chosen.
+                self._apply_options(item['result'], 'read')
             request.setresponse(item)
         else:
             self._send_error(item, 'Unknown format')
         return True
     
-    def proxy(self, sync_type, name, args, kwargs, callback = None):
+    def _expect_promise(self, item):
+        """
+            Registers the promise of the call **item**, which keeps its 
+            result under its *resultname*, before the calls received after 
+            it can refer to it.
+        """
+        name = item['resultname']
+        if type(name) is not str:
+            return
+        self._promise_lock.acquire()
+        try:
+            if name not in self._promises:
+                self._promises[name] = _Promise()
+        finally:
+            self._promise_lock.release()
+            
+    def _check_promises(self, item, single=False):
+        """
+            Looks for the promises that **item** depends on: the object of 
+            its method ("@<id>.method") and the references in its arguments.
+            Returns False when the item can be dispatched, after putting 
+            the results in their place. Otherwise returns True: the item 
+            was answered with an error, or waits for a promise and is 
+            dispatched again when it is resolved. **single** is True when 
+            called by *dispatch_item_single*, which releases the batch of 
+            the item afterwards.
+        """
+        method = item.get('method')
+        if type(method) is not str:
+            return False
+        names = []
+        objectname = None
+        if method[:1] == '@':
+            objectname, _, methodname = method.partition('.')
+            names.append(objectname)
+        params = item.get('params')
+        kwparams = item.get('kwparams')
+        _promise_refs(params, names)
+        _promise_refs(kwparams, names)
+        if not names:
+            return False
+        error = None
+        values = {}
+        self._promise_lock.acquire()
+        try:
+            for name in names:
+                promise = self._promises.get(name)
+                if promise is None:
+                    error = error or "ValueError: Unknown promise %s" % name
+                elif not promise.done:
+                    promise.waiting.append(item)
+                    if single and type(item) is _BatchItem:
+                        item.batch.hold()
+                    return True
+                elif promise.error is not None:
+                    error = error or "Promise %s failed: %s" % (name, 
+                                                                promise.error)
+                else:
+                    values[name] = promise.value
+        finally:
+            self._promise_lock.release()
+        if objectname is not None and methodname == '__delete__':
+            return False
+        if error is None and objectname is not None:
+            obj = values[objectname]
+            if hasattr(obj, 'get_method'):
+                objectname = self._dump_remoteobject(obj)['__remoteobject__']
+                item['method'] = "%s.%s" % (objectname, methodname)
+            else:
+                error = "TypeError: The result of %s has no methods" % (
+                    objectname)
+        if error is not None:
+            self._send_error(item, error)
+            if not single and type(item) is _BatchItem:
+                item.batch.release()
+            return True
+        if params is not None:
+            item['params'] = _substitute(params, values)
+        if kwparams is not None:
+            item['kwparams'] = _substitute(kwparams, values)
+        return False
+        
+    def _resolve_promise(self, item, value, error):
+        """
+            Keeps the result of the call **item** in its promise, and 
+            dispatches the calls that were waiting for it.
+        """
+        self._promise_lock.acquire()
+        try:
+            promise = self._promises.get(item['resultname'])
+            if promise is None or promise.done:
+                return
+            promise.done = True
+            promise.value = value
+            promise.error = error
+            waiting, promise.waiting = promise.waiting, None
+        finally:
+            self._promise_lock.release()
+        for waiter in waiting:
+            self.dispatch_item_threaded(waiter)
+            
+    def _forget_promise(self, name):
+        self._promise_lock.acquire()
+        try:
+            self._promises.pop(name, None)
+        finally:
+            self._promise_lock.release()
+        
+    def _dispatch_map(self, item):
+        """
+            Dispatches a call of the *map* proxy, whose parameters are the
+            name of the method, the number of calls and their arguments by 
+            columns. The method is looked up once and called for each row
+            of arguments. The result is the list of their results; if one
+            fails, the results before it and its error.
+        """
+        try:
+            name, count, columns = item['params']
+            rows = zip(*columns) if columns else repeat((), count)
+        except Exception:
+            return self._send_error(item, "ValueError: Invalid map call")
+        obj = self._find_object(name, (), {})
+        if obj is None: return
+        fn = self._find_method(obj, name, (), {})
+        if not callable(fn):
+            return self._send_error(item, fn or "%s is not callable" % name)
+        if (inspect.isgeneratorfunction(fn) 
+                or inspect.iscoroutinefunction(fn)
+                or inspect.isasyncgenfunction(fn)
+                or getattr(fn, '_run_in_process', None) is not None):
+            return self._send_error(item, "ValueError: %s can't be mapped" 
+                                    % name)
+        results = []
+        for args in rows:
+            try:
+                results.append(fn(*args))
+            except ServerError as exc:
+                error = str(exc)
+                break
+            except Exception:
+                error = self._format_exception(obj, name, args, {},
+                                               sys.exc_info())
+                break
+        else:
+            return self._send_response(item, results)
+        self._reply(item, { 'id': item['id'], 'result': results, 
+                            'error': error })
+        
+    def _execution_policy(self, item):
+        """
+            Returns whether the call **item** goes to the worker pool, and
+            the *ConcurrencyLimit* it goes through (or None), according to
+            the execution policies of its object and method. Looks them up
+            without side effects: errors are left to *dispatch_item_single*.
+        """
+        name = item.get('method')
+        if name == '__map__':
+            params = item.get('params')
+            if type(params) is list and params:
+                name = params[0]
+        if type(name) is not str:
+            return self.threaded, None
+        if '.' in name:
+            objectname, name = name.split('.')[:2]
+            obj = self._objects.get(objectname)
+        else:
+            obj = self.handler
+        execution = getattr(obj, 'execution', None)
+        try:
+            fn = obj.get_method(name)
+        except Exception:
+            fn = None
+        if execution == 'inline' or getattr(fn, '_execution', None) == 'inline':
+            return False, None
+        if execution == 'ordered':
+            return True, obj._ordered_limit
+        limit = getattr(fn, '_concurrency_limit', None)
+        if limit is not None:
+            return True, limit
+        if execution == 'concurrent':
+            return True, None
+        return self.threaded, None
+        
+    def _dispatch_in_process(self, item, obj, method, function, args, kw):
+        """
+            Runs a method decorated with *bjsonrpc.handlers.run_in_process*
+            in the shared process pool. The response is sent by a callback 
+            when it finishes, so this thread goes on dispatching.
+        """
+        def done(future):
+            try:
+                response = future.result()
+            except ServerError as exc:
+                self._send_error(item, str(exc))
+            except Exception:
+                err = self._format_exception(obj, method, args, kw,
+                                             sys.exc_info())
+                self._send_error(item, err)
+            else:
+                self._send_response(item, response)
+            finally:
+                if type(item) is _BatchItem:
+                    item.batch.release()
+        if type(item) is _BatchItem:
+            item.batch.hold()
+        submit_to_process(function, args, kw).add_done_callback(done)
+        
+    def negotiate(self, **options):
+        """
+            Agrees with the other end on the connection options given as
+            keyword arguments. Each one is a value or a list of values in
+            order of preference, e.g. *negotiate(framing='length')*. See
+            *negotiation* for the available options.
+            
+            This must be called before any other request is sent. The other
+            end picks the first value of each option it supports and both
+            ends switch to them right after the handshake. Peers that do not
+            know the handshake keep the defaults.
+            
+            Returns a dictionary with the chosen options.
+        """
+        request = {}
+        for name, values in options.items():
+            if not isinstance(values, (list, tuple)):
+                values = [ values ]
+            supported = self.negotiation.get(name, ())
+            values = [ value for value in values if value in supported ]
+            if values:
+                request[name] = values
+        if (request.get('compression', ['none']) != ['none'] or
+                request.get('codec', ['json']) != ['json']):
+            # Compressed and msgpack messages are binary.
+            request.setdefault('framing', ['length'])
+        if not request:
+            return {}
+        try:
+            chosen = self.call.__negotiate__(**request)
+        except ServerError as exc:
+            _log.debug("Peer doesn't support negotiation: %s", exc)
+            return {}
+        self._apply_options(chosen, 'write')
+        return chosen
+        
+    def _dispatch_negotiate(self, item):
+        """
+            Answers a *negotiate* request from the other end. The response 
+            is still sent with the old options: they are applied to the 
+            input before it and to the output after it.
+        """
+        method, args, kw = self._extract_params(item)
+        chosen = {}
+        for name, values in kw.items():
+            if not isinstance(values, (list, tuple)):
+                values = [ values ]
+            supported = self.negotiation.get(name, ())
+            for value in values:
+                if value in supported:
+                    chosen[name] = value
+                    break
+        if chosen.get('framing', self._read_framing) != 'length':
+            chosen.pop('compression', None)
+            if chosen.get('codec', 'json') != 'json':
+                chosen.pop('codec')
+        self._apply_options(chosen, 'read')
+        self._send_response(item, chosen)
+        self._apply_options(chosen, 'write')
+
+    def _apply_options(self, options, side):
+        """
+            Applies the negotiated *options* to one *side* ('read' or
+            'write') of the connection, calling *_set_<side>_<option>*.
+        """
+        for name, value in options.items():
+            getattr(self, "_set_%s_%s" % (side, name))(value)
+
+    def batch(self):
+        """
+            Returns a *request.Batch*, to send several calls as a single 
+            message::
+            
+                with conn.batch() as batch:
+                    requests = [ batch.method.add2(i, 1) for i in range(50) ]
+                print([ request.value for request in requests ])
+                
+            The other end sends all their responses in a single message 
+            too, when all of them have finished.
+        """
+        return Batch(self)
+
+    def proxy(self, sync_type, name, args, kwargs, callback = None, 
+              batch = None):
         """
         Call method on server.
 
@@ -647,15 +1610,24 @@ class Connection(object): # TODO: Split this class in simple ones
           = 1 .. call method, inmediate return of object.
           = 2 .. call notification and exit.
           = 3 .. call method, inmediate return of non-auto-close object.
+          = 4 .. call method, inmediate return of object that streams the result.
+          = 5 .. call method for each element of an iterable (see *map*).
+          = 6 .. call method, inmediate return of a promise (see *promise*).
+        
+        With a *request.Batch* in **batch**, the call is added to it instead
+        of being sent (calls are made as 1).
           
         """
        
         data = {}
         data['method'] = name
 
-        if sync_type in [0, 1, 3]: 
+        if sync_type in [0, 1, 3, 4, 6]: 
             data['id'] = self.get_id()
             
+        if sync_type == 6:
+            data['resultname'] = "@%d" % data['id']
+            
         if len(args) > 0: 
             data['params'] = args
             
@@ -665,31 +1637,90 @@ class Connection(object): # TODO: Split this class in simple ones
             else: 
                 data['kwparams'] = kwargs
             
+        if sync_type == 5:
+            return self._map(name, *args, **kwargs)
+        
+        if batch is not None:
+            if sync_type == 2:
+                return batch.add(data)
+            return Request(self, data, callback = callback, batch = batch)
+        
         if sync_type == 2: # short-circuit for speed!
             self.write(json.dumps(data, self))
             return None
                     
-        req = Request(self, data, callback = callback)
+        if sync_type == 3:
+            req = PipeRequest(self, data, callback = callback)
+        elif sync_type == 4:
+            req = StreamRequest(self, data, callback = callback)
+        elif sync_type == 6:
+            req = PromiseRequest(self, data, callback = callback)
+        else:
+            req = Request(self, data, callback = callback)
         if sync_type == 0: 
             return req.value
-        if sync_type == 3:
-            req.auto_close = False
         return req
 
+    def _map(self, name, iterable, chunk_size=1000, window=4):
+        """
+            Sends the chunks of a *map* call, up to **window** ahead of the
+            one being iterated, and returns an iterator over the results.
+        """
+        assert(chunk_size > 0 and window > 0)
+        requests = self._map_requests(name, iterable, chunk_size)
+        pending = deque(islice(requests, window))
+        return self._map_results(pending, requests)
+        
+    def _map_requests(self, name, iterable, chunk_size):
+        iterable = iter(iterable)
+        while True:
+            rows = [ args if type(args) is tuple else (args,) 
+                     for args in islice(iterable, chunk_size) ]
+            if not rows:
+                return
+            width = len(rows[0])
+            for args in rows:
+                if len(args) != width:
+                    raise ValueError("map() calls must have the same number"
+                                     " of arguments")
+            columns = [ list(column) for column in zip(*rows) ]
+            data = { 'method' : '__map__', 'id' : self.get_id(), 
+                     'params' : [ name, len(rows), columns ] }
+            yield Request(self, data)
+        
+    def _map_results(self, pending, requests):
+        while pending:
+            request = pending.popleft()
+            pending.extend(islice(requests, 1))
+            request.wait()
+            response = request.response
+            for value in response.get('result') or ():
+                yield value
+            err = response.get('error', None)
+            if err is not None:
+                raise ServerError(err)
+
     def close(self):
         """
             Close the connection and the socket. 
         """
         if self.connection_status == "closed": return
-        item = {
-            'abort' : True,
-            'event' : threading.Event()
-        }
-        self.write_thread_queue.append(item)
-        self.write_thread_semaphore.release() # notify new item.
-        item['event'].wait(1)
-        if not item['event'].isSet():
-            _log.warning("write thread doesn't process our abort command")
+        if self._background_reader is not None:
+            if self._background_reader is self._ioloop:
+                self._ioloop.remove(self._sck)
+            self._stop_reader(EofError(0))
+        if self._ioloop is not None:
+            self._close_buffered()
+        else:
+            item = {
+                'abort' : True,
+                'event' : threading.Event()
+            }
+            self.write_thread_queue.append(item)
+            self.write_thread_semaphore.release() # notify new item.
+            item['event'].wait(1)
+            if not item['event'].isSet():
+                _log.warning("write thread doesn't process our abort command")
         try:
             self.handler._shutdown()
         except Exception:
@@ -715,43 +1746,126 @@ class Connection(object): # TODO: Split this class in simple ones
             **data**
                 String containing the data to be sent.
         """
-        assert('\n' not in data)
+        return self.write_lines([data])
+        
+    def write_lines(self, lines):
+        """
+            Write several lines (messages) to socket at once, framed with the
+            current write framing. See *_write_frames*.
+            
+            Returns the number of bytes left in the output buffer.
+        """
+        return self._write_frames([ self._frame(data) for data in lines ])
+        
+    def _write_frames(self, frames):
+        """
+            Sends several frames (as returned by *_frame*). Their buffers are
+            appended to the output buffer without concatenating them, and the
+            buffer is sent with a single *sendmsg* (scatter-gather) call when
+            possible.
+            
+            Returns the number of bytes left in the output buffer.
+        """
         self.write_lock.acquire()
         try:
-            try:
-                data = data.encode('utf-8')
-            except AttributeError:
-                pass
-            if self._debug_socket: 
-                _log.debug("<:%d: %s", len(data), data.decode('utf-8')[:130])
-
-            self._wbuffer += data + b'\n'
-            sbytes = 0
-            while self._wbuffer:
-                try:
-                    sbytes = self._sck.send(self._wbuffer)
-                except IOError:
-                    _log.debug("Read socket error: IOError (timeout: %r)",
-                        self._sck.gettimeout())
-                    _log.debug(traceback.format_exc(0))
-                    return 0
-                except socket.error:
-                    _log.debug("Read socket error: socket.error (timeout: %r)",
-                        self._sck.gettimeout())
-                    _log.debug(traceback.format_exc(0))
-                    return 0
-                except:
-                    raise
-                if sbytes == 0: 
-                    break
-                self._wbuffer = self._wbuffer[sbytes:]
-            if self._wbuffer:
-                _log.warning("%d bytes left in write buffer", len(self._wbuffer))
-            return len(self._wbuffer)
+            for frame in frames:
+                self._append_frame(frame)
+            return self._send_wbuffer()
         finally:
             self.write_lock.release()
             
+    def _send_wbuffer(self):
+        """
+            Sends the output buffer, blocking. Returns the number of bytes 
+            left in it (0 on errors, which are logged). The caller must hold
+            *write_lock*.
+        """
+        sbytes = 0
+        while self._wbuffer:
+            try:
+                sbytes = self._sendmsg()
+            except IOError:
+                _log.debug("Read socket error: IOError (timeout: %r)",
+                    self._sck.gettimeout())
+                _log.debug(traceback.format_exc(0))
+                return 0
+            except socket.error:
+                _log.debug("Read socket error: socket.error (timeout: %r)",
+                    self._sck.gettimeout())
+                _log.debug(traceback.format_exc(0))
+                return 0
+            except:
+                raise
+            if sbytes == 0: 
+                break
+        if self._wbuffer:
+            _log.warning("%d bytes left in write buffer", self._wbuffer_size)
+        return self._wbuffer_size
+        
+    def _frame(self, data):
+        """
+            Encodes the message *data* and returns it along with the write
+            framing and compressor that are current, so a change of options
+            applies exactly to the messages written after it. The buffers
+            are built later by *_append_frame*.
+        """
+        try:
+            data = data.encode('utf-8')
+        except AttributeError:
+            pass
+        if self._debug_socket: 
+            _log.debug("<:%d: %s", len(data), 
+                       data[:130].decode('utf-8', 'replace'))
+        if self._write_framing != 'length':
+            assert(b'\n' not in data)
+        return (self._write_framing, self._compressor, data)
 
+    def _append_frame(self, frame):
+        """
+            Appends the buffers of *frame* to the output buffer: the data 
+            followed by a newline, or a length header followed by the 
+            (maybe compressed) data. The caller must hold *write_lock*, so
+            messages are compressed in the same order they are sent.
+        """
+        framing, compressor, data = frame
+        if framing == 'length':
+            if compressor is not None:
+                bufs = compressor.compress(data)
+            else:
+                bufs = [ data ]
+            size = sum([ len(buf) for buf in bufs ])
+            if size > _MAX_FRAME_SIZE:
+                raise ValueError("Message of %d bytes is too big" % size)
+            bufs.insert(0, _FRAME_HEADER.pack(size))
+        else:
+            bufs = [ data, b'\n' ]
+        for buf in bufs:
+            self._wbuffer.append(buf)
+            self._wbuffer_size += len(buf)
+
+    def _sendmsg(self, flags = 0):
+        """
+            Sends the head of the output buffer with one system call, and 
+            removes from the buffer what has been sent. Returns the number of
+            bytes sent.
+        """
+        wbuffer = self._wbuffer
+        if _HAS_SENDMSG:
+            sbytes = self._sck.sendmsg(list(islice(wbuffer, _IOV_MAX)), 
+                                       [], flags)
+        else:
+            sbytes = self._sck.send(b''.join(wbuffer), flags)
+        self._wbuffer_size -= sbytes
+        left = sbytes
+        while left:
+            head = wbuffer[0]
+            if len(head) <= left:
+                left -= len(head)
+                wbuffer.popleft()
+            else:
+                wbuffer[0] = memoryview(head)[left:]
+                left = 0
+        return sbytes
 
     def read_line(self):
         """
@@ -761,15 +1875,34 @@ class Connection(object): # TODO: Split this class in simple ones
             If the original packet contained `\\n`, the message will be decoded
             as two or more messages.
             
-            Returns the line of *data* received from the socket.
+            Returns the line of *data* received from the socket. Messages
+            decoded while they were received (see *stream_threshold*) are 
+            returned as the finished *bjsonrpc.streaming.StreamDecoder*.
         """
+        data = self._read_line()
+        if isinstance(data, StreamDecoder) or self._read_codec.binary:
+            return data
+        return data.decode('utf-8')
         
+    def _read_line(self):
+        """
+            Like *read_line*, but returns the message as received (*bytes*),
+            without decoding it to text: the codecs decode bytes directly.
+        """
         self.read_lock.acquire()
         try:
             data = self._readn()
+            if isinstance(data, StreamDecoder):
+                return data
+            if self._decompressor is not None and len(data):
+                try:
+                    data = self._decompressor.decompress(data)
+                except ValueError as exc:
+                    self._protocol_error(exc)
             if len(data) and self._debug_socket: 
-                _log.debug(">:%d: %s", len(data), data.decode('utf-8')[:130])
-            return data.decode('utf-8')
+                _log.debug(">:%d: %s", len(data), 
+                           data[:130].decode('utf-8', 'replace'))
+            return data
         finally:
             self.read_lock.release()
             
@@ -791,30 +1924,266 @@ class Connection(object): # TODO: Split this class in simple ones
             
     
     def write_thread(self):
+        """
+            Writer thread main loop. Each time it wakes up it takes every item
+            queued at that moment (waiting up to *write_coalesce_delay* 
+            seconds for more, and never more than *write_coalesce_bytes*),
+            and sends all of them together.
+        """
         abort = False
+        queue = self.write_thread_queue
+        semaphore = self.write_thread_semaphore
         while not abort:
-            self.write_thread_semaphore.acquire() 
+            semaphore.acquire() 
             try:
-                item = self.write_thread_queue.pop(0)
+                items = [ queue.popleft() ]
             except IndexError: # pop from empty list?
                 _log.warning("write queue was empty??")
                 continue
-            abort = item.get("abort", False)
-            event = item.get("event")
-            write_data  = item.get("write_data")
-            if write_data: item["result"] = self.write_now(write_data)
-            if event: event.set()
+            size = _frame_size(items[0].get("write_data"))
+            deadline = None
+            while (size < self.write_coalesce_bytes 
+                   and not items[-1].get("abort", False)):
+                if not semaphore.acquire(False):
+                    if not self.write_coalesce_delay:
+                        break
+                    if deadline is None:
+                        deadline = time.time() + self.write_coalesce_delay
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or not semaphore.acquire(True, remaining):
+                        break
+                item = queue.popleft()
+                items.append(item)
+                size += _frame_size(item.get("write_data"))
+            
+            frames = []
+            result = None
+            for item in items:
+                if item.get("write_stream") is not None:
+                    if frames:
+                        result = self._write_now_frames(frames)
+                        frames = []
+                    self._write_now_stream(item["write_stream"], 
+                                           item["stream_source"])
+                elif item.get("write_data"):
+                    frames.append(item["write_data"])
+            if frames: 
+                result = self._write_now_frames(frames)
+            for item in items:
+                abort = abort or item.get("abort", False)
+                if item.get("write_data"): item["result"] = result
+                event = item.get("event")
+                if event: event.set()
         if self._debug_socket:
             _log.debug("Writing thread finished.")
             
             
     def write(self, data, timeout = None):
+        """
+            Queues the message *data* to be sent. Depending on the write mode 
+            it is sent by the writer thread of this connection or buffered
+            and flushed without blocking (see *write_buffered*).
+            
+            The message is framed right away, so a change of framing applies
+            exactly to the messages written after it.
+        """
+        if self._ioloop is not None:
+            return self.write_buffered(data)
+        item = {
+            'write_data' : self._frame(data)
+        }
+        self.write_thread_queue.append(item)
+        self.write_thread_semaphore.release() # notify new item.
+
+    def write_stream(self, pieces):
+        """
+            Queues a message produced in parts by the iterable **pieces** 
+            (*bytes*), like *write*. The parts are taken, framed and sent one
+            at a time by the writer thread (or when the socket is writable, 
+            in IOLoop mode), and the messages written meanwhile are sent 
+            after the last one. So only one part has to be in memory at a 
+            time, and the first ones are sent before the rest are produced.
+            
+            The parts are taken while holding *write_lock*, so producing 
+            them must be quick. Parts produced by another thread are given
+            with a *bjsonrpc.streaming.StreamPipe*, which yields None while
+            the next part isn't ready: the writer thread waits for it 
+            without the lock, and in IOLoop mode the pipe must resume the 
+            sending with its *ready* callback.
+            
+            With length framing every part is sent as a fragment: a frame 
+            whose length header has its high bit set, but the last one. The
+            receiver joins the fragments (or decodes them as they arrive, 
+            see *stream_threshold*).
+        """
+        buffers = self._stream_buffers(self._write_framing, self._compressor,
+                                       pieces)
+        if self._ioloop is not None:
+            self.write_lock.acquire()
+            try:
+                if self._wstream is None and not self._wdeferred:
+                    self._wstream = buffers
+                else:
+                    self._wdeferred.append(buffers)
+                pending = self.flush()
+            finally:
+                self.write_lock.release()
+            if pending:
+                self._ioloop.want_write(self)
+            return
         item = {
-            'write_data' : data
+            'write_stream' : buffers,
+            'stream_source' : pieces,
         }
         self.write_thread_queue.append(item)
         self.write_thread_semaphore.release() # notify new item.
 
+    def _stream_buffers(self, framing, compressor, pieces):
+        """
+            Generator of the buffers to send for each part of a message 
+            written with *write_stream*, framed with **framing** and 
+            compressed with **compressor**. Like *_append_frame*, it has to
+            be advanced while holding *write_lock*. A None part (not 
+            produced yet) yields an empty list.
+        """
+        if framing != 'length':
+            for piece in pieces:
+                if piece is None:
+                    yield []
+                    continue
+                if self._debug_socket: 
+                    _log.debug("<:%d: %s (streamed)", len(piece), piece[:130])
+                assert(b'\n' not in piece)
+                yield [ piece ]
+            yield [ b'\n' ]
+            return
+        if compressor is not None:
+            pieces = compressor.compress_pieces(pieces)
+        last = None
+        for piece in pieces:
+            if piece is None:
+                yield []
+                continue
+            if not piece:
+                continue
+            if self._debug_socket: 
+                _log.debug("<:%d: %s (streamed)", len(piece), piece[:130])
+            if last is not None:
+                yield [ _FRAME_HEADER.pack(len(last) | _FRAGMENT), last ]
+            last = piece
+        if last is None:
+            last = b''
+        yield [ _FRAME_HEADER.pack(len(last)), last ]
+
+    def write_buffered(self, data):
+        """
+            Appends the message *data* to the output buffer and sends as much
+            as the socket accepts without blocking. If something is left, the
+            IOLoop is asked to send it when the socket becomes writable.
+        """
+        frame = self._frame(data)
+        self.write_lock.acquire()
+        try:
+            if self._wstream is not None or self._wdeferred:
+                self._wdeferred.append(frame) # after the streamed message
+            else:
+                self._append_frame(frame)
+            pending = self.flush()
+        finally:
+            self.write_lock.release()
+        if pending:
+            self._ioloop.want_write(self)
+        
+    def flush(self):
+        """
+            Sends as much of the output buffer as the socket accepts without
+            blocking. Returns the number of bytes left in the buffer.
+        """
+        self.write_lock.acquire()
+        try:
+            while self._wbuffer or self._refill():
+                try:
+                    if (self._sck.gettimeout() != 0 and 
+                            not wait_writable(self._sck, 0)):
+                        break
+                    sbytes = self._sendmsg(_MSG_DONTWAIT)
+                except socket.error as inst:
+                    if inst.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    _log.debug("Write socket error: socket.error%r", inst.args)
+                    self._wbuffer.clear()
+                    self._wbuffer_size = 0
+                    self._drop_streams()
+                    break
+                if sbytes == 0: 
+                    break
+            return self._wbuffer_size
+        finally:
+            self.write_lock.release()
+
+    def _refill(self):
+        """
+            Called by *flush* when the output buffer is empty: appends the 
+            next part of the message being streamed or, once it is complete,
+            the messages written after it. Returns False if there is nothing
+            left to send, or the next part isn't produced yet.
+        """
+        while True:
+            if self._wstream is not None:
+                bufs = next(self._wstream, None)
+                if bufs is not None:
+                    if not bufs:
+                        return False
+                    for buf in bufs:
+                        self._wbuffer.append(buf)
+                        self._wbuffer_size += len(buf)
+                    return True
+                self._wstream = None
+            deferred = self._wdeferred
+            while deferred and type(deferred[0]) is tuple:
+                self._append_frame(deferred.popleft())
+            if self._wbuffer:
+                return True
+            if not deferred:
+                return False
+            self._wstream = deferred.popleft()
+
+    def _close_buffered(self):
+        """
+            Sends what is left in the output buffer (waiting up to one second)
+            and removes this connection from the IOLoop.
+        """
+        self.write_lock.acquire()
+        try:
+            try:
+                self._sck.settimeout(1)
+                while self._wbuffer:
+                    self._sendmsg()
+            except socket.error:
+                _log.warning("%d bytes left in write buffer", 
+                             self._wbuffer_size)
+            if self._wstream is not None or self._wdeferred:
+                _log.warning("Streamed message interrupted by close")
+            self._wbuffer.clear()
+            self._wbuffer_size = 0
+            self._drop_streams()
+        finally:
+            self.write_lock.release()
+        self._ioloop.remove(self._sck)
+
+    def _drop_streams(self):
+        """
+            Forgets the streamed messages not sent (IOLoop mode), so their
+            producers stop. The caller must hold *write_lock*.
+        """
+        if self._wstream is not None:
+            self._wstream.close()
+            self._wstream = None
+        for deferred in self._wdeferred:
+            if type(deferred) is not tuple:
+                deferred.close()
+        self._wdeferred.clear()
+
     def write_now(self, data, timeout = None):
         """ 
             Standard function to write to the socket 
@@ -828,6 +2197,39 @@ class Connection(object): # TODO: Split this class in simple ones
         #finally:
         #    self.scklock.release()
         return ret
+
+    def _write_now_frames(self, frames, timeout = None):
+        """ 
+            Writes several frames to the socket at once, like *write_now*.
+        """
+        self.settimeout("write", timeout)
+        return self._write_frames(frames)
+
+    def _write_now_stream(self, buffers, source, timeout = None):
+        """ 
+            Sends the parts of a message written with *write_stream*, one at
+            a time, waiting for **source** when the next one isn't produced
+            yet. Gives up on the rest of the message if one isn't sent.
+        """
+        self.settimeout("write", timeout)
+        while True:
+            self.write_lock.acquire()
+            try:
+                bufs = next(buffers, None)
+                if bufs is None:
+                    return
+                for buf in bufs:
+                    self._wbuffer.append(buf)
+                    self._wbuffer_size += len(buf)
+                self._send_wbuffer()
+                if self._wbuffer:
+                    _log.warning("Streamed message interrupted")
+                    buffers.close()
+                    return
+            finally:
+                self.write_lock.release()
+            if not bufs:
+                source.wait()
     
     def read(self, timeout = None):
         """ 
@@ -842,34 +2244,49 @@ class Connection(object): # TODO: Split this class in simple ones
         finally:
             self.scklock.release()
         return ret
+        
+    def _read_message(self, timeout = None):
+        """ 
+            Like *read*, for *read_and_dispatch*: see *_read_line*.
+        """
+        # The timeout of the socket is shared with the writer thread, so 
+        # an explicit timeout is waited for here.
+        if (timeout and not self._lines 
+                and not wait_readable(self._sck, timeout)):
+            return b''
+        self.scklock.acquire()
+        self.settimeout("read", timeout)
+        try:
+            return self._read_line()
+        finally:
+            self.scklock.release()
 
     def _readn(self):
         """
-            Internal function which reads from socket waiting for a newline
+            Internal function which reads from socket waiting for a newline.
+            Returns the first complete line as *bytes*, or the finished 
+            *StreamDecoder* of a message decoded while it was received.
+            
+            While a message is streamed, it returns b'' after each read that 
+            hands elements of its result to a *Request*, so a thread that 
+            reads only to iterate that request can consume them.
         """
-        streambuffer = self._buffer
-        pos = streambuffer.find(b'\n')
         #_log.debug("read...")
-        #retry = 0
-        while pos == -1:
-            data = b''
+        while not self._lines:
+            if self._rerror is not None:
+                self._protocol_error(self._rerror)
             try:
-                data = self._sck.recv(2048)
+                nbytes = self._recv_into()
             except IOError as inst:
                 _log.debug("Read socket error: IOError%r (timeout: %r)",
                     inst.args, self._sck.gettimeout())
                 if inst.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
-                    if self._sck.gettimeout() == 0: # if it was too fast
-                        self._sck.settimeout(5)
-                        continue
-                        #time.sleep(0.5)
-                        #retry += 1
-                        #if retry < 10:
-                        #    _log.debug("Retry %s", retry)
-                        #    continue
+                    # Non-blocking read (e.g. from an IOLoop): the rest of
+                    # the message stays in the buffer for the next one.
+                    return b''
                 #_log.debug(traceback.format_exc(0))
                 if inst.errno in self._SOCKET_COMM_ERRORS:
-                    raise EofError(len(streambuffer))                
+                    raise EofError(self._rend - self._rstart)
                 
                 return b''
             except socket.error as inst:
@@ -879,16 +2296,387 @@ class Connection(object): # TODO: Split this class in simple ones
                 return b''
             except:
                 raise
-            if not data:
-                raise EofError(len(streambuffer))
-            #_log.debug("readbuf+: %r", data)
-            streambuffer += data
-            pos = streambuffer.find(b'\n')
-
-        self._buffer = streambuffer[pos + 1:]
-        streambuffer = streambuffer[:pos]
-        #_log.debug("read: %r", buffer)
-        return streambuffer
+            if not nbytes:
+                raise EofError(self._rend - self._rstart)
+            try:
+                self._split_frames()
+            except ValueError as exc:
+                # The messages before the error are read first.
+                self._rerror = exc
+            if self._rdelivered:
+                self._rdelivered = False
+                if not self._lines:
+                    return b''
+
+        #_log.debug("read: %r", self._lines[0])
+        return self._lines.popleft()
+
+    def _recv_into(self):
+        """
+            Receives data directly into the free space at the end of the 
+            receive buffer, growing it by up to *read_chunk_size* bytes if 
+            needed. Returns the number of bytes received.
+        """
+        chunk = self.read_chunk_size
+        if len(self._rbuf) - self._rend < chunk:
+            if self._rstart:
+                # Move the incomplete line to the start of the buffer.
+                del self._rbuf[:self._rstart]
+                self._rend -= self._rstart
+                self._rscan -= self._rstart
+                self._rstart = 0
+            free = len(self._rbuf) - self._rend
+            if free < chunk:
+                # Grown only as the data arrives, never by the size that 
+                # the other end announces.
+                self._rbuf.extend(bytearray(chunk - free))
+        # When the size of the next frame is known, read as much of it as
+        # fits at once.
+        chunk = max(chunk, min(self._rwant, len(self._rbuf) - self._rend))
+        view = memoryview(self._rbuf)
+        try:
+            nbytes = self._sck.recv_into(view[self._rend:], chunk)
+        finally:
+            view.release()
+        self._rend += nbytes
+        return nbytes
+
+    def _split_frames(self):
+        """
+            Moves every complete frame of the receive buffer to the list of
+            received messages in one pass, using the current read framing.
+            Data of a message being streamed is fed to its decoder instead.
+        """
+        if self._rstream is not None:
+            self._feed_stream()
+        if self._rstream is None:
+            if self._read_framing == 'length':
+                self._split_length()
+            else:
+                self._split_lines()
+            self._start_stream()
+        if self._rstart == self._rend:
+            # Buffer is empty, rewind it (and release it if it grew a lot).
+            self._rstart = self._rend = self._rscan = 0
+            if len(self._rbuf) > 2 * self.read_chunk_size:
+                self._rbuf = bytearray(self.read_chunk_size)
+
+    def _split_lines(self):
+        """
+            Newline framing: splits every complete line. Bytes already 
+            scanned by a previous call are never scanned again.
+        """
+        rbuf = self._rbuf
+        pos = rbuf.find(b'\n', self._rscan, self._rend)
+        if pos == -1:
+            self._rscan = self._rend
+            self._check_frame_size(self._rend - self._rstart)
+            return
+        view = memoryview(rbuf)
+        try:
+            while pos != -1:
+                self._check_frame_size(pos - self._rstart)
+                self._lines.append(view[self._rstart:pos].tobytes())
+                self._rstart = pos + 1
+                pos = rbuf.find(b'\n', self._rstart, self._rend)
+        finally:
+            view.release()
+        self._rscan = self._rend
+        self._check_frame_size(self._rend - self._rstart)
+
+    def _split_length(self):
+        """
+            Length framing: splits every complete frame. The data is never
+            scanned; *_rwant* tells *_recv_into* how many bytes are still 
+            missing to complete the next frame.
+        """
+        rbuf = self._rbuf
+        start, end = self._rstart, self._rend
+        self._rwant = 0
+        view = memoryview(rbuf)
+        try:
+            while end - start >= _FRAME_HEADER.size:
+                header = _FRAME_HEADER.unpack_from(rbuf, start)[0]
+                size = header & _MAX_FRAME_SIZE
+                self._check_frame_size(size + self._fragments_size)
+                begin = start + _FRAME_HEADER.size
+                if end - begin < size:
+                    limit = self._stream_limit()
+                    if limit is None or size < limit:
+                        self._rwant = size - (end - begin)
+                    break
+                data = view[begin:begin + size].tobytes()
+                start = begin + size
+                if header & _FRAGMENT or self._fragments:
+                    # A streamed message (see write_stream): join its parts.
+                    self._fragments.append(data)
+                    self._fragments_size += size
+                    if not header & _FRAGMENT:
+                        self._lines.append(b''.join(self._fragments))
+                        self._fragments = []
+                        self._fragments_size = 0
+                else:
+                    self._lines.append(data)
+        finally:
+            view.release()
+            self._rstart = self._rscan = start
+        
+    def _check_frame_size(self, size):
+        """
+            Raises ValueError if a message of **size** bytes received is 
+            bigger than *max_frame_size*.
+        """
+        if size > self.max_frame_size:
+            raise ValueError("Message of %d bytes is bigger than "
+                             "max_frame_size (%d)" % (size, self.max_frame_size))
+        
+    def _protocol_error(self, exc):
+        """
+            Closes the connection after receiving data that breaks the 
+            protocol (**exc**): the rest of the stream can't be followed.
+        """
+        _log.error("Closing connection: %s", exc)
+        self.close()
+        raise EofError(self._rend - self._rstart)
+        
+    def _stream_limit(self):
+        """
+            Returns the size above which the messages received now are 
+            streamed, or None if they are not.
+        """
+        if self._decompressor is not None or self._read_codec.binary:
+            return None
+        return self.stream_threshold
+        
+    def _start_stream(self):
+        """
+            Starts decoding the incomplete message at the start of the 
+            receive buffer while it is received, if it is big enough (or 
+            sent in fragments). Never while there are messages to dispatch
+            before it, as one of them may change the read options.
+        """
+        limit = self._stream_limit()
+        if limit is None or self._lines:
+            return
+        start, end = self._rstart, self._rend
+        if self._read_framing == 'length':
+            if end - start < _FRAME_HEADER.size:
+                return
+            header = _FRAME_HEADER.unpack_from(self._rbuf, start)[0]
+            size = header & _MAX_FRAME_SIZE
+            if size < limit and not (header & _FRAGMENT or self._fragments):
+                return
+            self._rstart = self._rscan = start + _FRAME_HEADER.size
+            self._rleft = size
+            self._rmore = bool(header & _FRAGMENT)
+        elif end - start >= limit:
+            self._rleft = None
+        else:
+            return
+        self._rstream = StreamDecoder(self.load_object, self._stream_item,
+                                      max_pending = 16 * self.read_chunk_size)
+        self._rsink = None
+        for data in self._fragments:
+            self._rstream.feed(data)
+        self._fragments = []
+        self._feed_stream()
+        
+    def _feed_stream(self):
+        """
+            Feeds the data received of the message being streamed to its 
+            decoder, and queues the decoder when the message is complete.
+        """
+        rbuf = self._rbuf
+        start, end = self._rstart, self._rend
+        view = memoryview(rbuf)
+        try:
+            if self._rleft is None:
+                stop = rbuf.find(b'\n', start, end)
+                done = stop != -1
+                if not done:
+                    stop = end
+                self._fragments_size += stop - start
+                self._check_frame_size(self._fragments_size)
+                self._rstream.feed(view[start:stop])
+                start = stop + done
+            else:
+                while True:
+                    if not self._rleft and self._rmore:
+                        # Header of the next fragment.
+                        if end - start < _FRAME_HEADER.size:
+                            break
+                        header = _FRAME_HEADER.unpack_from(rbuf, start)[0]
+                        start += _FRAME_HEADER.size
+                        self._rleft = header & _MAX_FRAME_SIZE
+                        self._rmore = bool(header & _FRAGMENT)
+                        self._check_frame_size(self._fragments_size + 
+                                               self._rleft)
+                    stop = min(end, start + self._rleft)
+                    self._rleft -= stop - start
+                    self._fragments_size += stop - start
+                    self._rstream.feed(view[start:stop])
+                    start = stop
+                    if not self._rleft and not self._rmore or start == end:
+                        break
+                done = not self._rleft and not self._rmore
+        finally:
+            view.release()
+        self._rstart = self._rscan = start
+        if done:
+            self._fragments_size = 0
+            # Decode what is left now, while the item hook can still route 
+            # the last elements. An error is raised again by close() when 
+            # the message is dispatched.
+            try:
+                self._rstream.close()
+            except ValueError:
+                pass
+            self._lines.append(self._rstream)
+            self._rstream = self._rsink = None
+        
+    def _fail_stream(self, decoder, exc):
+        """
+            Answers a message decoded while it was received that turned out
+            to be invalid, if its id was decoded: the request waiting for it
+            gets the error, or the peer if it was a call.
+        """
+        root = decoder.root
+        if type(root) is not dict or root.get('id') is None:
+            return
+        error = "ValueError: Invalid message: %s" % exc
+        if 'method' in root:
+            self._send_error(root, error)
+        elif root['id'] in self._requests:
+            self.dispatch_item_single({ 'id' : root['id'], 'result' : None,
+                                        'error' : error })
+        
+    def _stream_item(self, path, value):
+        """
+            Item hook of the *StreamDecoder*: hands the elements of a result
+            being streamed to its request, if it was made with the *stream*
+            proxy. Returns True if it took the element.
+        """
+        if path != ('result',):
+            return False
+        if self._rsink is None:
+            # Decided on the first element: it needs the id before the result.
+            root = self._rstream.root
+            request = self._requests.get(root.get('id'))
+            if request is None or not request.streaming:
+                request = False
+            self._rsink = request
+        if self._rsink is False:
+            return False
+        self._rsink.putitem(value)
+        self._rdelivered = True
+        return True
+
+    def _set_read_framing(self, framing):
+        """
+            Changes the framing used to split the received data. Messages 
+            that were already split with the old framing after the current
+            one are put back in the buffer and split again.
+        """
+        if framing == self._read_framing: return
+        pending = []
+        for data in self._lines:
+            if self._read_framing == 'length':
+                pending.append(_FRAME_HEADER.pack(len(data)))
+                pending.append(data)
+            else:
+                pending.append(data)
+                pending.append(b'\n')
+        self._lines.clear()
+        pending.append(self._rbuf[self._rstart:self._rend])
+        self._rbuf = bytearray(b''.join(pending))
+        self._rstart = self._rscan = self._rwant = 0
+        self._rend = len(self._rbuf)
+        self._read_framing = framing
+        try:
+            self._split_frames()
+        except ValueError as exc:
+            self._rerror = exc
+
+    def _set_write_framing(self, framing):
+        """
+            Changes the framing used for the messages written from now on.
+        """
+        self._write_framing = framing
+        
+    def set_codec(self, name):
+        """
+            Selects the codec used to encode and decode the messages of this
+            connection by its name (see *bjsonrpc.jsonlib.get_codec*). It 
+            defaults to *bjsonrpc_options['codec']*.
+            
+            Codecs of the same wire format (e.g. 'json' and 'orjson') can
+            talk to each other, so this can be changed at any time without
+            telling the other end. Other formats must be negotiated 
+            (*negotiate(codec=...)* or *connect(..., codec=...)*).
+        """
+        self._write_codec = self._read_codec = json.get_codec(name)
+        
+    @property
+    def codec(self):
+        """
+            Name of the codec used to encode the messages sent.
+        """
+        return self._write_codec.name
+        
+    def _set_read_codec(self, wire_format):
+        """
+            Decodes the messages read from now on as *wire_format*.
+        """
+        if self._read_codec.format != wire_format:
+            self._read_codec = json.default_codec(wire_format)
+        
+    def _set_write_codec(self, wire_format):
+        """
+            Encodes the messages written from now on as *wire_format*.
+        """
+        if self._write_codec.format != wire_format:
+            self._write_codec = json.default_codec(wire_format)
+        
+    def _set_read_compression(self, name):
+        """
+            Decompresses the messages read from now on with the method
+            *name* of *bjsonrpc.compression.compressors* ('none' to stop).
+        """
+        if name == 'none':
+            self._decompressor = None
+        else:
+            self._decompressor = compressors[name][1](
+                self.compression_max_size)
+        
+    def _set_write_compression(self, name):
+        """
+            Compresses the messages written from now on with the method
+            *name*, in a new stream ('none' to stop).
+        """
+        if name == 'none':
+            self._compressor = None
+        else:
+            self._compressor = compressors[name][0](
+                self.compression_threshold, self.compression_level)
+            
+    @property
+    def compression_stats(self):
+        """
+            Counters of the compression of the messages written, as a 
+            dictionary with the keys 'messages', 'compressed', 'raw_bytes',
+            'wire_bytes' and 'ratio' (raw_bytes / wire_bytes). None if the
+            connection doesn't compress.
+        """
+        compressor = self._compressor
+        if compressor is None:
+            return None
+        return {
+            'messages' : compressor.messages,
+            'compressed' : compressor.compressed,
+            'raw_bytes' : compressor.raw_bytes,
+            'wire_bytes' : compressor.wire_bytes,
+            'ratio' : compressor.ratio,
+        }
         
     def serve(self):
         """
@@ -39,6 +39,14 @@ class ServerError(Exception):
     """
     pass
 
+class ServerBusyError(ServerError):
+    """
+        Raised by *bjsonrpc.workers.WorkerPool.submit* when the queue of the
+        pool is full and its overflow policy is 'reject'. The call that 
+        could not be queued gets it as its error.
+    """
+    pass
+
 class EofError(Exception):
     """
         End-of-file error raised whenever the socket reaches the 
@@ -31,9 +31,14 @@
     POSSIBILITY OF SUCH DAMAGE.
 
 """
+import functools
+import inspect
 import re
 from types import MethodType
 from bjsonrpc.exceptions import  ServerError
+from bjsonrpc.table import Table
+from bjsonrpc.streaming import ResultStream
+from bjsonrpc.workers import register_process_function, ConcurrencyLimit
 
 class BaseHandler(object):
     """
@@ -63,6 +68,22 @@ class BaseHandler(object):
             if they are in the format required by the RegEx). Defaults to
             ["close","_factory","add_method","get_method"]
             
+        **execution**
+            How the calls to the methods of this object are run:
+            
+            - None (default): as the connection says, in the thread that
+              reads or, with *bjsonrpc_options['threaded']*, in the worker
+              pool (see *bjsonrpc.workers.WorkerPool*).
+            - 'inline': always in the thread that reads, in order.
+            - 'concurrent': always in the worker pool, in parallel.
+            - 'ordered': in the worker pool, but one at a time and in the 
+              order they were received, for objects whose methods expect 
+              that (e.g. appending to a list). Calls to other objects still
+              run in parallel.
+              
+            Methods can override it with the *inline* and *max_concurrency*
+            decorators.
+            
     """
     
     public_methods_pattern = r'^[a-z]\w+$'
@@ -76,6 +97,8 @@ class BaseHandler(object):
         ] 
     # List of method names that never should be published    
     
+    execution = None
+    
     @classmethod
     def _factory(cls, *args, **kwargs):
         """
@@ -105,6 +128,8 @@ class BaseHandler(object):
         if hasattr(self._conn,"_conn"): 
             self._conn = self._conn._conn
             
+        if self.execution == 'ordered':
+            self._ordered_limit = ConcurrencyLimit(1)
         self._methods = {}
         for mname in dir(self):
             if re.match(self.public_methods_pattern, mname):
@@ -178,3 +203,117 @@ class NullHandler(BaseHandler):
     """
     pass
 
+
+def columnar(function):
+    """
+        Decorator for handler methods that return lists of records with the 
+        same keys. The result is sent as a *bjsonrpc.table.Table* (a 
+        *__table__* hint with one list per field) when it is a list of such
+        dictionaries, and as usual otherwise. For generator methods, each
+        yielded value is converted.
+        
+            class MyHandler(bjsonrpc.handlers.BaseHandler):
+                @bjsonrpc.handlers.columnar
+                def search(self, text):
+                    return [ {"id": 1, "name": text}, ... ]
+    """
+    def convert(result):
+        if type(result) is list:
+            table = Table.from_rows(result)
+            if table is not None:
+                return table
+        return result
+        
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            for result in function(*args, **kwargs):
+                yield convert(result)
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return convert(function(*args, **kwargs))
+    return wrapper
+
+
+def streamed(function):
+    """
+        Decorator for handler methods that return large iterables, or are
+        generators of a large number of values. The values are sent as one
+        list, encoded and written while they are produced (see 
+        *bjsonrpc.streaming.ResultStream*), instead of one response per 
+        value as with plain generator methods.
+        
+            class MyHandler(bjsonrpc.handlers.BaseHandler):
+                @bjsonrpc.handlers.streamed
+                def export(self):
+                    for row in database.query("select * from data"):
+                        yield row
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return ResultStream(function(*args, **kwargs))
+    return wrapper
+
+
+def run_in_process(function):
+    """
+        Decorator for CPU-bound handler methods. They are run in the shared 
+        process pool (see *bjsonrpc.workers.process_pool*), so they use the
+        other cores instead of waiting for the GIL, and the connection goes
+        on reading and dispatching other calls meanwhile. The response is 
+        sent when the method finishes.
+        
+        Only for pure functions: the handler, its connection and any other
+        state of this process are not available in the pool. So the method
+        is defined without *self*, like a static method, and only gets the
+        parameters of the call. They, its return value and the exceptions 
+        it raises must be picklable, and its class must be defined at the 
+        top level of an importable module (not the script run as 
+        *__main__*), as the processes of the pool import it by name.
+        
+            class MyHandler(bjsonrpc.handlers.BaseHandler):
+                @bjsonrpc.handlers.run_in_process
+                def score(features):
+                    return model.score(features)
+    """
+    register_process_function(function)
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        return function(*args, **kwargs)
+    wrapper._run_in_process = function
+    return wrapper
+
+
+def inline(function):
+    """
+        Decorator for cheap handler methods: they are always run right away
+        in the thread that reads the connection, without going through the
+        worker pool, whatever the *execution* policy of the handler is (so 
+        they don't wait for the calls queued on an 'ordered' object).
+        
+            class MyHandler(bjsonrpc.handlers.BaseHandler):
+                @bjsonrpc.handlers.inline
+                def version(self):
+                    return "1.0"
+    """
+    function._execution = 'inline'
+    return function
+
+
+def max_concurrency(limit):
+    """
+        Decorator for handler methods that must not run more than **limit**
+        times at once (e.g. to protect a database), counting the calls from
+        every connection of this process. They are run in the worker pool; 
+        the calls over the limit wait, in order, without taking a thread.
+        
+            class MyHandler(bjsonrpc.handlers.BaseHandler):
+                @bjsonrpc.handlers.max_concurrency(4)
+                def report(self, month):
+                    return database.query(...)
+    """
+    def decorator(function):
+        function._concurrency_limit = ConcurrencyLimit(limit)
+        return function
+    return decorator
@@ -0,0 +1,243 @@
+"""
+    bjson/ioloop.py
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+from collections import deque
+import logging
+import threading
+import traceback
+
+from bjsonrpc.pollers import READ, WRITE, Waker, default_poller
+
+__all__ = [
+    "IOLoop",
+]
+
+_log = logging.getLogger(__name__)
+
+
+class IOLoop(object):
+    """
+        Single-threaded event loop that watches a set of sockets with a poller
+        (see *bjsonrpc.pollers*). It is used by *bjsonrpc.server.Server* to
+        dispatch incoming data and, when *bjsonrpc_options['write_mode']* is
+        'ioloop', to send the pending output of its connections whenever
+        their sockets become writable.
+
+        All the public methods are thread-safe. While a thread runs the loop
+        (see *run*, *start* and *attach*), changes requested from other
+        threads are queued and the loop is woken up to apply them.
+
+        Parameters:
+
+        **poller_factory** = None
+            Callable that returns a new poller. Defaults to
+            *bjsonrpc.pollers.default_poller*.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, poller_factory=None):
+        if poller_factory is None:
+            poller_factory = default_poller
+        self._poller = poller_factory()
+        self._waker = Waker()
+        self._poller.register(self._waker.socket, READ)
+        self._readers = {}
+        self._writers = {}
+        self._events = {}
+        self._pending = deque()
+        self._thread_ident = None
+        self._running = False
+        self._stopped = False
+
+    @classmethod
+    def instance(cls):
+        """
+            Returns the IOLoop shared by all the client connections of this
+            process, creating it (and its daemon thread) on first use.
+        """
+        cls._instance_lock.acquire()
+        try:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+            return cls._instance
+        finally:
+            cls._instance_lock.release()
+
+    def start(self):
+        """
+            Runs the loop in a new daemon thread.
+        """
+        # Until the thread runs, other threads must queue their changes.
+        self._running = True
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        """
+            Runs the loop in the calling thread until *stop* is called.
+        """
+        self._stopped = False
+        self.attach()
+        try:
+            while not self._stopped:
+                try:
+                    self.run_once(None)
+                except Exception:
+                    _log.error("Unhandled error in IOLoop: %s",
+                               traceback.format_exc())
+                    self.prune()
+        finally:
+            self._running = False
+            self._thread_ident = None
+            self._run_pending()
+
+    def attach(self):
+        """
+            Makes the calling thread the one that runs the loop, so the
+            changes requested from other threads are queued for it. *run*
+            does it; call it before running the loop with *run_once*.
+        """
+        self._thread_ident = threading.current_thread().ident
+        self._running = True
+
+    def stop(self):
+        """
+            Tells the loop started with *run* or *start* to exit.
+        """
+        self._stopped = True
+        self.wake()
+
+    def wake(self):
+        """
+            Interrupts the current (or next) poll of the loop.
+        """
+        self._waker.wake()
+
+    def close(self):
+        """
+            Releases the poller and the internal wake-up socket.
+        """
+        self._poller.close()
+        self._waker.close()
+
+    def run_once(self, timeout=None):
+        """
+            Waits at most **timeout** seconds for events and processes them.
+            Read events call the callback given to *add_reader*, write events
+            call *flush()* on the connection given to *want_write*.
+        """
+        self._run_pending()
+        for sck, events in self._poller.poll(timeout):
+            if sck is self._waker.socket:
+                self._waker.drain()
+                continue
+            if events & WRITE:
+                conn = self._writers.get(sck)
+                if conn is not None and not conn.flush():
+                    del self._writers[sck]
+                    self._update(sck)
+            if events & READ:
+                callback = self._readers.get(sck)
+                if callback is not None:
+                    callback()
+        self._run_pending()
+
+    def add_reader(self, sck, callback):
+        """
+            Calls **callback** (without arguments) from the loop each time
+            **sck** has data available to read.
+        """
+        self._call(self._add_reader, sck, callback)
+
+    def want_write(self, conn):
+        """
+            Asks the loop to call *conn.flush()* when the connection socket
+            becomes writable. The loop keeps calling it until *flush* returns
+            0 (nothing left in the output buffer).
+        """
+        self._call(self._want_write, conn)
+
+    def remove(self, sck):
+        """
+            Stops watching **sck** for any event.
+        """
+        self._call(self._remove, sck)
+
+    def prune(self):
+        """
+            Forgets the sockets that were closed without calling *remove*.
+        """
+        for sck in list(self._events):
+            try:
+                if sck.fileno() != -1:
+                    continue
+            except Exception:
+                pass
+            self._remove(sck)
+
+    def _call(self, function, *args):
+        """
+            Runs **function** now if we are in the loop thread (or no thread
+            runs the loop), otherwise queues it and wakes up the loop.
+        """
+        if (self._running and
+                self._thread_ident != threading.current_thread().ident):
+            self._pending.append((function, args))
+            self._waker.wake()
+        else:
+            function(*args)
+
+    def _run_pending(self):
+        while self._pending:
+            function, args = self._pending.popleft()
+            function(*args)
+
+    def _add_reader(self, sck, callback):
+        self._readers[sck] = callback
+        self._update(sck)
+
+    def _want_write(self, conn):
+        sck = conn.socket
+        if sck in self._writers:
+            return
+        self._writers[sck] = conn
+        self._update(sck)
+
+    def _remove(self, sck):
+        self._readers.pop(sck, None)
+        self._writers.pop(sck, None)
+        self._update(sck)
+
+    def _update(self, sck):
+        """
+            Syncs the poller registration of **sck** with our tables.
+        """
+        events = 0
+        if sck in self._readers:
+            events |= READ
+        if sck in self._writers:
+            events |= WRITE
+        oldevents = self._events.get(sck, 0)
+        if events == oldevents:
+            return
+        if not events:
+            del self._events[sck]
+            self._poller.unregister(sck)
+        elif not oldevents:
+            self._events[sck] = events
+            self._poller.register(sck, events)
+        else:
+            self._events[sck] = events
+            self._poller.modify(sck, events)
@@ -39,16 +39,435 @@ except ImportError:
     print("FATAL: No suitable json library found!")
     raise
 from pprint import pprint
+import base64
+import datetime
+import decimal
+import re
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+from bjsonrpc import bjsonrpc_options
+
+__all__ = [
+    "dumps",
+    "loads",
+    "Codec",
+    "codecs",
+    "register_codec",
+    "get_codec",
+    "default_codec",
+    "register_type",
+]
+
+codecs = {}
+"""Registered codecs by name. See *register_codec*."""
+
+preference = ['orjson', 'msgspec', 'ujson', 'json']
+"""Codec names from fastest to slowest, used to pick the 'auto' codec."""
+
+
+def register_codec(codec):
+    """
+        Makes the *Codec* instance **codec** available under *codec.name*.
+    """
+    codecs[codec.name] = codec
+    return codec
+
+def get_codec(name = None):
+    """
+        Returns the registered codec called **name**. 'auto' returns the
+        fastest one installed, and None the one set in 
+        *bjsonrpc_options['codec']*.
+    """
+    if name is None:
+        name = bjsonrpc_options['codec']
+    if name == 'auto':
+        return _fastest('json')
+    try:
+        return codecs[name]
+    except KeyError:
+        raise ValueError("Unknown codec %r (available: %s)" 
+                         % (name, ", ".join(sorted(codecs))))
+
+def default_codec(wire_format):
+    """
+        Returns the codec to use for the **wire_format** ('json'): the one
+        set in *bjsonrpc_options['codec']* if it produces that format, or
+        the fastest one installed.
+    """
+    codec = codecs.get(bjsonrpc_options['codec'])
+    if codec is not None and codec.format == wire_format:
+        return codec
+    return _fastest(wire_format)
+
+def _fastest(wire_format):
+    """
+        Returns the fastest codec installed for the **wire_format**.
+    """
+    for name in preference:
+        codec = codecs.get(name)
+        if codec is not None and codec.format == wire_format:
+            return codec
+    for codec in codecs.values():
+        if codec.format == wire_format:
+            return codec
+    raise ValueError("No codec available for %r" % wire_format)
+
+_types = {} # class -> (hint, encode)
+_hints = {} # hint -> decode
+_reserved_hints = ('__remoteobject__', '__objectreference__', 
+                   '__functionreference__', '__promise__')
+
+def hint_key(hint_name):
+    """
+        Returns the key used in the messages for **hint_name**: 'datetime'
+        and '__datetime__' are both sent as '__datetime__'.
+    """
+    if not (hint_name.startswith('__') and hint_name.endswith('__')):
+        hint_name = '__%s__' % hint_name
+    if hint_name in _reserved_hints:
+        raise ValueError("Hint %r is reserved" % hint_name)
+    return hint_name
+
+def register_type(cls, hint_name, encode, decode):
+    """
+        Sends the instances of **cls** (and its subclasses) as hinted 
+        objects {"__<hint_name>__": encode(obj)}, and converts the hinted
+        objects received back with decode(value). **encode** must return
+        something the codec can serialize (it may contain other hinted
+        types). 
+        
+        **cls** may also be the dotted name of the class (e.g. 
+        'numpy.ndarray'), so optional packages don't have to be imported
+        to register their types.
+        
+        Applies to the connections created after the call. To register a
+        type in one connection only, use *Connection.register_type*.
+        
+        These are registered by default: *datetime.datetime*, *date*,
+        *time*, *timedelta*, *uuid.UUID*, *decimal.Decimal*, *set*, 
+        *frozenset*, *bytes* and *bytearray*, and *numpy.ndarray* (see
+        *_encode_ndarray*) when NumPy is installed. Note that some codecs encode
+        a few of them natively (e.g. msgpack sends bytes as binary), and 
+        then they are not hinted.
+    """
+    hint = hint_key(hint_name)
+    _types[cls] = (hint, encode)
+    _hints[hint] = decode
+
+def find_type(cls, types = None):
+    """
+        Returns the (hint, encode) registered for **cls** or its closest 
+        base class in the dictionary **types** (by default, the types 
+        registered with *register_type*). None if there is none.
+    """
+    if types is None:
+        types = _types
+    for base in cls.__mro__:
+        name = "%s.%s" % (base.__module__, base.__qualname__)
+        for key in (base, name):
+            if key in types:
+                return types[key]
+    return None
+
+def registered_types():
+    """
+        Returns a copy of the {class: (hint, encode)} registered.
+    """
+    return dict(_types)
+
+def type_hints():
+    """
+        Returns a copy of the {hint: decode} registered.
+    """
+    return dict(_hints)
+
+def _decode_timedelta(value):
+    return datetime.timedelta(*value)
+
+def _encode_bytes(value):
+    return base64.b64encode(value).decode('ascii')
+
+register_type(datetime.datetime, 'datetime', 
+              datetime.datetime.isoformat, datetime.datetime.fromisoformat)
+register_type(datetime.date, 'date', 
+              datetime.date.isoformat, datetime.date.fromisoformat)
+register_type(datetime.time, 'time', 
+              datetime.time.isoformat, datetime.time.fromisoformat)
+register_type(datetime.timedelta, 'timedelta', 
+              lambda value: [ value.days, value.seconds, value.microseconds ],
+              _decode_timedelta)
+register_type(uuid.UUID, 'uuid', str, uuid.UUID)
+register_type(decimal.Decimal, 'decimal', str, decimal.Decimal)
+register_type(set, 'set', list, set)
+register_type(frozenset, 'frozenset', list, frozenset)
+register_type(bytes, 'bytes', _encode_bytes, base64.b64decode)
+register_type(bytearray, 'bytearray', bytes, bytearray)
+
+def _encode_ndarray(value):
+    """
+        Sends a NumPy array as its dtype, shape and raw buffer. The buffer 
+        is *bytes*, so it goes as base64 in JSON and as binary in msgpack.
+        The dtype is described as in .npy files (*dtype_to_descr*): a string
+        like '<f8', or a list of fields for structured arrays. Arrays of 
+        Python objects are sent as a flat list.
+    """
+    from numpy.lib.format import dtype_to_descr
+    if value.dtype.hasobject:
+        return { 'dtype' : 'object', 'shape' : list(value.shape), 
+                 'data' : value.ravel().tolist() }
+    return { 'dtype' : dtype_to_descr(value.dtype), 
+             'shape' : list(value.shape), 'data' : value.tobytes() }
+
+def _decode_ndarray(value):
+    """
+        Rebuilds the array with *numpy.frombuffer*, without copying or
+        touching each element. The result shares the message buffer, so it
+        is read-only: use *copy()* to modify it.
+    """
+    import numpy
+    from numpy.lib.format import descr_to_dtype
+    data = value['data']
+    if value['dtype'] == 'object':
+        array = numpy.empty(len(data), dtype=object)
+        for index, item in enumerate(data):
+            array[index] = item
+        return array.reshape(value['shape'])
+    dtype = descr_to_dtype(value['dtype'])
+    if not len(data):
+        return numpy.empty(value['shape'], dtype=dtype)
+    return numpy.frombuffer(data, dtype=dtype).reshape(value['shape'])
+
+register_type('numpy.ndarray', 'ndarray', _encode_ndarray, _decode_ndarray)
+
+def _apply_object_hook(obj, hook):
+    """
+        Calls **hook** for every dictionary inside **obj**, innermost first,
+        and replaces it with the result; the same as the *object_hook* of 
+        *json.loads* for decoders that don't support it.
+    """
+    if type(obj) is dict:
+        for key, value in obj.items():
+            if type(value) is dict or type(value) is list:
+                obj[key] = _apply_object_hook(value, hook)
+        return hook(obj)
+    if type(obj) is list:
+        for index, value in enumerate(obj):
+            if type(value) is dict or type(value) is list:
+                obj[index] = _apply_object_hook(value, hook)
+    return obj
+
+_scalars = frozenset([str, int, float, bool, type(None)])
+
+def _hint_native(obj, native, dump_object):
+    """
+        Returns **obj** with the instances of the **native** types inside 
+        it replaced by their class hints (*dump_object*), for encoders that
+        would encode those types their own way. Lists and dictionaries 
+        without any are returned as they are, not copied.
+    """
+    cls = type(obj)
+    if cls is dict:
+        hinted = None
+        for key, value in obj.items():
+            if type(value) in _scalars:
+                continue
+            new = _hint_native(value, native, dump_object)
+            if new is not value:
+                if hinted is None:
+                    hinted = dict(obj)
+                hinted[key] = new
+        return obj if hinted is None else hinted
+    if cls is list or cls is tuple:
+        hinted = None
+        for index, value in enumerate(obj):
+            if type(value) in _scalars:
+                continue
+            new = _hint_native(value, native, dump_object)
+            if new is not value:
+                if hinted is None:
+                    hinted = list(obj)
+                hinted[index] = new
+        return obj if hinted is None else hinted
+    if cls in _scalars:
+        return obj
+    if isinstance(obj, native):
+        return _hint_native(dump_object(obj), native, dump_object)
+    return obj
+
+def _has_hints(data):
+    """
+        True if the message **data** may contain class hints. All the hint
+        keys start with '__', so messages without '"__' are never walked.
+    """
+    if isinstance(data, str):
+        return '"__' in data
+    return b'"__' in data
+
+
+class Codec(object):
+    """
+        Encodes and decodes messages for a *Connection*. Codecs must honour
+        the class hinting hooks of the connection: objects that the encoder
+        doesn't know are passed to *conn.dump_object*, and every decoded 
+        dictionary is passed to *conn.load_object*.
+        
+        **name**
+            Name used to select it (see *get_codec*).
+            
+        **format**
+            Wire format produced. Codecs with the same format are 
+            interchangeable, so each end can use its fastest one.
+            
+        **binary**
+            True if the messages are binary (*bytes*) rather than text. 
+            Binary formats need length framing.
+    """
+    name = None
+    format = 'json'
+    binary = False
+    
+    def dumps(self, obj, conn):
+        """ Returns the message for **obj**, as *str* or *bytes*. """
+        raise NotImplementedError
+        
+    def loads(self, data, conn):
+        """ Returns the object for the message **data** """
+        raise NotImplementedError
+
+
+class StdlibCodec(Codec):
+    """
+        *simplejson* if installed, otherwise the standard *json* module.
+    """
+    name = 'json'
+    
+    def dumps(self, obj, conn):
+        return j.dumps(obj, separators = (',', ':'), default=conn.dump_object)
+        
+    def loads(self, data, conn):
+        return j.loads(data, object_hook=conn.load_object)
+        
+        
+class OrjsonCodec(Codec):
+    """
+        *orjson*. Types it knows natively but the standard module doesn't 
+        (datetime, dataclasses...) are still passed to *dump_object*. The
+        standard module is used instead for the messages orjson would 
+        change: those it can't encode (integers over 64 bits), those where
+        it may have encoded a UUID as a plain string (it has no option to
+        pass them to *dump_object*), and those with integers it would 
+        decode as floats (20 digits or more).
+    """
+    name = 'orjson'
+    
+    _uuid_text = re.compile(br'"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                            br'[0-9a-f]{4}-[0-9a-f]{12}"')
+    _long_int = (re.compile(r'\d{20}'), re.compile(br'\d{20}'))
+    
+    def __init__(self):
+        self._options = (orjson.OPT_NON_STR_KEYS
+                         | orjson.OPT_PASSTHROUGH_DATETIME
+                         | orjson.OPT_PASSTHROUGH_DATACLASS
+                         | orjson.OPT_PASSTHROUGH_SUBCLASS)
+    
+    def dumps(self, obj, conn):
+        try:
+            data = orjson.dumps(obj, default=conn.dump_object, 
+                                option=self._options)
+        except orjson.JSONEncodeError:
+            return StdlibCodec.dumps(self, obj, conn)
+        if self._uuid_text.search(data):
+            return StdlibCodec.dumps(self, obj, conn)
+        return data
+            
+    def loads(self, data, conn):
+        if self._long_int[not isinstance(data, str)].search(data):
+            return StdlibCodec.loads(self, data, conn)
+        obj = orjson.loads(data)
+        if _has_hints(data):
+            obj = _apply_object_hook(obj, conn.load_object)
+        return obj
+        
+        
+class UjsonCodec(Codec):
+    """
+        *ujson* (5.0 or newer, for the *default* argument). It encodes
+        *decimal.Decimal* as a float, so they are replaced by their class 
+        hint before (see *_hint_native*).
+    """
+    name = 'ujson'
+    native = (decimal.Decimal,)
+    
+    def dumps(self, obj, conn):
+        native, dump_object = self.native, conn.dump_object
+        default = lambda value: _hint_native(dump_object(value), native, 
+                                             dump_object)
+        return ujson.dumps(_hint_native(obj, native, dump_object), 
+                           default=default, escape_forward_slashes=False)
+            
+    def loads(self, data, conn):
+        obj = ujson.loads(data)
+        if _has_hints(data):
+            obj = _apply_object_hook(obj, conn.load_object)
+        return obj
+        
+        
+class MsgspecCodec(Codec):
+    """
+        *msgspec.json*, without schemas. It encodes dates, times, UUIDs, 
+        decimals, sets and bytes natively (as strings or lists), so they are
+        replaced by their class hints before (see *_hint_native*).
+    """
+    name = 'msgspec'
+    native = (datetime.datetime, datetime.date, datetime.time, 
+              datetime.timedelta, uuid.UUID, decimal.Decimal, set, 
+              frozenset, bytes, bytearray)
+    
+    def dumps(self, obj, conn):
+        native, dump_object = self.native, conn.dump_object
+        enc_hook = lambda value: _hint_native(dump_object(value), native, 
+                                              dump_object)
+        return msgspec.json.encode(_hint_native(obj, native, dump_object), 
+                                   enc_hook=enc_hook)
+            
+    def loads(self, data, conn):
+        obj = msgspec.json.decode(data)
+        if _has_hints(data):
+            obj = _apply_object_hook(obj, conn.load_object)
+        return obj
+        
+        
+register_codec(StdlibCodec())
+if orjson is not None:
+    register_codec(OrjsonCodec())
+if ujson is not None and hasattr(ujson, "__version__") and \
+        int(ujson.__version__.split(".")[0]) >= 5:
+    register_codec(UjsonCodec())
+if msgspec is not None:
+    register_codec(MsgspecCodec())
 
 
 def dumps(argobj, conn):
     """
-        dumps json object using loaded json library and forwards unknown objects
-        to *Connection.dumpObject* function.
+        dumps json object using the codec of the connection (see *Codec*) and
+        forwards unknown objects to *Connection.dump_object* function.
     """
     ret = None
     try:
-        ret = j.dumps(argobj, separators = (',', ':'), default=conn.dump_object)
+        ret = conn._write_codec.dumps(argobj, conn)
     except TypeError:
         pprint(argobj)
         raise
@@ -62,7 +481,7 @@ def loads(argobj, conn):
     """
     ret = None
     try:
-        ret = j.loads(argobj, object_hook=conn.load_object)
+        ret = conn._read_codec.loads(argobj, conn)
     except ValueError:
         pprint(argobj)
         raise
@@ -9,19 +9,26 @@
 
 """
 
+import os
 import socket
+import stat
 
 import bjsonrpc.server
 import bjsonrpc.connection
 import bjsonrpc.handlers
+import bjsonrpc.ioloop
+import bjsonrpc.jsonlib
+from bjsonrpc import bjsonrpc_options
 
 __all__ = [
     "createserver",
     "connect",
+    "socketpair",
 ]
 
 def createserver(host="127.0.0.1", port=10123, 
-    handler_factory=bjsonrpc.handlers.NullHandler):
+    handler_factory=bjsonrpc.handlers.NullHandler, path=None, workers=None,
+    reuseport=None, worker_pool=None, max_frame_size=None):
     """
         Creates a *bjson.server.Server* object linked to a listening socket.
         
@@ -39,6 +46,33 @@ def createserver(host="127.0.0.1", port=10123,
         **handler_factory**
           Class to instantiate to publish remote functions.
         
+        **path**
+          Listen on a Unix domain socket at this path instead of TCP (*host*
+          and *port* are ignored). A stale socket file left at that path is
+          removed first. On Linux, a path starting with a null byte 
+          ("\\0name") is bound in the abstract namespace and leaves no 
+          file behind.
+          
+        **workers**
+          If given, returns a *bjson.server.PreforkServer* that forks this
+          number of processes, each one running its own server loop, so the
+          handlers can use several cores. Unix only.
+          
+        **reuseport**
+          With **workers**, give each worker its own listening socket bound
+          to the same port with SO_REUSEPORT, so the kernel balances the 
+          connections between them. Otherwise all the workers accept on a 
+          shared socket. Defaults to True for TCP where SO_REUSEPORT exists.
+        
+        **worker_pool**
+          *bjsonrpc.workers.WorkerPool* that runs the incoming calls in 
+          threaded mode (see *bjsonrpc.server.Server*). With **workers**, 
+          each process gets its own threads.
+        
+        **max_frame_size**
+          The most bytes a message received may have; bigger ones close the
+          connection (see *bjsonrpc.server.Server*).
+        
         **(return value)**
           A *bjson.server.Server* instance or raises an exception.
         
@@ -51,16 +85,51 @@ def createserver(host="127.0.0.1", port=10123,
             
         Check :ref:`bjsonrpc.server` documentation
     """
+    if path is not None:
+        sck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _remove_stale_socket(path)
+        sck.bind(path)
+        reuseport = False
+    else:
+        if reuseport is None:
+            reuseport = bool(workers) and hasattr(socket, "SO_REUSEPORT")
+        sck = _tcp_socket(host, port, reuseport)
+    if not workers:
+        sck.listen(3) 
+        return bjsonrpc.server.Server(sck, handler_factory=handler_factory,
+                                      worker_pool=worker_pool, 
+                                      max_frame_size=max_frame_size)
+    if reuseport:
+        # The parent only holds the port (port 0 is resolved here), and 
+        # every worker listens on its own socket.
+        port = sck.getsockname()[1]
+        def listen_reuseport():
+            wsck = _tcp_socket(host, port, True)
+            wsck.listen(3)
+            return wsck
+        socket_factory = listen_reuseport
+    else:
+        sck.listen(3)
+        socket_factory = None
+    return bjsonrpc.server.PreforkServer(sck, handler_factory=handler_factory,
+        workers=workers, socket_factory=socket_factory, 
+        worker_pool=worker_pool, max_frame_size=max_frame_size)
+    
+def _tcp_socket(host, port, reuseport=False):
+    """
+        Returns a new TCP socket bound to (**host**, **port**).
+    """
     sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sck.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
+    if reuseport:
+        sck.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sck.bind((host, port))
-    sck.listen(3) 
-    return bjsonrpc.server.Server(sck, handler_factory=handler_factory)
+    return sck
         
         
 def connect(host="127.0.0.1", port=10123, 
-    handler_factory=bjsonrpc.handlers.NullHandler):
+    handler_factory=bjsonrpc.handlers.NullHandler, path=None, framing=None,
+    compression=None, codec=None, reader=False):
     """
         Creates a *bjson.connection.Connection* object linked to a connected
         socket.
@@ -78,6 +147,30 @@ def connect(host="127.0.0.1", port=10123,
           By default this is *NullHandler* which means that no functions are
           executable by the server.
         
+        **path**
+          Connect to the Unix domain socket at this path instead of TCP 
+          (see *createserver*).
+        
+        **framing**
+          If given ('length' or 'newline', or a list of them in order of
+          preference), the framing of the messages is negotiated with the 
+          server before returning. Servers that don't support it keep the
+          default newline framing.
+          
+        **compression**
+          If given ('deflate'), compression of the messages is negotiated 
+          too (it implies length framing). See *bjsonrpc.compression*.
+          
+        **codec**
+          Name of the codec for this connection (see 
+          *bjsonrpc.jsonlib.codecs*). Defaults to *bjsonrpc_options['codec']*.
+          Codecs of a wire format other than JSON are negotiated.
+        
+        **reader**
+          If True, the connection is read in the background (see 
+          *Connection.start_reader*), for clients whose calls are made 
+          from many threads at once.
+        
         **(return value)**
           A *bjson.connection.Connection* instance or raises an exception.
         
@@ -88,11 +181,93 @@ def connect(host="127.0.0.1", port=10123,
             conn = bjsonrpc.connect("rpc.host.net")
             print conn.call.some_method_in_server_side()
     """
-    sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sck.connect((host, port))
-    return bjsonrpc.connection.Connection(sck, 
-        handler_factory=handler_factory)
+    if path is not None:
+        sck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sck.connect(path)
+    else:
+        sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sck.connect((host, port))
+    conn = _wrap(sck, handler_factory)
+    options = {}
+    if codec is not None:
+        codec = bjsonrpc.jsonlib.get_codec(codec)
+        if codec.format == 'json':
+            conn.set_codec(codec.name)
+        else:
+            options['codec'] = codec.format
+    if framing is not None:
+        options['framing'] = framing
+    if compression is not None:
+        options['compression'] = compression
+    if options:
+        chosen = conn.negotiate(**options)
+        if codec is not None and chosen.get('codec') == codec.format:
+            conn.set_codec(codec.name)
+    if reader:
+        conn.start_reader()
+    return conn
+        
+
+def socketpair(handler_factory=bjsonrpc.handlers.NullHandler,
+    peer_handler_factory=None):
+    """
+        Creates two *bjson.connection.Connection* objects connected to each 
+        other through *socket.socketpair* (a Unix domain socket pair on Unix).
+        
+        Parameters:
+        
+        **handler_factory**
+          Class to instantiate to publish remote functions in the first 
+          connection.
+          
+        **peer_handler_factory**
+          The same for the second connection. Defaults to *handler_factory*.
+          
+        **(return value)**
+          A tuple with the two connections.
         
+        To talk with a worker process, create the socket pair yourself and
+        wrap each end in the process that uses it, after forking::
+        
+            parent_sck, child_sck = socket.socketpair()
+            if os.fork() == 0:
+                parent_sck.close()
+                conn = bjsonrpc.connection.Connection(child_sck, 
+                    handler_factory=WorkerHandler)
+                conn.serve()
+                os._exit(0)
+            child_sck.close()
+            conn = bjsonrpc.connection.Connection(parent_sck)
+            print(conn.call.some_method_in_worker())
+    """
+    if peer_handler_factory is None:
+        peer_handler_factory = handler_factory
+    sck1, sck2 = socket.socketpair()
+    return (_wrap(sck1, handler_factory), _wrap(sck2, peer_handler_factory))
 
 
+def _wrap(sck, handler_factory):
+    """
+        Creates a client *Connection* for a connected socket, honoring 
+        *bjsonrpc_options['write_mode']*.
+    """
+    ioloop = None
+    if bjsonrpc_options['write_mode'] == 'ioloop':
+        ioloop = bjsonrpc.ioloop.IOLoop.instance()
+    return bjsonrpc.connection.Connection(sck, 
+        handler_factory=handler_factory, ioloop=ioloop)
+
 
+def _remove_stale_socket(path):
+    """
+        Removes the socket file at *path*, if any, so it can be bound again.
+        Abstract namespace addresses and files that are not sockets are 
+        left alone.
+    """
+    if path[:1] in ('\0', b'\0'):
+        return
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
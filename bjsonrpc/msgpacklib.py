@@ -0,0 +1,310 @@
+"""
+    bjson/msgpacklib.py
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+from collections import namedtuple
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from bjsonrpc.jsonlib import Codec, register_codec, _hint_native
+
+__all__ = [
+    "packb",
+    "unpackb",
+    "ExtType",
+    "ext_hints",
+    "MsgpackCodec",
+]
+
+if msgpack is not None:
+    ExtType = msgpack.ExtType
+else:
+    ExtType = namedtuple("ExtType", "code data")
+
+ext_hints = {
+    1 : '__remoteobject__',
+    2 : '__objectreference__',
+    3 : '__functionreference__',
+    4 : '__promise__',
+}
+"""
+MessagePack extension type codes used for the class hints. The payload of
+each one is the name of the object in UTF-8.
+"""
+_hint_codes = dict([ (hint, code) for code, hint in ext_hints.items() ])
+
+
+def _py_packb(obj, default=None):
+    """
+        Pure-Python MessagePack encoder, used when *msgpack* is not
+        installed. **default** is called for objects of unknown types, and
+        for bytearrays so they can be told apart from bytes. It must return
+        something that can be packed (like an *ExtType*).
+    """
+    out = []
+    _pack(obj, out, default)
+    return b''.join(out)
+
+_pack_B = struct.Struct(">B").pack
+_pack_BB = struct.Struct(">BB").pack
+_pack_Bb = struct.Struct(">Bb").pack
+_pack_BH = struct.Struct(">BH").pack
+_pack_Bh = struct.Struct(">Bh").pack
+_pack_BI = struct.Struct(">BI").pack
+_pack_Bi = struct.Struct(">Bi").pack
+_pack_BQ = struct.Struct(">BQ").pack
+_pack_Bq = struct.Struct(">Bq").pack
+_pack_Bd = struct.Struct(">Bd").pack
+
+def _pack_header(out, size, fixcode, fixmax, code16, code32, code8=None):
+    """ Appends the header of a str, bin, array, map or ext of **size** """
+    if size <= fixmax:
+        out.append(_pack_B(fixcode | size))
+    elif code8 is not None and size < 0x100:
+        out.append(_pack_BB(code8, size))
+    elif size < 0x10000:
+        out.append(_pack_BH(code16, size))
+    elif size < 0x100000000:
+        out.append(_pack_BI(code32, size))
+    else:
+        raise ValueError("Object too big to pack (%d)" % size)
+
+_fixcodes = { 1: 0xd4, 2: 0xd5, 4: 0xd6, 8: 0xd7, 16: 0xd8 }
+
+def _pack(obj, out, default):
+    if obj is None:
+        out.append(b'\xc0')
+    elif obj is True:
+        out.append(b'\xc3')
+    elif obj is False:
+        out.append(b'\xc2')
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(_pack_B(obj))
+        elif -0x20 <= obj < 0:
+            out.append(_pack_Bb(0xe0, obj)[1:])
+        elif 0 <= obj:
+            if obj < 0x100: out.append(_pack_BB(0xcc, obj))
+            elif obj < 0x10000: out.append(_pack_BH(0xcd, obj))
+            elif obj < 0x100000000: out.append(_pack_BI(0xce, obj))
+            elif obj < 0x10000000000000000: out.append(_pack_BQ(0xcf, obj))
+            else: raise OverflowError("Integer out of range")
+        else:
+            if obj >= -0x80: out.append(_pack_Bb(0xd0, obj))
+            elif obj >= -0x8000: out.append(_pack_Bh(0xd1, obj))
+            elif obj >= -0x80000000: out.append(_pack_Bi(0xd2, obj))
+            elif obj >= -0x8000000000000000: out.append(_pack_Bq(0xd3, obj))
+            else: raise OverflowError("Integer out of range")
+    elif isinstance(obj, float):
+        out.append(_pack_Bd(0xcb, obj))
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        _pack_header(out, len(data), 0xa0, 31, 0xda, 0xdb, 0xd9)
+        out.append(data)
+    elif isinstance(obj, (bytes, memoryview)):
+        data = bytes(obj)
+        _pack_header(out, len(data), 0, -1, 0xc5, 0xc6, 0xc4)
+        out.append(data)
+    elif isinstance(obj, ExtType): # before tuple: it is a namedtuple
+        size = len(obj.data)
+        if size in _fixcodes:
+            out.append(_pack_B(_fixcodes[size]))
+        else:
+            _pack_header(out, size, 0, -1, 0xc8, 0xc9, 0xc7)
+        out.append(_pack_Bb(0, obj.code)[1:])
+        out.append(obj.data)
+    elif isinstance(obj, (list, tuple)):
+        _pack_header(out, len(obj), 0x90, 15, 0xdc, 0xdd)
+        for value in obj:
+            _pack(value, out, default)
+    elif isinstance(obj, dict):
+        _pack_header(out, len(obj), 0x80, 15, 0xde, 0xdf)
+        for key, value in obj.items():
+            _pack(key, out, default)
+            _pack(value, out, default)
+    elif default is not None:
+        value = default(obj)
+        if type(value) is type(obj):
+            raise TypeError("Can't pack %r" % obj)
+        _pack(value, out, default)
+    else:
+        raise TypeError("Can't pack %r" % obj)
+
+
+def _py_unpackb(data, ext_hook=None, object_hook=None):
+    """
+        Pure-Python MessagePack decoder, used when *msgpack* is not
+        installed. **ext_hook(code, data)** is called for extension types,
+        and **object_hook(dict)** for every map, innermost first.
+    """
+    data = bytes(data)
+    obj, pos = _unpack(data, 0, ext_hook, object_hook)
+    if pos != len(data):
+        raise ValueError("Extra data after the packed object")
+    return obj
+
+_fixsizes = dict([ (code, size) for size, code in _fixcodes.items() ])
+_scalars = {
+    0xca: struct.Struct(">f"), 0xcb: struct.Struct(">d"),
+    0xcc: struct.Struct(">B"), 0xcd: struct.Struct(">H"),
+    0xce: struct.Struct(">I"), 0xcf: struct.Struct(">Q"),
+    0xd0: struct.Struct(">b"), 0xd1: struct.Struct(">h"),
+    0xd2: struct.Struct(">i"), 0xd3: struct.Struct(">q"),
+}
+_sizes = {
+    # code: (kind, struct of the size)
+    0xc4: ('bin', _scalars[0xcc]), 0xc5: ('bin', _scalars[0xcd]),
+    0xc6: ('bin', _scalars[0xce]), 0xc7: ('ext', _scalars[0xcc]),
+    0xc8: ('ext', _scalars[0xcd]), 0xc9: ('ext', _scalars[0xce]),
+    0xd9: ('str', _scalars[0xcc]), 0xda: ('str', _scalars[0xcd]),
+    0xdb: ('str', _scalars[0xce]), 0xdc: ('array', _scalars[0xcd]),
+    0xdd: ('array', _scalars[0xce]), 0xde: ('map', _scalars[0xcd]),
+    0xdf: ('map', _scalars[0xce]),
+}
+
+def _take(data, pos, size):
+    end = pos + size
+    if end > len(data):
+        raise ValueError("Truncated packed data")
+    return data[pos:end], end
+
+def _unpack(data, pos, ext_hook, object_hook):
+    if pos >= len(data):
+        raise ValueError("Truncated packed data")
+    code = data[pos]
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    if code >= 0xe0:
+        return code - 0x100, pos
+    if code < 0x90:
+        kind, size = 'map', code & 0x0f
+    elif code < 0xa0:
+        kind, size = 'array', code & 0x0f
+    elif code < 0xc0:
+        kind, size = 'str', code & 0x1f
+    elif code == 0xc0:
+        return None, pos
+    elif code == 0xc2:
+        return False, pos
+    elif code == 0xc3:
+        return True, pos
+    elif code in _scalars:
+        scalar = _scalars[code]
+        raw, pos = _take(data, pos, scalar.size)
+        return scalar.unpack(raw)[0], pos
+    elif code in _fixsizes:
+        kind, size = 'ext', _fixsizes[code]
+    elif code in _sizes:
+        kind, sizefmt = _sizes[code]
+        raw, pos = _take(data, pos, sizefmt.size)
+        size = sizefmt.unpack(raw)[0]
+    else:
+        raise ValueError("Invalid MessagePack code 0x%02x" % code)
+
+    if kind == 'str':
+        raw, pos = _take(data, pos, size)
+        return raw.decode('utf-8'), pos
+    if kind == 'bin':
+        return _take(data, pos, size)
+    if kind == 'ext':
+        raw, pos = _take(data, pos, 1)
+        extcode = struct.unpack(">b", raw)[0]
+        raw, pos = _take(data, pos, size)
+        if ext_hook is not None:
+            return ext_hook(extcode, raw), pos
+        return ExtType(extcode, raw), pos
+    if kind == 'array':
+        result = []
+        for i in range(size):
+            value, pos = _unpack(data, pos, ext_hook, object_hook)
+            result.append(value)
+        return result, pos
+    result = {}
+    for i in range(size):
+        key, pos = _unpack(data, pos, ext_hook, object_hook)
+        value, pos = _unpack(data, pos, ext_hook, object_hook)
+        result[key] = value
+    if object_hook is not None:
+        result = object_hook(result)
+    return result, pos
+
+
+if msgpack is not None:
+    def packb(obj, default=None):
+        """
+            Returns the MessagePack encoding of **obj**, calling **default**
+            for objects of unknown types. As in *_py_packb*, bytearrays are
+            passed to it too, so they can be told apart from bytes.
+        """
+        if default is not None:
+            native = (bytearray,)
+            dump = default
+            default = lambda value: _hint_native(dump(value), native, dump)
+            obj = _hint_native(obj, native, dump)
+        return msgpack.packb(obj, default=default, use_bin_type=True)
+
+    def unpackb(data, ext_hook=None, object_hook=None):
+        """
+            Decodes the MessagePack data **data**. See *_py_unpackb*.
+        """
+        kwargs = {}
+        if ext_hook is not None:
+            kwargs['ext_hook'] = ext_hook
+        return msgpack.unpackb(data, raw=False, strict_map_key=False,
+                               object_hook=object_hook, **kwargs)
+else:
+    packb = _py_packb
+    unpackb = _py_unpackb
+
+
+class MsgpackCodec(Codec):
+    """
+        MessagePack codec. It uses the *msgpack* package if installed, and a
+        bundled pure-Python implementation otherwise. Floats are sent as
+        8-byte IEEE doubles and *bytes* as binary strings. The class hints
+        produced by *Connection.dump_object* are sent as extension types
+        (see *ext_hints*); other dictionaries returned by it are sent as
+        maps.
+
+        It is a binary format, so it needs length framing: connections
+        select it with *negotiate(codec='msgpack')*.
+    """
+    name = 'msgpack'
+    format = 'msgpack'
+    binary = True
+
+    def dumps(self, obj, conn):
+        dump_object = conn.dump_object
+        def default(value):
+            value = dump_object(value)
+            if type(value) is dict and len(value) == 1:
+                for key, name in value.items():
+                    code = _hint_codes.get(key)
+                    if code is not None:
+                        return ExtType(code, name.encode('utf-8'))
+            return value
+        return packb(obj, default=default)
+
+    def loads(self, data, conn):
+        load_object = conn.load_object
+        def ext_hook(code, payload):
+            hint = ext_hints.get(code)
+            if hint is None:
+                return ExtType(code, payload)
+            return load_object({ hint : bytes(payload).decode('utf-8') })
+        return unpackb(data, ext_hook=ext_hook, object_hook=load_object)
+
+
+register_codec(MsgpackCodec())
@@ -0,0 +1,252 @@
+"""
+    bjson/pollers.py
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+import errno
+import select
+import socket
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+__all__ = [
+    "READ",
+    "WRITE",
+    "SelectPoller",
+    "SelectorsPoller",
+    "Waker",
+    "default_poller",
+    "wait_readable",
+    "wait_writable",
+]
+
+READ = 1
+"""Event mask bit for read readiness (same value as *selectors.EVENT_READ*)"""
+
+WRITE = 2
+"""Event mask bit for write readiness (same value as *selectors.EVENT_WRITE*)"""
+
+if hasattr(select, "poll"):
+    _POLLIN = select.POLLIN | select.POLLPRI
+    _POLLOUT = select.POLLOUT
+else:
+    _POLLIN = _POLLOUT = 0
+
+
+class BasePoller(object):
+    """
+        Interface shared by all the poller backends. A poller watches a set of
+        sockets that are registered once, and returns the ones that are ready
+        on each call to *poll*.
+
+        Sockets are always given and returned as the original objects, so
+        the caller can use them as keys (e.g. to find its *Connection*).
+    """
+    def register(self, sck, events=READ):
+        """
+            Starts watching **sck** for the events given in the **events**
+            mask (a combination of *READ* and *WRITE*).
+        """
+        raise NotImplementedError
+
+    def modify(self, sck, events):
+        """
+            Changes the event mask of an already registered socket.
+        """
+        raise NotImplementedError
+
+    def unregister(self, sck):
+        """
+            Stops watching **sck**. Unknown sockets are silently ignored.
+        """
+        raise NotImplementedError
+
+    def poll(self, timeout=None):
+        """
+            Waits up to **timeout** seconds (forever if None) and returns a
+            list of (socket, events) tuples for the sockets that are ready.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+            Releases the resources held by the poller.
+        """
+        pass
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class SelectPoller(BasePoller):
+    """
+        Portable fallback based on *select.select*. It costs O(n) per call and
+        it can't handle file descriptors over FD_SETSIZE (usually 1024), but
+        it is available on every platform.
+    """
+    def __init__(self):
+        self._sockets = {}
+        self._rlist = []
+        self._wlist = []
+
+    def _rebuild(self):
+        self._rlist = [ sck for sck, ev in self._sockets.values() if ev & READ ]
+        self._wlist = [ sck for sck, ev in self._sockets.values() if ev & WRITE ]
+
+    def register(self, sck, events=READ):
+        self._sockets[sck.fileno()] = (sck, events)
+        self._rebuild()
+
+    def modify(self, sck, events):
+        self.register(sck, events)
+
+    def unregister(self, sck):
+        for fileno, (osck, ev) in list(self._sockets.items()):
+            if osck is sck:
+                del self._sockets[fileno]
+        self._rebuild()
+
+    def poll(self, timeout=None):
+        if not self._rlist and not self._wlist:
+            # select() with empty lists is an error on some platforms.
+            if timeout:
+                select.select([], [], [], timeout)
+            return []
+        rready, wready = select.select(self._rlist, self._wlist, [], timeout)[:2]
+        events = {}
+        for sck in rready:
+            events[sck] = events.get(sck, 0) | READ
+        for sck in wready:
+            events[sck] = events.get(sck, 0) | WRITE
+        return list(events.items())
+
+    def __len__(self):
+        return len(self._sockets)
+
+
+class SelectorsPoller(BasePoller):
+    """
+        Poller based on *selectors.DefaultSelector*, which uses the best
+        mechanism available in the platform (epoll on Linux, kqueue on BSD).
+        Each socket is registered once in the kernel, so the cost of a wakeup
+        depends on the number of ready sockets and not on the total.
+    """
+    def __init__(self, selector_class=None):
+        if selector_class is None:
+            selector_class = selectors.DefaultSelector
+        self._selector = selector_class()
+
+    def register(self, sck, events=READ):
+        self._selector.register(sck, events)
+
+    def modify(self, sck, events):
+        self._selector.modify(sck, events)
+
+    def unregister(self, sck):
+        try:
+            self._selector.unregister(sck)
+        except (KeyError, ValueError):
+            pass
+
+    def poll(self, timeout=None):
+        return [ (key.fileobj, events)
+                 for key, events in self._selector.select(timeout) ]
+
+    def close(self):
+        self._selector.close()
+
+    def __len__(self):
+        return len(self._selector.get_map())
+
+
+class Waker(object):
+    """
+        Self-pipe used to interrupt a thread blocked in *poll* from another
+        thread. Register *Waker.socket* for *READ* in the poller, call *wake*
+        from any thread and *drain* it from the polling thread.
+    """
+    def __init__(self):
+        self.socket, self._peer = socket.socketpair()
+        self.socket.setblocking(False)
+        self._peer.setblocking(False)
+
+    def wake(self):
+        """
+            Makes *socket* readable. Never blocks.
+        """
+        try:
+            self._peer.send(b'\0')
+        except socket.error:
+            pass # buffer full: it is already awake.
+
+    def drain(self):
+        """
+            Consumes all the pending wake-ups.
+        """
+        try:
+            while self.socket.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def close(self):
+        """
+            Closes both ends of the pipe.
+        """
+        self.socket.close()
+        self._peer.close()
+
+
+def default_poller():
+    """
+        Returns a new instance of the best poller available in this platform.
+    """
+    if selectors is not None:
+        return SelectorsPoller()
+    return SelectPoller()
+
+
+def _wait(sck, pollmask, selectidx, timeout):
+    """
+        Waits for a single socket using *select.poll* when available.
+    """
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sck, pollmask)
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        while True:
+            try:
+                return bool(poller.poll(timeout))
+            except (select.error, OSError) as exc:
+                if exc.args[0] != errno.EINTR:
+                    raise
+    lists = [[], [], []]
+    lists[selectidx].append(sck)
+    return bool(select.select(lists[0], lists[1], lists[2], timeout)[selectidx])
+
+
+def wait_readable(sck, timeout=0):
+    """
+        Returns True if **sck** has data to read (or it is closed) after
+        waiting at most **timeout** seconds. Unlike *select.select*, it works
+        with file descriptors over FD_SETSIZE when *select.poll* is available.
+    """
+    return _wait(sck, _POLLIN, 0, timeout)
+
+
+def wait_writable(sck, timeout=0):
+    """
+        Returns True if **sck** can accept more data after waiting at most
+        **timeout** seconds. See *wait_readable*.
+    """
+    return _wait(sck, _POLLOUT, 1, timeout)
@@ -32,7 +32,7 @@ class Proxy(object):
         self._conn = conn
         self._obj = obj
         self.sync_type = sync_type
-        self._callback = None
+        self._callback = callback
 
     @property
     def callback(self):
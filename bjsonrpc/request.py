@@ -36,16 +36,22 @@ try:
     from Queue import Queue
 except ImportError:
     from queue import Queue
+from collections import deque
+from concurrent.futures import Future, TimeoutError
 import logging
-from threading import Event
+from threading import Event, Lock
+import time
 import traceback
 
 from bjsonrpc.exceptions import ServerError
+from bjsonrpc.proxies import Proxy
 import bjsonrpc.jsonlib as json
 
 
 _log = logging.getLogger(__name__)
 
+_future_lock = Lock()
+
 class Request(object):
     """
         Represents a request to the other end which may be not be completed yet.
@@ -64,14 +70,14 @@ class Request(object):
             
         Attributes:
         
-        **responses**
-            Queue of JSON Objects of the response, each as a dictionary. If
-            no response has been received, this is empty. 
+        **response**
+            JSON Object of the response, as a dictionary, or None if it 
+            has not been received yet.
             
         **event_response**
             A threading.Event object, which is set to true when a response has 
             been received. Useful to wake up threads or to wait exactly until
-            the response is received.
+            the response is received. Created on first use.
             
         **callbacks**
             List array where the developer can append functions to call when
@@ -83,38 +89,170 @@ class Request(object):
             Be careful because it may be not an integer. Strings and other objects
             may be valid for other implementations.
             
+        **streaming**
+            True for the *StreamRequest* made with the *stream* proxy.
+            
+        **future**
+            A *concurrent.futures.Future* resolved with the value (or the 
+            *exceptions.ServerError*) when the response is received, so 
+            *concurrent.futures.wait* and *as_completed* work over many 
+            requests. Created on first use. They only wait: another thread
+            must read the connection (see *Connection.start_reader*).
+            
+        The request itself has the methods of a Future that don't change
+        it (*done*, *result*, *exception*, *add_done_callback*...). It only
+        expects one response, and has no dictionary: *PipeRequest* queues
+        the responses of pipe calls.
     """
-    def __init__(self, conn, request_data, callback=None):
+    __slots__ = ('conn', 'data', 'request_id', 'auto_close', '_response',
+                 '_event', '_callbacks', '_future', '__weakref__')
+    streaming = False
+    _auto_close = True
+    
+    def __init__(self, conn, request_data, callback=None, batch=None):
         self.conn = conn
         self.data = request_data
-        self.responses = Queue()
-        # TODO: Now that we have a Queue, do we need an Event (and a cv)?
-        self.event_response = Event()
-        self.callbacks = []
+        self._response = None
+        self._event = None
+        self._callbacks = None
+        self._future = None
         if callback:
-            self.callbacks.append(callback)
-        self.thread_wait = self.event_response.wait
+            self._callbacks = [callback]
         self.request_id = None
         self.auto_close = False
-        if 'id' in self.data: 
-            self.request_id = self.data['id']
-            
+        if batch is not None:
+            # Sent (and added) by the batch. Until it takes the request,
+            # there is no id to close.
+            batch.add(request_data, self)
+        self.request_id = request_data.get('id')
+        if self.request_id:
+            self.auto_close = self._auto_close
+        if batch is not None:
+            return
         if self.request_id:
-            self.auto_close = True
             self.conn.addrequest(self)
             
         data = json.dumps(self.data, self.conn)
 
         self.conn.write(data)
     
+    @property
+    def response(self):
+        return self._response
+    
+    @property
+    def callbacks(self):
+        if self._callbacks is None:
+            self._callbacks = []
+        return self._callbacks
+    
+    @property
+    def event_response(self):
+        if self._event is None:
+            self._event = Event()
+            # Set it ourselves if the response arrived meanwhile.
+            if self.done():
+                self._event.set()
+        return self._event
+    
+    @property
+    def thread_wait(self):
+        return self.event_response.wait
+    
+    @property
+    def future(self):
+        _future_lock.acquire()
+        try:
+            if self._future is None:
+                self._future = Future()
+                self._future.set_running_or_notify_cancel()
+        finally:
+            _future_lock.release()
+        if self._response is not None:
+            self._resolve_future()
+        return self._future
+        
+    def _resolve_future(self):
+        _future_lock.acquire()
+        try:
+            future = self._future
+            if future.done():
+                return
+            error = self._response.get('error')
+            if error is not None:
+                future.set_exception(ServerError(error))
+            else:
+                future.set_result(self._response.get('result'))
+        finally:
+            _future_lock.release()
+    
     def hasresponse(self):
         """
             Method thet checks if there's a response or not.
             Returns True if there it is or False if it haven't arrived yet.
         """
-        if not self.responses.empty(): return True
-        self.conn.dispatch_until_empty()
-        return not self.responses.empty()
+        if self.done(): return True
+        if not self.conn.reads_in_background():
+            self.conn.dispatch_until_empty()
+        return self.done()
+        
+    def done(self):
+        """
+            Returns True if there is a response, without reading.
+        """
+        return self._response is not None
+        
+    def running(self):
+        return not self.done()
+        
+    def cancelled(self):
+        return False
+        
+    def cancel(self):
+        """
+            Requests can't be cancelled: returns False, like the method of
+            a running *concurrent.futures.Future*.
+        """
+        return False
+        
+    def add_done_callback(self, function):
+        """
+            Calls *function(request)* when the response is received, or now
+            if it was already received.
+        """
+        if self.done():
+            function(self)
+        else:
+            self.callbacks.append(function)
+        
+    def _store(self, value):
+        self._response = value
+        
+    def _take(self):
+        return self._response
+        
+    def wake(self):
+        """
+            Method used by Connection instance to wake up the threads that
+            wait for this request when its reader stops (see
+            *Connection.start_reader*).
+        """
+        self.event_response.set()
+        
+    def _wait_reader(self, event, pending, timeout=None):
+        """
+            Waits for **event** while the reader of the connection reads,
+            if *pending()* is still True. Raises the error that stopped the
+            reader.
+        """
+        event.clear()
+        if not pending():
+            event.set() # it was set for this
+            return
+        error = self.conn._reader_error
+        if error is not None:
+            raise error
+        event.wait(timeout)
         
     def setresponse(self, value):
         """
@@ -126,28 +264,66 @@ class Request(object):
             **value**
                 Value (JSON decoded) received from socket.
         """
-        self.responses.put(value)
-        for callback in self.callbacks: 
+        self._store(value)
+        for callback in self._callbacks or (): 
             try:
                 callback(self)
             except Exception as exc:
                 _log.error("Error on callback: %r", exc)
                 _log.debug(traceback.format_exc())
-                
-        self.event_response.set() # helper for threads.
+        
+        if self._event is not None:
+            self._event.set() # helper for threads.
+        if self._future is not None:
+            self._resolve_future()
         if self.auto_close:
             self.close()
     
-    def wait(self):
+    def wait(self, timeout=None):
         """
             Block until there is a response. Will manage the socket and dispatch
-            messages until the response is found.
-        """
-        #if self.response is None:
-        #    self.conn.read_ensure_thread()
+            messages until the response is found, unless the connection is
+            read in the background (see *Connection.start_reader*).
             
-        while self.responses.empty():
-            self.conn.read_and_dispatch(condition=lambda: self.responses.empty())
+            With a **timeout** in seconds, returns False if there is no
+            response yet when it expires, and True otherwise.
+        """
+        pending = lambda: not self.done()
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while pending():
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    return False
+            if self.conn.reads_in_background():
+                self._wait_reader(self.event_response, pending, timeout)
+            else:
+                self.conn.read_and_dispatch(timeout=timeout, 
+                                            condition=pending)
+        return True
+    
+    def result(self, timeout=None):
+        """
+            Like *value*, but waits at most **timeout** seconds, and then
+            raises *concurrent.futures.TimeoutError*.
+        """
+        if not self.wait(timeout):
+            raise TimeoutError()
+        return self.value
+    
+    def exception(self, timeout=None):
+        """
+            Returns the *exceptions.ServerError* of the response, or None,
+            waiting for it at most **timeout** seconds.
+        """
+        if not self.wait(timeout):
+            raise TimeoutError()
+        error = self._response.get('error')
+        if error is not None:
+            return ServerError(error)
+        return None
     
     def __call__(self):
         return self.value
@@ -184,8 +360,282 @@ class Request(object):
                 
         """
         self.wait()
-        response = self.responses.get()
+        response = self._take()
         err = response.get('error', None)
         if err is not None:
             raise ServerError(err)
         return response['result']
+
+
+class PipeRequest(Request):
+    """
+        *Request* of the *pipe* proxy, which receives one response for each
+        value yielded by the remote method and is not closed by them: each
+        *value* waits for the next one.
+        
+        Attributes:
+        
+        **responses**
+            Queue of the JSON Objects of the responses not taken yet.
+    """
+    __slots__ = ('responses',)
+    _auto_close = False
+    
+    def __init__(self, conn, request_data, callback=None):
+        self.responses = Queue()
+        Request.__init__(self, conn, request_data, callback)
+        
+    def done(self):
+        return not self.responses.empty()
+        
+    def _store(self, value):
+        if self._response is None:
+            self._response = value
+        self.responses.put(value)
+        
+    def _take(self):
+        return self.responses.get()
+
+
+class StreamRequest(Request):
+    """
+        *Request* of the *stream* proxy: the elements of a result list 
+        streamed by the connection are handed to it as they are decoded 
+        (see *Connection.stream_threshold*), and iterating it yields them 
+        (see *iter_result*).
+    """
+    __slots__ = ('items', '_item_event')
+    streaming = True
+    
+    def __init__(self, conn, request_data, callback=None):
+        self.items = deque()
+        self._item_event = Event()
+        Request.__init__(self, conn, request_data, callback)
+        
+    def putitem(self, value):
+        """
+            Method used by Connection instance to hand over one element of 
+            the result while it is streamed, before *setresponse* is called
+            with the rest of the response.
+        """
+        self.items.append(value)
+        self._item_event.set()
+        
+    def _store(self, value):
+        self._response = value
+        self._item_event.set()
+        
+    def wake(self):
+        Request.wake(self)
+        self._item_event.set()
+        
+    def iter_result(self):
+        """
+            Iterates over the elements of the result list. They are yielded
+            as they are decoded, even if no other thread reads from the 
+            connection. Raises *exceptions.ServerError* if the response 
+            contains an error.
+        """
+        items = self.items
+        pending = lambda: not items and not self.done()
+        while not self.done():
+            if items:
+                yield items.popleft()
+            elif self.conn.reads_in_background():
+                self._wait_reader(self._item_event, pending)
+            else:
+                self.conn.read_and_dispatch(condition=pending)
+        response = self._response
+        while items:
+            yield items.popleft()
+        # A streamed result that failed has both the elements sent before
+        # the error and the error.
+        for value in response.get('result') or ():
+            yield value
+        err = response.get('error', None)
+        if err is not None:
+            raise ServerError(err)
+        
+    def __iter__(self):
+        return self.iter_result()
+        
+    @property
+    def value(self):
+        return list(self.iter_result())
+
+
+class PromiseRequest(Request):
+    """
+        *Request* of the *promise* proxy. The other end keeps its result 
+        under **name**, so it can be used before the response arrives: as
+        an argument of other calls, which get the result in its place, and
+        through the proxies of the request, which call the methods of the 
+        object returned. The calls that depend on it are sent right away, 
+        and the other end runs them when the result is ready::
+        
+            orders = conn.promise.Cursor("orders")
+            pending = orders.promise.filter(status="pending")
+            print(pending.call.count())    # a single round trip
+            conn.call.export(pending)
+        
+        If the call fails, the calls that depend on it fail too.
+        
+        Attributes:
+        
+        **name**
+            Name of the result in the other end, or None once released.
+        
+        **call**, **method**, **notify**, **promise**
+            Proxies for the methods of the object returned, like those of 
+            *connection.RemoteObject*.
+            
+        The other end forgets the result when *release* is called, or when
+        the request is deleted.
+    """
+    __slots__ = ('name',)
+    
+    def __init__(self, conn, request_data, callback=None):
+        self.name = request_data['resultname']
+        Request.__init__(self, conn, request_data, callback)
+        
+    @property
+    def call(self):
+        return _PromiseProxy(self, 0)
+        
+    @property
+    def method(self):
+        return _PromiseProxy(self, 1)
+        
+    @property
+    def notify(self):
+        return _PromiseProxy(self, 2)
+        
+    @property
+    def promise(self):
+        return _PromiseProxy(self, 6)
+        
+    def release(self):
+        """
+            Tells the other end to forget the result. It is done after the
+            calls already sent that depend on it.
+        """
+        name, self.name = self.name, None
+        if name is not None and self.conn.connection_status == "open":
+            Proxy(self.conn, sync_type=2, obj=name).__delete__()
+            
+    def __del__(self):
+        self.close()
+        self.release()
+
+
+class _PromiseProxy(Proxy):
+    """ 
+        Proxy for the methods of the result of a *PromiseRequest*. It keeps
+        the request, so it isn't released before the calls are sent.
+    """
+    def __init__(self, request, sync_type):
+        if request.name is None:
+            raise ValueError("The promise was released")
+        Proxy.__init__(self, request.conn, sync_type, obj=request.name)
+        self._request = request
+
+
+class Batch(object):
+    """
+        Collects calls to send them to the other end in a single message 
+        (a JSON-RPC batch), whose responses come back in a single message 
+        too. Created by *Connection.batch*::
+        
+            with conn.batch() as batch:
+                total = batch.call.add2(1, 2)
+                items = batch.method.getabc(a=1)
+                batch.notify.ping()
+            print(total.value, items.value)
+            
+        Attributes:
+        
+        **call**, **method**
+            Proxies that add a call to the batch and return its *Request*,
+            which gets the response after the batch is sent. (*call* can't
+            wait for the value inside the batch.)
+            
+        **notify**
+            Proxy that adds a notification to the batch.
+            
+        **requests**
+            The requests of the calls added, in order.
+            
+        The batch is sent when the *with* block ends, or by *send*. If the
+        block raises an exception, nothing is sent, and the requests raise
+        *exceptions.ServerError*.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.call = Proxy(self, sync_type=1)
+        self.method = Proxy(self, sync_type=1)
+        self.notify = Proxy(self, sync_type=2)
+        self.requests = []
+        self._items = []
+        self._sent = False
+        
+    def proxy(self, sync_type, name, args, kwargs, callback = None):
+        """
+            Adds a call to the batch (see *Connection.proxy*).
+        """
+        return self.conn.proxy(sync_type, name, args, kwargs, callback, 
+                               batch = self)
+        
+    def add(self, data, request = None):
+        """
+            Adds the message **data** to the batch; **request** is the 
+            *Request* that waits for its response, if any.
+        """
+        if self._sent:
+            raise ValueError("The batch has already been sent")
+        self._items.append(data)
+        if request is not None:
+            self.requests.append(request)
+            
+    def send(self):
+        """
+            Sends the calls added to the batch (if any).
+        """
+        if self._sent: return
+        if not self._items:
+            self._sent = True
+            return
+        try:
+            data = json.dumps(self._items, self.conn)
+        except Exception as exc:
+            # Nothing was registered: the requests get the error instead.
+            self.abort("Batch not sent: %s: %s" % (type(exc).__name__, exc))
+            raise
+        self._sent = True
+        for request in self.requests:
+            if request.request_id:
+                self.conn.addrequest(request)
+        self.conn.write(data)
+        
+    def abort(self, reason = "Batch not sent"):
+        """
+            Discards the calls added to the batch: their requests get 
+            **reason** as the error.
+        """
+        if self._sent: return
+        self._sent = True
+        for request in self.requests:
+            request.auto_close = False
+            request.request_id = None
+            request.setresponse({ 'id': None, 'result': None, 
+                                  'error': reason })
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+        else:
+            self.abort("Batch not sent: %s: %s" % (exc_type.__name__, 
+                                                   exc_value))
+        return False
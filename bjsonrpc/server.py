@@ -31,10 +31,22 @@
     POSSIBILITY OF SUCH DAMAGE.
 
 """
-import socket, select
+import errno
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
 
 from bjsonrpc.connection import Connection
 from bjsonrpc.exceptions import EofError
+from bjsonrpc.ioloop import IOLoop
+from bjsonrpc.workers import WorkerPool
+from bjsonrpc import bjsonrpc_options
+
+_log = logging.getLogger(__name__)
 
 class Server(object):
     """
@@ -55,13 +67,51 @@ class Server(object):
             Class (object type) to instantiate to publish methods for incoming
             connections. Should be an inherited class of *bjsonrpc.handlers.BaseHandler*
             
+        **poller_factory** = None
+            Callable that returns a new poller (see *bjsonrpc.pollers*). By 
+            default the best one available in the platform is used (epoll 
+            on Linux). Pass *bjsonrpc.pollers.SelectPoller* to force the old
+            *select.select* behaviour.
+            
+        **write_mode** = None
+            'thread' to give each connection its own writer thread, or 
+            'ioloop' to buffer the output of the connections and send it from
+            the server loop when the sockets are writable. Defaults to 
+            *bjsonrpc_options['write_mode']*.
+            
+        **worker_pool** = None
+            *bjsonrpc.workers.WorkerPool* shared by all the connections to 
+            run the incoming items in threaded mode 
+            (*bjsonrpc_options['threaded']*). By default the server creates
+            one, with the default size, when it starts serving, and shuts it
+            down when it stops.
+            
+        **max_frame_size** = None
+            If given, the *max_frame_size* of the connections: the most bytes
+            a message received may have before the connection is closed
+            (see *bjsonrpc.connection.Connection*).
+            
     """
-    def __init__(self, lstsck, handler_factory):
+    def __init__(self, lstsck, handler_factory, poller_factory=None,
+                 write_mode=None, worker_pool=None, max_frame_size=None):
         self._lstsck = lstsck
         self._handler = handler_factory
+        self._poller_factory = poller_factory
+        if write_mode is None:
+            write_mode = bjsonrpc_options['write_mode']
+        assert(write_mode in ['thread', 'ioloop'])
+        self._write_mode = write_mode
+        self._worker_pool = worker_pool
+        self._own_pool = False
+        self._max_frame_size = max_frame_size
+        self._ioloop = None
+        self._connections = {}
         self._debug_socket = False
         self._debug_dispatch = False
         self._serve = True
+        # False when the listener is shared with other processes, which
+        # would stop accepting too if it was shut down.
+        self._shutdown_listener = True
     
     def stop(self):
         """
@@ -69,6 +119,8 @@ class Server(object):
             Once stopped, call again to *serve()* to start the server loop again.
         """
         self._serve = False
+        if self._ioloop is not None:
+            self._ioloop.wake()
     
     def debug_socket(self, value = None):
         """
@@ -102,85 +154,117 @@ class Server(object):
             
         return ret
         
+    @property
+    def worker_pool(self):
+        """
+            The *bjsonrpc.workers.WorkerPool* of the connections (see its
+            *stats* method), or None until the server starts serving.
+        """
+        return self._worker_pool
+        
     def serve(self):
         """
             Starts the forever-serving loop. This function only exits when an
             Exception is raised inside, by unexpected error, KeyboardInterrput,
             etc.
             
-            It is coded using *select.select* function, and it is capable to 
-            serve to an unlimited amount of connections at same time 
-            without using threading.
+            It is coded using a *bjsonrpc.ioloop.IOLoop* over a poller (epoll,
+            kqueue or *select.select* as fallback), and it is capable to serve
+            to an unlimited amount of connections at same time without using
+            threading. Each socket is registered only once, so the cost of
+            every wakeup does not grow with the number of idle connections.
         """
         self._serve = True
+        if self._worker_pool is None:
+            # Created here and not in __init__, so PreforkServer workers 
+            # each get their own threads.
+            self._worker_pool = WorkerPool()
+            self._own_pool = True
+        ioloop = self._ioloop = IOLoop(self._poller_factory)
+        ioloop.attach()
         try:
-            sockets = []
-            connections = []
-            connidx = {}
+            ioloop.add_reader(self._lstsck, self._accept)
             while self._serve:
                 try:
-                    ready_to_read = select.select( 
-                        [self._lstsck]+sockets, # read
-                        [], [], # write, errors
-                        1 # timeout
-                        )[0]
+                    ioloop.run_once(1)
                 except Exception:
                     # Probably a socket is no longer valid.
-                    a = self._lstsck.fileno() # if this is not valid, raise Exception, exit.
-                    newsockets = []
-                    for sck in sockets:
-                        try:
-                            a = sck.fileno()
-                            h = sck.getpeername()
-                        except Exception:
-                            continue
-                        newsockets.append(sck)
-                    sockets[:] = newsockets
+                    self._lstsck.fileno() # if this is not valid, raise Exception, exit.
+                    self._prune()
                     continue
-                if not ready_to_read: 
-                    continue
-                    
-                if self._lstsck in ready_to_read:
-                    clientsck, clientaddr = self._lstsck.accept()
-                    sockets.append(clientsck)
-            
-                    conn = Connection(
-                            sck = clientsck, address = clientaddr, 
-                            handler_factory = self._handler
-                            )
-                    connidx[clientsck.fileno()] = conn
-                    conn._debug_socket = self._debug_socket
-                    conn._debug_dispatch = self._debug_socket
-                    # conn.internal_error_callback = self.
-                    
-                    connections.append(conn)
-                
-                for sck in ready_to_read:
-                    fileno = sck.fileno()
-                    if fileno not in connidx: 
-                        continue
-                        
-                    conn = connidx[fileno]
-                    try:
-                        conn.dispatch_until_empty()
-                    except EofError:
-                        conn.close()
-                        sockets.remove(conn.socket)
-                        connections.remove(conn)
-                        #print "Closing client conn."
-                    
 
         finally:
-            for conn in connections: 
+            for conn in list(self._connections.values()): 
                 conn.close()
+            self._connections.clear()
+            self._ioloop = None
+            ioloop.close()
+            if self._own_pool:
+                self._worker_pool.shutdown(wait=False)
+                self._worker_pool = None
+                self._own_pool = False
+            if self._shutdown_listener:
+                try:
+                    self._lstsck.shutdown(socket.SHUT_RDWR)
+                except Exception:
+                    pass
             try:
-                self._lstsck.shutdown(socket.SHUT_RDWR)
+                self._lstsck.close()
             except Exception:
                 pass
+
+    def _accept(self):
+        """
+            Accepts a new incoming connection and registers it in the loop.
+        """
+        clientsck, clientaddr = self._lstsck.accept()
+        ioloop = None
+        if self._write_mode == 'ioloop':
+            ioloop = self._ioloop
+        conn = Connection(
+                sck = clientsck, address = clientaddr, 
+                handler_factory = self._handler,
+                ioloop = ioloop
+                )
+        conn._debug_socket = self._debug_socket
+        conn._debug_dispatch = self._debug_socket
+        conn.worker_pool = self._worker_pool
+        if self._max_frame_size is not None:
+            conn.max_frame_size = self._max_frame_size
+        # conn.internal_error_callback = self.
+        self._connections[clientsck] = conn
+        self._ioloop.add_reader(clientsck, lambda: self._dispatch(conn))
+        return conn
+
+    def _dispatch(self, conn):
+        """
+            Reads and dispatches all the messages available for **conn**.
+        """
+        try:
+            conn.dispatch_until_empty()
+        except EofError:
+            self._drop(conn)
+            #print "Closing client conn."
+
+    def _drop(self, conn):
+        """
+            Unregisters and closes a client connection.
+        """
+        self._ioloop.remove(conn.socket)
+        self._connections.pop(conn.socket, None)
+        conn.close()
+
+    def _prune(self):
+        """
+            Removes from the loop the sockets that are no longer valid.
+        """
+        for sck, conn in list(self._connections.items()):
             try:
-                self._lstsck.close()
+                sck.fileno()
+                sck.getpeername()
             except Exception:
-                pass
+                self._drop(conn)
+        self._ioloop.prune()
 
     @property
     def socket(self): 
@@ -188,3 +272,191 @@ class Server(object):
             public property that holds the internal listener socket used.
         """
         return self._lstsck
+
+
+class PreforkServer(Server):
+    """
+        Forks **workers** processes that run their own *Server* loop over the
+        same port, so the handlers can use as many cores as workers. The
+        parent process doesn't serve: it supervises the workers, starts a new
+        one when any of them dies, and passes SIGTERM and SIGINT through to
+        them to shut down. Only available where *os.fork* exists.
+        
+        Usually created with *bjsonrpc.createserver(..., workers=N)*.
+        
+        Parameters:
+        
+        **lstsck**
+            Socket for the port. If **socket_factory** is None it must be 
+            already listening, and all the workers accept on it.
+            
+        **handler_factory**
+            As in *Server*. A handler instance is created per connection 
+            inside the worker that accepts it.
+            
+        **workers**
+            Number of worker processes.
+            
+        **socket_factory** = None
+            Callable that returns a new listening socket. When given, each
+            worker calls it to listen on its own socket (bound to the same 
+            port with SO_REUSEPORT) and the kernel balances the incoming 
+            connections between them. In that case **lstsck** is only bound,
+            to hold the port.
+            
+        **restart_delay** = 1
+            Seconds to wait before restarting a worker that died less than
+            this time after it was started, so a handler that crashes on
+            startup doesn't turn into a fork loop.
+            
+        The other keyword arguments are passed to the *Server* of each worker.
+    """
+    poll_interval = 0.2
+    stop_timeout = 5
+    
+    def __init__(self, lstsck, handler_factory, workers, socket_factory=None,
+                 restart_delay=1, **kwargs):
+        if not hasattr(os, "fork"):
+            raise NotImplementedError("PreforkServer requires os.fork")
+        assert(workers > 0)
+        Server.__init__(self, lstsck, handler_factory, **kwargs)
+        self._kwargs = kwargs
+        self._nworkers = workers
+        self._socket_factory = socket_factory
+        self._restart_delay = restart_delay
+        self._workers = {} # pid -> (index, start time)
+        self._server = None
+        
+    @property
+    def workers(self):
+        """
+            List of the process ids of the running workers.
+        """
+        return list(self._workers)
+        
+    def serve(self):
+        """
+            Starts the workers and supervises them until *stop* is called or
+            the process receives SIGTERM or SIGINT. Then it sends SIGTERM to
+            the workers and waits for them (up to *stop_timeout* seconds, 
+            then they are killed).
+        """
+        self._serve = True
+        handlers = self._install_signals(self._stop_signal)
+        try:
+            for index in range(self._nworkers):
+                self._spawn(index)
+            while self._serve:
+                time.sleep(self.poll_interval)
+                self._reap()
+        finally:
+            self._serve = False
+            self._restore_signals(handlers)
+            self._stop_workers()
+            try:
+                self._lstsck.close()
+            except Exception:
+                pass
+                
+    def _stop_signal(self, signum, frame):
+        self._serve = False
+        
+    def _install_signals(self, handler):
+        """
+            Installs **handler** for SIGTERM and SIGINT and returns the old
+            ones. Signals can only be handled in the main thread, elsewhere
+            this does nothing.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return {}
+        handlers = {}
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            handlers[signum] = signal.signal(signum, handler)
+        return handlers
+        
+    def _restore_signals(self, handlers):
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+            
+    def _spawn(self, index):
+        """
+            Forks the worker number **index**.
+        """
+        pid = os.fork()
+        if pid:
+            self._workers[pid] = (index, time.time())
+            _log.info("Started worker %d (pid %d)", index, pid)
+            return pid
+        # Child process: it must never return from here.
+        status = 1
+        try:
+            self._run_worker(index)
+            status = 0
+        except Exception:
+            _log.error("Worker %d failed: %s", index, traceback.format_exc())
+        finally:
+            os._exit(status)
+            
+    def _run_worker(self, index):
+        """
+            Serves in the worker process until it receives SIGTERM or SIGINT.
+        """
+        self._workers = {}
+        lstsck = self._lstsck
+        if self._socket_factory is not None:
+            lstsck.close()
+            lstsck = self._socket_factory()
+        server = self._server = Server(lstsck, self._handler, **self._kwargs)
+        # The inherited listener is only closed: shutting it down would
+        # stop it in every worker.
+        server._shutdown_listener = self._socket_factory is not None
+        server.debug_socket(self._debug_socket)
+        server.debug_dispatch(self._debug_dispatch)
+        # After fork the calling thread is the main thread of the child.
+        self._install_signals(lambda signum, frame: server.stop())
+        server.serve()
+        
+    def _reap(self):
+        """
+            Collects the workers that have exited and starts new ones. Only
+            the pids of the workers are waited for, so other children of 
+            the process (e.g. those of a *ProcessPoolExecutor*) are left to
+            their owners.
+        """
+        for pid in list(self._workers):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno != errno.ECHILD: raise
+                done, status = pid, 0 # collected by someone else
+            if not done: continue
+            index, started = self._workers.pop(pid)
+            if not self._serve: continue
+            _log.warning("Worker %d (pid %d) exited with status %d, restarting", 
+                         index, pid, os.waitstatus_to_exitcode(status))
+            if time.time() - started < self._restart_delay:
+                time.sleep(self._restart_delay)
+            self._spawn(index)
+            
+    def _stop_workers(self):
+        """
+            Sends SIGTERM to the workers and waits for them to finish.
+        """
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + self.stop_timeout
+        while self._workers:
+            if time.time() > deadline:
+                for pid in self._workers:
+                    _log.warning("Killing worker pid %d", pid)
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                deadline = float("inf")
+            self._reap()
+            if self._workers:
+                time.sleep(0.05)
@@ -0,0 +1,434 @@
+"""
+    bjson/streaming.py
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+from collections import deque
+import codecs
+import re
+import threading
+
+from bjsonrpc.jsonlib import j
+
+__all__ = [
+    "StreamDecoder",
+    "ResultStream",
+    "StreamPipe",
+]
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_SPACES = (' ', '\t', '\n', '\r')
+_NUMBER_CHARS = '0123456789.eE+-'
+_NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+
+# Parser states: what is expected next.
+_VALUE, _FIRST_VALUE, _KEY, _FIRST_KEY, _COLON, _NEXT, _END = range(7)
+
+
+class StreamDecoder(object):
+    """
+        Decodes one JSON message while its bytes arrive, so the whole raw
+        message (and its decoded text) is never held in memory: only the
+        objects decoded and the part of the message not decoded yet.
+
+        The outermost object is walked by the decoder itself; the values
+        inside it are decoded at once by the C scanner of the *json* module
+        when they are complete. Containers that are still incomplete with
+        more than **max_pending** characters buffered are walked too, so
+        the memory needed for the text stays bounded by the size of the
+        biggest scalar value (usually a string).
+
+        Parameters:
+
+        **object_hook**
+            Called for every dictionary decoded, innermost first, like in
+            *json.loads*.
+
+        **item_hook**
+            Called as *item_hook(path, value)* for every element of a list
+            walked by the decoder, where *path* is the tuple of keys (or
+            indexes) from the outermost object to the list. If it returns
+            True, the element is not added to the list. Used to hand the
+            elements of large results to the caller as they are decoded.
+
+        **max_pending** = 1048576
+            Size in characters of an incomplete container above which it
+            is walked instead of waiting for the rest of it.
+    """
+    def __init__(self, object_hook=None, item_hook=None, max_pending=1048576):
+        self.object_hook = object_hook
+        self.item_hook = item_hook
+        self.max_pending = max_pending
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        decoder = j.JSONDecoder(object_hook=object_hook)
+        self._scan = decoder.raw_decode
+        self._scan_once = decoder.scan_once # raises StopIteration, faster
+        self._text = '' # part of the message not decoded yet
+        self._retry = 0 # don't try to decode it again until it is this long
+        self._stack = [] # [container, key or index] of the open containers
+        self._keys = None # keys of the last dictionary added to a list
+        self._state = _VALUE
+        self._value = None
+        self._error = None
+
+    @property
+    def root(self):
+        """
+            The outermost object, which is still being filled until the
+            message is complete. None if it hasn't started yet.
+        """
+        if self._stack:
+            return self._stack[0][0]
+        return self._value
+
+    def feed(self, data):
+        """
+            Decodes as much as possible of the message with the next bytes
+            received, **data**. Errors are raised by *close*.
+        """
+        if self._error is not None: return
+        try:
+            self._text += self._utf8.decode(data)
+            self._parse(False)
+        except ValueError as exc:
+            self._error = exc
+            self._text = ''
+
+    def close(self):
+        """
+            Called when the whole message has been fed. Returns the decoded
+            object, or raises *ValueError* if the message is not valid JSON.
+        """
+        if self._error is None:
+            try:
+                self._text += self._utf8.decode(b'', True)
+                self._parse(True)
+                if self._state != _END:
+                    raise ValueError("Truncated JSON message")
+            except ValueError as exc:
+                self._error = exc
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _parse(self, final):
+        text = self._text
+        end = len(text)
+        if not final and end < self._retry: return
+        whitespace = _WHITESPACE.match
+        state = self._state
+        pos = 0
+        while True:
+            pos = whitespace(text, pos).end()
+            if pos == end:
+                self._retry = 0
+                break
+            char = text[pos]
+            if state == _NEXT:
+                container = self._stack[-1][0]
+                if char == ',':
+                    if type(container) is list:
+                        newpos = self._items(text, pos, end)
+                        if newpos != pos:
+                            pos = newpos
+                            continue
+                    pos += 1
+                    state = _KEY if type(container) is dict else _VALUE
+                elif char == ('}' if type(container) is dict else ']'):
+                    pos += 1
+                    state = self._close()
+                else:
+                    raise ValueError("Expecting ',' delimiter at char %d" % pos)
+            elif state == _COLON:
+                if char != ':':
+                    raise ValueError("Expecting ':' delimiter at char %d" % pos)
+                pos += 1
+                state = _VALUE
+            elif state == _END:
+                raise ValueError("Extra data at char %d" % pos)
+            elif ((state == _FIRST_KEY and char == '}') or
+                  (state == _FIRST_VALUE and char == ']')):
+                pos += 1
+                state = self._close()
+            elif state == _KEY or state == _FIRST_KEY:
+                if char != '"':
+                    raise ValueError("Expecting property name enclosed in "
+                                     "double quotes at char %d" % pos)
+                try:
+                    key, newpos = self._scan(text, pos)
+                except ValueError:
+                    if final: raise
+                    newpos = end
+                if newpos == end and not final:
+                    self._retry = 2 * (end - pos)
+                    break
+                self._stack[-1][1] = key
+                pos = newpos
+                state = _COLON
+            elif char in '{[' and not self._stack:
+                pos += 1
+                state = self._open(char)
+            else:
+                try:
+                    value, newpos = self._scan(text, pos)
+                except ValueError:
+                    if final: raise
+                    newpos = end
+                if (not final and newpos != end and 
+                        text[newpos] in _NUMBER_CHARS and
+                        _NUMBER_TAIL.match(text, newpos).end() == end):
+                    newpos = end # '1.' or '1e': the rest of a number
+                if newpos == end and not final:
+                    # Incomplete (or a number that may go on): wait for the
+                    # rest, unless it is a big container.
+                    if char in '{[' and end - pos > self.max_pending:
+                        pos += 1
+                        state = self._open(char)
+                        continue
+                    self._retry = 2 * (end - pos)
+                    break
+                pos = newpos
+                state = self._add(value)
+        self._text = text[pos:]
+        self._state = state
+
+    def _items(self, text, pos, end):
+        """
+            Fast path for the elements of a list: decodes the complete ones
+            after **pos** (a comma), and returns the position after the last
+            one decoded. Anything else is left to *_parse*.
+        """
+        frame = self._stack[-1]
+        append = frame[0].append
+        item_hook = self.item_hook
+        if item_hook is not None:
+            path = tuple([ parent[1] for parent in self._stack[:-1] ])
+        scan_once = self._scan_once
+        whitespace = _WHITESPACE.match
+        keys = self._keys
+        count = frame[1]
+        try:
+            while text.startswith(',', pos):
+                start = pos + 1
+                if text[start:start + 1] in _SPACES:
+                    start = whitespace(text, start).end()
+                try:
+                    value, newpos = scan_once(text, start)
+                except (StopIteration, ValueError):
+                    break
+                if newpos == end or text[newpos] in _NUMBER_CHARS:
+                    break # maybe incomplete: left to _parse
+                pos = newpos
+                count += 1
+                if type(value) is dict:
+                    # Inline _share_keys
+                    names = list(value)
+                    if names == keys:
+                        value = dict(zip(keys, value.values()))
+                    else:
+                        keys = names
+                if item_hook is None or not item_hook(path, value):
+                    append(value)
+        finally:
+            frame[1] = count
+            self._keys = keys
+        return pos
+
+    def _share_keys(self, value):
+        """
+            Each dictionary decoded by a separate call of the scanner has its
+            own copy of the key strings. Records with the same keys as the
+            previous one are rebuilt on its keys, so they are stored once.
+        """
+        keys = list(value)
+        if keys == self._keys:
+            return dict(zip(self._keys, value.values()))
+        self._keys = keys
+        return value
+
+    def _open(self, char):
+        if char == '{':
+            self._stack.append([{}, None])
+            return _FIRST_KEY
+        self._stack.append([[], 0])
+        return _FIRST_VALUE
+
+    def _close(self):
+        container = self._stack.pop()[0]
+        if type(container) is dict and self.object_hook is not None:
+            container = self.object_hook(container)
+        return self._add(container)
+
+    def _add(self, value):
+        stack = self._stack
+        if not stack:
+            self._value = value
+            return _END
+        frame = stack[-1]
+        container = frame[0]
+        if type(container) is dict:
+            container[frame[1]] = value
+            return _NEXT
+        frame[1] += 1
+        if type(value) is dict:
+            value = self._share_keys(value)
+        if self.item_hook is not None:
+            path = tuple([ parent[1] for parent in stack[:-1] ])
+            if self.item_hook(path, value):
+                return _NEXT
+        container.append(value)
+        return _NEXT
+
+
+class ResultStream(object):
+    """
+        Result of a handler method that is sent as a list with the values
+        of the iterable **values**, encoded and written a few at a time 
+        while they are produced, so the whole list (or its encoding) never 
+        has to be in memory and the first values are sent right away. See
+        *bjsonrpc.handlers.streamed*.
+
+        The values are produced and encoded by the thread that dispatched 
+        the call, which hands the encoded parts to the thread that writes to
+        the socket through a *StreamPipe*, and waits while that one is 
+        behind. If producing them raises an exception,
+        the list ends there and the error is sent in the *error* field of 
+        the same response. With the msgpack codec, which needs the length of
+        the list up front, and with *bjsonrpc.aio*, the list is built first
+        and sent as usual.
+    """
+    def __init__(self, values):
+        self.values = values
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+class StreamPipe(object):
+    """
+        Hands the parts (*bytes*) of a message produced by one thread to the
+        thread that sends them (see *Connection.write_stream*), so producing
+        them never holds up the writer. At most **max_pending** parts are
+        held: *put* blocks while the pipe is full.
+
+        Iterating the pipe yields the parts put so far, and None when the
+        next one isn't produced yet (*wait* blocks until it is). It ends 
+        after *close* and the last part. If the iteration is abandoned, the
+        pipe is cancelled and *put* returns False.
+
+        Parameters:
+
+        **ready** = None
+            Called (without arguments) by the producer when a part is put in
+            an empty pipe and when the pipe is closed, to resume a consumer
+            that does not *wait*.
+
+        **drain** = None
+            Called (with the pipe) by *put* when it finds the pipe full, and
+            then every **interval** seconds until there is room. It may send
+            data itself, or *cancel* the pipe.
+    """
+    def __init__(self, max_pending=4, ready=None, drain=None, interval=0.05):
+        self.max_pending = max_pending
+        self.ready = ready
+        self.drain = drain
+        self.interval = interval
+        self._parts = deque()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._closed = False
+        self._cancelled = False
+
+    def put(self, part):
+        """
+            Adds the next **part**, waiting while the pipe is full. Returns
+            False (and drops it) if the consumer gave up.
+        """
+        self._lock.acquire()
+        try:
+            while (len(self._parts) >= self.max_pending 
+                   and not self._cancelled):
+                if self.drain is not None:
+                    self._lock.release()
+                    try:
+                        self.drain(self)
+                    finally:
+                        self._lock.acquire()
+                    if (len(self._parts) < self.max_pending 
+                            or self._cancelled):
+                        break
+                self._changed.wait(self.interval if self.drain else None)
+            if self._cancelled:
+                return False
+            self._parts.append(part)
+            first = len(self._parts) == 1
+            self._changed.notify_all()
+        finally:
+            self._lock.release()
+        if first and self.ready is not None:
+            self.ready()
+        return True
+
+    def close(self):
+        """
+            Tells the consumer that there are no more parts.
+        """
+        self._lock.acquire()
+        try:
+            self._closed = True
+            self._changed.notify_all()
+        finally:
+            self._lock.release()
+        if self.ready is not None:
+            self.ready()
+
+    def cancel(self):
+        """
+            Tells the producer that the parts won't be consumed.
+        """
+        self._lock.acquire()
+        try:
+            self._cancelled = True
+            self._parts.clear()
+            self._changed.notify_all()
+        finally:
+            self._lock.release()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def wait(self, timeout=None):
+        """
+            Waits until there is a part to consume or the pipe is closed.
+        """
+        self._lock.acquire()
+        try:
+            if not self._parts and not self._closed:
+                self._changed.wait(timeout)
+        finally:
+            self._lock.release()
+
+    def __iter__(self):
+        try:
+            while True:
+                self._lock.acquire()
+                try:
+                    if self._parts:
+                        part = self._parts.popleft()
+                        self._changed.notify_all()
+                    elif self._closed:
+                        return
+                    else:
+                        part = None
+                finally:
+                    self._lock.release()
+                yield part
+        finally:
+            self.cancel()
@@ -0,0 +1,120 @@
+"""
+    bjson/table.py
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+from bjsonrpc.jsonlib import register_type
+
+__all__ = [
+    "Table",
+]
+
+
+class Table(object):
+    """
+        List of records stored by columns. It is sent as a *__table__* hint
+        with the field names once and one list per field, instead of
+        repeating every key in every row:
+
+            {"__table__": {"columns": ["id", "name"],
+                           "data": [[1, 2], ["a", "b"]]}}
+
+        Handlers return tables with the *bjsonrpc.handlers.columnar*
+        decorator, or automatically with *Connection.table_min_rows*. The
+        receiver gets a *Table*, which behaves like a read-only list of
+        dictionaries whose rows are only built when they are accessed, and
+        gives direct access to the columns, e.g. for
+        *pandas.DataFrame(table.as_dict())* or *numpy.array(table.column(name))*.
+
+        Parameters:
+
+        **columns**
+            List of the field names.
+
+        **data**
+            List with the values of each field, in the order of **columns**.
+            All of them must have the same length.
+    """
+    def __init__(self, columns, data):
+        assert(len(columns) == len(data))
+        self.columns = list(columns)
+        self._data = list(data)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+            Returns a *Table* with the dictionaries of the list **rows**, or
+            None if they don't all have the same keys (or it is empty).
+        """
+        if not rows or type(rows[0]) is not dict or not rows[0]:
+            return None
+        columns = list(rows[0])
+        width = len(columns)
+        for row in rows:
+            if type(row) is not dict or len(row) != width:
+                return None
+        try:
+            data = [ [ row[name] for row in rows ] for name in columns ]
+        except KeyError:
+            return None
+        return cls(columns, data)
+
+    def column(self, name):
+        """
+            Returns the list of values of the field **name**.
+        """
+        return self._data[self.columns.index(name)]
+
+    def as_dict(self):
+        """
+            Returns a dictionary of field name -> list of values.
+        """
+        return dict(zip(self.columns, self._data))
+
+    def rows(self):
+        """
+            Returns all the rows as a list of dictionaries.
+        """
+        return list(self)
+
+    def __len__(self):
+        if not self._data:
+            return 0
+        return len(self._data[0])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ self[i] for i in range(*index.indices(len(self))) ]
+        return dict([ (name, values[index])
+                      for name, values in zip(self.columns, self._data) ])
+
+    def __iter__(self):
+        columns = self.columns
+        for values in zip(*self._data):
+            yield dict(zip(columns, values))
+
+    def __eq__(self, other):
+        if isinstance(other, Table):
+            return self.as_dict() == other.as_dict()
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "<Table %r, %d rows>" % (self.columns, len(self))
+
+
+def _encode_table(table):
+    return { 'columns' : table.columns, 'data' : table._data }
+
+def _decode_table(value):
+    return Table(value['columns'], value['data'])
+
+register_type(Table, 'table', _encode_table, _decode_table)
@@ -0,0 +1,412 @@
+"""
+    bjson/workers.py
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import importlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+from bjsonrpc.exceptions import ServerBusyError
+
+__all__ = [
+    "WorkerPool",
+    "ConcurrencyLimit",
+    "process_pool",
+    "set_process_pool",
+    "register_process_function",
+    "submit_to_process",
+]
+
+_log = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('block', 'reject', 'inline')
+
+
+class WorkerPool(object):
+    """
+        Bounded pool of threads that run the items dispatched in threaded
+        mode (*bjsonrpc_options['threaded']*), instead of starting a new
+        thread for each one. Threads are started when there is work and no
+        idle thread, up to **max_workers**, and then wait for more work.
+
+        A *bjsonrpc.server.Server* shares one pool between all its
+        connections. Other connections use *WorkerPool.instance()*.
+
+        Parameters:
+
+        **max_workers** = None
+            Maximum number of threads. By default, the number of CPUs plus 4
+            (up to 32).
+
+        **max_queue** = 1024
+            Maximum number of items waiting for a thread, or None for no
+            limit.
+
+        **overflow** = 'block'
+            What *submit* does when the queue is full: 'block' waits for a
+            free place (so the connection that submitted it, and the loop of
+            its *Server*, stop reading), 'reject' raises
+            *bjsonrpc.exceptions.ServerBusyError*, which is sent back as the
+            error of the call, and 'inline' runs the item in the calling
+            thread.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_workers=None, max_queue=1024, overflow='block'):
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        assert(max_workers > 0)
+        assert(overflow in OVERFLOW_POLICIES)
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self._queue = deque() # (function, args, time queued)
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._threads = []
+        self._idle = 0
+        self._busy = 0 # items being run by the threads
+        self._shutdown = False
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.inlined = 0
+        self._max_depth = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @classmethod
+    def instance(cls):
+        """
+            Returns the pool shared by the connections that don't belong to
+            a *Server*, creating it on first use.
+        """
+        cls._instance_lock.acquire()
+        try:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+        finally:
+            cls._instance_lock.release()
+
+    @property
+    def queue_depth(self):
+        """
+            Number of items waiting for a thread.
+        """
+        return len(self._queue)
+
+    def submit(self, function, *args):
+        """
+            Runs *function(\\*args)* in a thread of the pool. If the queue
+            is full, applies the **overflow** policy. Returns False if the
+            function was run in the calling thread.
+        """
+        self._lock.acquire()
+        try:
+            while (not self._shutdown and self.max_queue is not None
+                   and len(self._queue) >= self.max_queue):
+                if self.overflow == 'block':
+                    self._not_full.wait()
+                    continue
+                if self.overflow == 'reject':
+                    self.rejected += 1
+                    raise ServerBusyError("%d items queued" % len(self._queue))
+                self.inlined += 1
+                break
+            else:
+                if self._shutdown:
+                    raise RuntimeError("WorkerPool is shut down")
+                self._queue.append((function, args, time.time()))
+                self.submitted += 1
+                depth = len(self._queue)
+                if depth > self._max_depth:
+                    self._max_depth = depth
+                if self._idle < depth and len(self._threads) < self.max_workers:
+                    self._start_thread()
+                self._not_empty.notify()
+                return True
+        finally:
+            self._lock.release()
+        self._run(function, args)
+        return False
+
+    def _start_thread(self):
+        thread = threading.Thread(target=self._worker,
+            name="bjsonrpc-worker-%d" % (len(self._threads) + 1))
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+
+    def _worker(self):
+        """
+            Runs the queued items until the pool is shut down and the queue
+            is empty.
+        """
+        lock = self._lock
+        while True:
+            lock.acquire()
+            try:
+                self._idle += 1
+                while not self._queue and not self._shutdown:
+                    self._not_empty.wait()
+                self._idle -= 1
+                if not self._queue:
+                    self._threads.remove(threading.current_thread())
+                    return
+                function, args, queued = self._queue.popleft()
+                self._busy += 1
+                wait = time.time() - queued
+                self._wait_total += wait
+                if wait > self._wait_max:
+                    self._wait_max = wait
+                self._not_full.notify()
+            finally:
+                lock.release()
+            self._run(function, args)
+            lock.acquire()
+            try:
+                self._busy -= 1
+                self.completed += 1
+            finally:
+                lock.release()
+
+    def _run(self, function, args):
+        try:
+            function(*args)
+        except Exception:
+            _log.error("Unhandled error in worker: %s", traceback.format_exc())
+
+    def stats(self):
+        """
+            Returns a dictionary with the metrics of the pool:
+
+            **workers**, **busy**
+                Threads started, and how many of them are running an item.
+
+            **queue_depth**, **max_queue_depth**
+                Items waiting for a thread now, and the most there have been.
+
+            **submitted**, **completed**, **rejected**, **inlined**
+                Items queued, finished by the threads, rejected and run in
+                the calling thread because the queue was full.
+
+            **wait_avg**, **wait_max**
+                Average and maximum seconds that the items started have
+                waited in the queue.
+        """
+        self._lock.acquire()
+        try:
+            started = self.submitted - len(self._queue)
+            return {
+                'workers' : len(self._threads),
+                'busy' : self._busy,
+                'queue_depth' : len(self._queue),
+                'max_queue_depth' : self._max_depth,
+                'submitted' : self.submitted,
+                'completed' : self.completed,
+                'rejected' : self.rejected,
+                'inlined' : self.inlined,
+                'wait_avg' : self._wait_total / started if started else 0.0,
+                'wait_max' : self._wait_max,
+            }
+        finally:
+            self._lock.release()
+
+    def shutdown(self, wait=True):
+        """
+            Stops accepting items. The threads exit when the queue is empty;
+            if **wait** is True, waits for them.
+        """
+        self._lock.acquire()
+        try:
+            self._shutdown = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+            threads = list(self._threads)
+        finally:
+            self._lock.release()
+        if wait:
+            for thread in threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
+
+class ConcurrencyLimit(object):
+    """
+        Runs the items submitted through it in a *WorkerPool*, no more than
+        **limit** at a time, and in the order they were submitted. The items
+        over the limit wait here, without taking a thread of the pool: each
+        item runs the next one waiting when it finishes, in the same thread.
+        With a limit of 1 the items are serialized.
+
+        The items waiting are bounded by the *max_queue* of the pool, and
+        its *overflow* policy applies when they reach it: 'reject' raises
+        *bjsonrpc.exceptions.ServerBusyError*, while 'block' (and 'inline',
+        as running the item at once would break the limit) waits for one of
+        them to start.
+
+        Used for the execution policies of handlers (see 
+        *bjsonrpc.handlers.BaseHandler.execution* and 
+        *bjsonrpc.handlers.max_concurrency*). Each one has its own lock, so 
+        unrelated items never wait for each other.
+    """
+    def __init__(self, limit):
+        assert(limit > 0)
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._waiting = deque() # (function, args)
+        self._running = 0
+
+    @property
+    def waiting(self):
+        """
+            Number of items waiting for their turn.
+        """
+        return len(self._waiting)
+
+    def submit(self, pool, function, *args):
+        """
+            Runs *function(\\*args)* in **pool** when there are less than
+            *limit* items running. Raises the errors of *WorkerPool.submit*
+            (e.g. *ServerBusyError*), also when too many items wait here.
+        """
+        self._lock.acquire()
+        try:
+            while self._running >= self.limit:
+                if (pool.max_queue is None 
+                        or len(self._waiting) < pool.max_queue):
+                    self._waiting.append((function, args))
+                    return
+                if pool.overflow == 'reject':
+                    pool._lock.acquire()
+                    try:
+                        pool.rejected += 1
+                    finally:
+                        pool._lock.release()
+                    raise ServerBusyError("%d items waiting" 
+                                          % len(self._waiting))
+                self._not_full.wait()
+            self._running += 1
+        finally:
+            self._lock.release()
+        try:
+            pool.submit(self._run, function, args)
+        except Exception:
+            self._lock.acquire()
+            try:
+                self._running -= 1
+            finally:
+                self._lock.release()
+            raise
+
+    def _run(self, function, args):
+        while True:
+            try:
+                function(*args)
+            except Exception:
+                _log.error("Unhandled error in worker: %s", 
+                           traceback.format_exc())
+            self._lock.acquire()
+            try:
+                if not self._waiting:
+                    self._running -= 1
+                    return
+                function, args = self._waiting.popleft()
+                self._not_full.notify()
+            finally:
+                self._lock.release()
+
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+_process_functions = {} # (module, qualified name) -> function
+
+def process_pool():
+    """
+        Returns the *concurrent.futures.ProcessPoolExecutor* shared by the
+        handler methods decorated with *bjsonrpc.handlers.run_in_process*,
+        creating it on first use (with one process per CPU). A new one is
+        created if a process of the pool died.
+        
+        Its processes are started with 'forkserver' ('spawn' where it 
+        doesn't exist), never forked from this process: it already runs 
+        writer, IOLoop and worker threads, whose locks a forked child could
+        inherit held.
+    """
+    global _process_pool
+    _process_pool_lock.acquire()
+    try:
+        if _process_pool is None or getattr(_process_pool, "_broken", False):
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+            else:
+                context = multiprocessing.get_context("spawn")
+            _process_pool = ProcessPoolExecutor(mp_context=context)
+        return _process_pool
+    finally:
+        _process_pool_lock.release()
+
+def set_process_pool(executor):
+    """
+        Replaces the shared process pool with **executor**, e.g. to choose
+        its number of processes or its *mp_context*. The previous one is 
+        shut down (without waiting for it).
+    """
+    global _process_pool
+    _process_pool_lock.acquire()
+    try:
+        old, _process_pool = _process_pool, executor
+    finally:
+        _process_pool_lock.release()
+    if old is not None and old is not executor:
+        old.shutdown(wait=False)
+
+def register_process_function(function):
+    """
+        Registers **function** to be called by *submit_to_process*. The 
+        functions are sent to the pool by name, and looked up in this 
+        registry in the process that runs them, which imports their module
+        by name. So they must be registered when their module is imported,
+        e.g. by a decorator, and be reachable by module and qualified name:
+        not defined inside a function, nor in the script run as 
+        *__main__*.
+    """
+    key = (function.__module__, function.__qualname__)
+    if key[0] == "__main__" or "<locals>" in key[1]:
+        raise ValueError("%s.%s can't be imported by the process pool" % key)
+    _process_functions[key] = function
+    return key
+
+def submit_to_process(function, args=(), kwargs=None):
+    """
+        Runs *function(\\*args, \\*\\*kwargs)* in the shared process pool and 
+        returns its *concurrent.futures.Future*. The arguments and the 
+        result must be picklable.
+    """
+    key = register_process_function(function)
+    return process_pool().submit(_call_process_function, key, tuple(args),
+                                 kwargs or {})
+
+def _call_process_function(key, args, kwargs):
+    function = _process_functions.get(key)
+    if function is None:
+        importlib.import_module(key[0])
+        function = _process_functions[key]
+    return function(*args, **kwargs)
@@ -0,0 +1,68 @@
+"""
+    benchmark-codecs.py
+
+    Compares the encode and decode time of every codec installed in
+    bjsonrpc.jsonlib on typical bjsonrpc messages.
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+from __future__ import print_function
+import sys
+sys.path.insert(0,"../") # prefer local version
+import socket
+import time
+
+from bjsonrpc.connection import Connection
+from bjsonrpc.handlers import BaseHandler, NullHandler
+import bjsonrpc.jsonlib as json
+
+ROUNDS = 2000
+
+class Item(BaseHandler):
+    def value(self):
+        return 1
+
+def messages(conn):
+    records = [ {"id": i, "name": "item %d" % i, "price": i * 1.25,
+                 "tags": ["a", "b"], "active": i % 2 == 0}
+                for i in range(100) ]
+    return [
+        ("call", {"method": "getabc", "params": [1, "text", [1, 2, 3]],
+                  "id": 17}),
+        ("response 100 records", {"result": records, "error": None, "id": 17}),
+        ("response 20 objects", {"result": [ Item(conn) for i in range(20) ],
+                                 "error": None, "id": 17}),
+    ]
+
+def timeit(function, *args):
+    start = time.time()
+    for i in range(ROUNDS):
+        function(*args)
+    return (time.time() - start) * 1e6 / ROUNDS
+
+def benchmark():
+    sck, peer = socket.socketpair()
+    conn = Connection(sck, handler_factory=NullHandler)
+    try:
+        print("%-22s %-8s %10s %10s %8s" %
+              ("message", "codec", "dumps us", "loads us", "bytes"))
+        for label, msg in messages(conn):
+            for name in sorted(json.codecs):
+                conn.set_codec(name)
+                data = json.dumps(msg, conn)
+                dumps = timeit(json.dumps, msg, conn)
+                loads = timeit(json.loads, data, conn)
+                print("%-22s %-8s %10.1f %10.1f %8d" %
+                      (label, name, dumps, loads, len(data)))
+            print()
+    finally:
+        conn.close()
+        peer.close()
+
+benchmark()
@@ -0,0 +1,78 @@
+"""
+    benchmark-hints.py
+
+    Measures the cost of the class hinting hooks (Connection.load_object and
+    Connection.dump_object) on deeply nested payloads with many dicts.
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+from __future__ import print_function
+import sys
+sys.path.insert(0,"../") # prefer local version
+from decimal import Decimal
+import socket
+import time
+
+from bjsonrpc.connection import Connection
+from bjsonrpc.handlers import BaseHandler, NullHandler
+import bjsonrpc.jsonlib as json
+
+ROUNDS = 20
+
+class Item(BaseHandler):
+    pass
+
+def nested(depth, width):
+    """ Plain data: a tree of dicts with *width* children per level """
+    if depth == 0:
+        return {"value": 1, "name": "leaf"}
+    return {"level": depth, "children": [ nested(depth - 1, width)
+                                          for i in range(width) ]}
+
+def timeit(function, *args):
+    """ Best time of ROUNDS runs, in milliseconds """
+    best = None
+    for i in range(ROUNDS):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e3
+
+def benchmark():
+    sck, peer = socket.socketpair()
+    conn = Connection(sck, handler_factory=NullHandler)
+    try:
+        tree = nested(6, 5)
+        data = json.dumps(tree, conn)
+        ndicts = data.count("{")
+        print("load_object: %d plain dicts     %8.2f ms" %
+              (ndicts, timeit(lambda: [ conn.load_object(d)
+                                         for d in [{"a": 1, "b": 2}] * ndicts ])))
+        print("loads:       %d plain dicts     %8.2f ms" %
+              (ndicts, timeit(json.loads, data, conn)))
+
+        items = [ Item(conn) for i in range(1000) ]
+        json.dumps(items, conn) # register them
+        print("dump_object: %d handlers        %8.2f ms" %
+              (len(items), timeit(lambda: [ conn.dump_object(v)
+                                            for v in items ])))
+        decimals = [ Decimal("1.5") ] * 1000
+        print("dump_object: %d decimals        %8.2f ms" %
+              (len(decimals), timeit(lambda: [ conn.dump_object(v)
+                                               for v in decimals ])))
+        hinted = json.dumps(items, conn)
+        print("loads:       %d hinted objects  %8.2f ms" %
+              (len(items), timeit(json.loads, hinted, conn)))
+    finally:
+        conn.close()
+        peer.close()
+
+benchmark()
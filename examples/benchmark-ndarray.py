@@ -0,0 +1,69 @@
+"""
+    benchmark-ndarray.py
+
+    Compares sending NumPy arrays with the __ndarray__ hint against the
+    list of floats produced by ndarray.tolist(), with the JSON and msgpack
+    codecs.
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+from __future__ import print_function
+import sys
+sys.path.insert(0,"../") # prefer local version
+import socket
+import time
+
+try:
+    import numpy
+except ImportError:
+    print("This benchmark requires numpy.")
+    sys.exit(1)
+
+from bjsonrpc.connection import Connection
+from bjsonrpc.handlers import NullHandler
+import bjsonrpc.jsonlib as json
+
+ROUNDS = 20
+
+def timeit(function, *args):
+    """ Best time of ROUNDS runs, in milliseconds """
+    best = None
+    for i in range(ROUNDS):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e3
+
+def benchmark():
+    sck, peer = socket.socketpair()
+    conn = Connection(sck, handler_factory=NullHandler)
+    try:
+        print("%-10s %-8s %-10s %10s %10s %10s" %
+              ("array", "codec", "mode", "dumps ms", "loads ms", "bytes"))
+        for shape in [(1000,), (100000,), (480, 640)]:
+            array = numpy.random.random(shape)
+            for codec in ("json", "msgpack"):
+                conn.set_codec(codec)
+                for mode, value in (("tolist", array.tolist()),
+                                    ("ndarray", array)):
+                    msg = {"result": value, "error": None, "id": 1}
+                    data = json.dumps(msg, conn)
+                    dumps = timeit(json.dumps, msg, conn)
+                    loads = timeit(json.loads, data, conn)
+                    print("%-10s %-8s %-10s %10.2f %10.2f %10d" %
+                          ("x".join(map(str, shape)), codec, mode,
+                           dumps, loads, len(data)))
+            print()
+    finally:
+        conn.close()
+        peer.close()
+
+benchmark()
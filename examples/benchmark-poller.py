@@ -0,0 +1,84 @@
+"""
+    benchmark-poller.py
+
+    Measures the cost of one server wakeup with many idle connections for
+    each poller backend available in bjsonrpc.pollers.
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+from __future__ import print_function
+import sys
+sys.path.insert(0,"../") # prefer local version
+import socket
+import time
+
+from bjsonrpc.pollers import READ, SelectPoller, SelectorsPoller, selectors
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROUNDS = 2000
+
+def raise_fd_limit(wanted):
+    if resource is None: return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft >= wanted: return
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+def wakeup_cost(poller_class, idle):
+    """
+        Registers *idle* sockets that never become ready plus one active
+        socket, and returns the mean time in microseconds to wake up for
+        the active one.
+    """
+    pairs = []
+    poller = poller_class()
+    try:
+        for i in range(idle):
+            a, b = socket.socketpair()
+            pairs.append((a, b))
+            poller.register(a, READ)
+        active, peer = socket.socketpair()
+        pairs.append((active, peer))
+        poller.register(active, READ)
+
+        start = time.time()
+        for i in range(ROUNDS):
+            peer.send(b'x')
+            ready = poller.poll(1)
+            assert(ready[0][0] is active)
+            active.recv(1)
+        return (time.time() - start) * 1e6 / ROUNDS
+    finally:
+        poller.close()
+        for a, b in pairs:
+            a.close()
+            b.close()
+
+def benchmark():
+    raise_fd_limit(2 * 10000 + 100)
+    backends = [("select", SelectPoller)]
+    if selectors is not None:
+        backends.append(("%s" % selectors.DefaultSelector.__name__, SelectorsPoller))
+
+    for idle in (100, 1000, 10000):
+        for name, poller_class in backends:
+            try:
+                cost = wakeup_cost(poller_class, idle)
+            except (ValueError, OSError) as exc:
+                # select() can't watch descriptors over FD_SETSIZE.
+                print("%6d idle  %-16s unsupported (%s)" % (idle, name, exc))
+                continue
+            print("%6d idle  %-16s %8.1f us/wakeup" % (idle, name, cost))
+
+benchmark()
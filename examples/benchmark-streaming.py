@@ -0,0 +1,132 @@
+"""
+    benchmark-streaming.py
+
+    Time and peak memory of the client to receive a large result: buffering
+    the whole message first, decoding it while it arrives
+    (Connection.stream_threshold), and iterating it with the stream proxy
+    without keeping the rows. The server runs in a child process.
+
+    Then, the time to the first row and the peak memory of the server to
+    send it: built as a list, and produced by a @streamed generator.
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+from __future__ import print_function
+import sys
+sys.path.insert(0,"../") # prefer local version
+import gc
+import multiprocessing
+import socket
+import time
+import tracemalloc
+
+from bjsonrpc.connection import Connection
+from bjsonrpc.handlers import BaseHandler, NullHandler, streamed
+from bjsonrpc.exceptions import EofError
+
+ROWS = 200000
+
+class Handler(BaseHandler):
+    def rows(self, count):
+        return [ {"id": i, "name": "row %d" % i, "value": i * 0.5,
+                  "tags": ["a", "b"]} for i in range(count) ]
+
+    @streamed
+    def streamrows(self, count):
+        for i in range(count):
+            yield {"id": i, "name": "row %d" % i, "value": i * 0.5,
+                   "tags": ["a", "b"]}
+
+def serve(sck, queue=None):
+    if queue is not None:
+        tracemalloc.start()
+    conn = Connection(sck, handler_factory=Handler)
+    try:
+        conn.serve()
+    except EofError:
+        pass
+    if queue is not None:
+        queue.put(tracemalloc.get_traced_memory()[1])
+
+def buffered(conn):
+    return conn.call.rows(ROWS)
+
+def streamed(conn):
+    conn.stream_threshold = 1 << 20
+    return conn.call.rows(ROWS)
+
+def iterated(conn):
+    conn.stream_threshold = 1 << 20
+    count = 0
+    for row in conn.stream.rows(ROWS):
+        count += 1
+    return count
+
+def measure(function, trace):
+    sck, peer = socket.socketpair()
+    server = multiprocessing.Process(target=serve, args=(peer,))
+    server.start()
+    peer.close()
+    conn = Connection(sck, handler_factory=NullHandler)
+    gc.collect()
+    if trace:
+        tracemalloc.start()
+    start = time.time()
+    result = function(conn)
+    elapsed = time.time() - start
+    peak = kept = 0
+    if trace:
+        kept, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    del result
+    conn.close()
+    server.join(5)
+    return elapsed, peak, kept
+
+def measure_server(method, trace):
+    sck, peer = socket.socketpair()
+    queue = multiprocessing.Queue() if trace else None
+    server = multiprocessing.Process(target=serve, args=(peer, queue))
+    server.start()
+    peer.close()
+    conn = Connection(sck, handler_factory=NullHandler)
+    conn.stream_threshold = 1 << 20
+    start = time.time()
+    rows = iter(getattr(conn.stream, method)(ROWS))
+    next(rows)
+    first = time.time() - start
+    for row in rows:
+        pass
+    elapsed = time.time() - start
+    conn.close()
+    peak = queue.get(timeout=10) if trace else 0
+    server.join(5)
+    return first, elapsed, peak
+
+def benchmark():
+    print("%d rows" % ROWS)
+    print("%-24s %8s %10s %10s" % ("mode", "time s", "peak MB", "kept MB"))
+    for name, function in (("buffered", buffered),
+                           ("stream_threshold", streamed),
+                           ("stream proxy, iterated", iterated)):
+        elapsed = min([ measure(function, False)[0] for i in range(3) ])
+        peak, kept = measure(function, True)[1:]
+        print("%-24s %8.2f %10.1f %10.1f" %
+              (name, elapsed, peak / 1e6, kept / 1e6))
+    print()
+    print("%-24s %8s %8s %16s" % ("server", "first s", "time s", 
+                                  "server peak MB"))
+    for name, method in (("list", "rows"), ("@streamed", "streamrows")):
+        first, elapsed = min([ measure_server(method, False)[:2] 
+                               for i in range(3) ])
+        peak = measure_server(method, True)[2]
+        print("%-24s %8.2f %8.2f %16.1f" % (name, first, elapsed, peak / 1e6))
+
+if __name__ == "__main__":
+    benchmark()
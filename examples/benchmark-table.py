@@ -0,0 +1,68 @@
+"""
+    benchmark-table.py
+
+    Compares sending a large list of records as rows (a list of dicts) and
+    as a columnar bjsonrpc.table.Table, with every codec installed.
+
+    Copyright (c) 2010 David Martinez Marti
+    All rights reserved.
+
+    Licensed under 3-clause BSD License.
+    See LICENSE for the full license text.
+
+"""
+
+from __future__ import print_function
+import sys
+sys.path.insert(0,"../") # prefer local version
+import socket
+import time
+
+from bjsonrpc.connection import Connection
+from bjsonrpc.handlers import NullHandler
+from bjsonrpc.table import Table
+import bjsonrpc.jsonlib as json
+
+ROUNDS = 10
+ROWS = 20000
+
+def timeit(function, *args):
+    """ Best time of ROUNDS runs, in milliseconds """
+    best = None
+    for i in range(ROUNDS):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e3
+
+def benchmark():
+    sck, peer = socket.socketpair()
+    conn = Connection(sck, handler_factory=NullHandler)
+    rows = [ {"id": i, "name": "item %d" % i, "ts": 1262304000.0 + i,
+              "active": i % 3 == 0} for i in range(ROWS) ]
+    try:
+        print("%-8s %-6s %10s %10s %10s" %
+              ("codec", "mode", "dumps ms", "loads ms", "bytes"))
+        for codec in sorted(json.codecs):
+            conn.set_codec(codec)
+            for mode, value in (("rows", rows),
+                                ("table", Table.from_rows(rows))):
+                msg = {"result": value, "error": None, "id": 1}
+                data = json.dumps(msg, conn)
+                dumps = timeit(json.dumps, msg, conn)
+                loads = timeit(json.loads, data, conn)
+                print("%-8s %-6s %10.2f %10.2f %10d" %
+                      (codec, mode, dumps, loads, len(data)))
+        print()
+        table = Table.from_rows(rows)
+        print("Table.from_rows:            %8.2f ms" %
+              timeit(Table.from_rows, rows))
+        print("iterate all the table rows: %8.2f ms" %
+              timeit(lambda: [ row for row in table ]))
+    finally:
+        conn.close()
+        peer.close()
+
+benchmark()
@@ -48,9 +48,9 @@ class MyHandler(BaseHandler):
 
 
 
-conn = bjsonrpc.connect(host="127.0.0.1",port=10123,handler_factory=MyHandler)
+UNIX_PATH = "/tmp/bjsonrpc-example1.sock" # see example1-server.py
 
-def benchmark():
+def benchmark(conn):
     print(conn.call.echo('Hello World!'))
     total = 0
     count = 0
@@ -95,7 +95,25 @@ def benchmark():
     print("Call Total: %.2fs   %.2f reg/s" % (lapse, valuecount/lapse))
     
 
+def roundtrip(conn, valuecount = 5000):
+    """ Returns the mean time of a synchronous call in microseconds """
+    start = time.time()
+    for i in range(valuecount):
+        conn.call.getrandom()
+    return (time.time() - start) * 1e6 / valuecount
     
 
-benchmark()
+transports = [
+    ("TCP", bjsonrpc.connect(host="127.0.0.1",port=10123,handler_factory=MyHandler)),
+    ("UDS", bjsonrpc.connect(path=UNIX_PATH,handler_factory=MyHandler)),
+    ]
+results = []
+for name, conn in transports:
+    print("*** %s ***" % name)
+    benchmark(conn)
+    results.append((name, roundtrip(conn)))
+    
+print()
+for name, lapse in results:
+    print("%s round-trip: %.1f us/call" % (name, lapse))
 
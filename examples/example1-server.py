@@ -150,4 +150,11 @@ s = bjsonrpc.createserver(handler_factory=MyHandler._factory(domain="yourdomain-
 s.debug_socket(True)
 threading.Thread(target=thread1).start()
 
+# Same handler over a Unix domain socket, to compare with TCP in example1-client.py
+UNIX_PATH = "/tmp/bjsonrpc-example1.sock"
+u = bjsonrpc.createserver(handler_factory=MyHandler._factory(domain="yourdomain-dot-com"), path = UNIX_PATH)
+uthread = threading.Thread(target=u.serve)
+uthread.daemon = True
+uthread.start()
+
 s.serve()
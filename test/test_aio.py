@@ -0,0 +1,208 @@
+import unittest
+import sys
+sys.path.insert(0, "../")
+import asyncio
+import bjsonrpc
+import bjsonrpc.aio
+import json
+import os
+from bjsonrpc.handlers import BaseHandler, run_in_process
+from bjsonrpc.exceptions import ServerError
+
+
+class MyList(BaseHandler):
+    def _setup(self):
+        self._list = []
+
+    def add(self, item):
+        self._list.append(item)
+
+    def items(self):
+        return self._list
+
+
+class AsyncServerHandler(BaseHandler):
+    def ping(self):
+        return "pong"
+
+    async def slowecho(self, value, delay):
+        await asyncio.sleep(delay)
+        return value
+
+    async def countdown(self, n):
+        for i in range(n, 0, -1):
+            yield i
+
+    def newList(self):
+        return MyList(self)
+
+    def failure(self):
+        raise ValueError("expected failure")
+
+    @run_in_process
+    def getpid():
+        return os.getpid()
+
+
+class TestAsyncio(unittest.TestCase):
+    def run_client(self, client):
+        """
+            Runs the coroutine function *client(conn)* against a fresh server.
+        """
+        async def main():
+            server = await bjsonrpc.aio.createserver(port=0,
+                handler_factory=AsyncServerHandler)
+            port = server.sockets[0].getsockname()[1]
+            conn = await bjsonrpc.aio.connect(port=port)
+            try:
+                return await client(conn)
+            finally:
+                await conn.aclose()
+                server.stop()
+        return asyncio.run(main())
+
+    def test_call(self):
+        async def client(conn):
+            return await conn.call.ping()
+        self.assertEqual(self.run_client(client), "pong")
+
+    def test_concurrent_methods(self):
+        """
+            Many in-flight calls to a coroutine handler, answered out of order
+        """
+        async def client(conn):
+            reqs = [ conn.method.slowecho(i, (100 - i) * 0.001)
+                     for i in range(100) ]
+            return await asyncio.gather(*reqs)
+        self.assertEqual(self.run_client(client), list(range(100)))
+
+    def test_pipe(self):
+        async def client(conn):
+            result = []
+            pipe = conn.pipe.countdown(3)
+            async for value in pipe:
+                result.append(value)
+                if value == 1: break
+            pipe.close()
+            return result
+        self.assertEqual(self.run_client(client), [3, 2, 1])
+
+    def test_remote_object(self):
+        async def client(conn):
+            mylist = await conn.call.newList()
+            mylist.notify.add(1)
+            await mylist.call.add(2)
+            return await mylist.call.items()
+        self.assertEqual(self.run_client(client), [1, 2])
+
+    def test_run_in_process(self):
+        async def client(conn):
+            return await conn.call.getpid()
+        self.assertNotEqual(self.run_client(client), os.getpid())
+
+    def test_blocking(self):
+        """
+            Blocking methods of Connection raise a clear error
+        """
+        async def client(conn):
+            for method, args in ((conn.read_and_dispatch, ()), 
+                                 (conn.dispatch_until_empty, ()),
+                                 (conn.write_line, ("{}",))):
+                try:
+                    method(*args)
+                except TypeError as exc:
+                    self.assertTrue("event loop" in str(exc))
+                else:
+                    self.fail("TypeError not raised")
+            self.assertFalse(conn.reads_in_background())
+            return await conn.call.ping()
+        self.assertEqual(self.run_client(client), "pong")
+
+    def test_error(self):
+        async def client(conn):
+            try:
+                await conn.call.failure()
+            except ServerError as exc:
+                return str(exc)
+        self.assertTrue("expected failure" in self.run_client(client))
+
+    def test_promise(self):
+        """
+            Calls of the promise proxy are refused with an error
+        """
+        def client(port):
+            conn = bjsonrpc.connect(port=port)
+            try:
+                request = conn.promise.ping()
+                return request.exception(5), conn.call.ping()
+            finally:
+                conn.close()
+        async def main():
+            server = await bjsonrpc.aio.createserver(port=0,
+                handler_factory=AsyncServerHandler)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, client, port)
+            finally:
+                server.stop()
+        error, pong = asyncio.run(main())
+        self.assertTrue("not supported" in str(error))
+        self.assertEqual(pong, "pong")
+
+    def test_max_frame_size(self):
+        """
+            A line longer than max_frame_size closes the connection
+        """
+        async def main():
+            server = await bjsonrpc.aio.createserver(port=0,
+                handler_factory=AsyncServerHandler, max_frame_size=100)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection(port=port)
+            try:
+                writer.write(b'{"method":"ping","id":1}\n')
+                pong = json.loads(await reader.readline())
+                writer.write(b'[' + b'1,' * 200)
+                return pong, await asyncio.wait_for(reader.read(), 5)
+            finally:
+                writer.close()
+                server.stop()
+        pong, rest = asyncio.run(main())
+        self.assertEqual(pong['result'], "pong")
+        self.assertEqual(rest, b'')
+
+    def test_batch(self):
+        """
+            The responses to a batch are sent together, in one message;
+            maps of methods that are not coroutines work too
+        """
+        async def main():
+            server = await bjsonrpc.aio.createserver(port=0,
+                handler_factory=AsyncServerHandler)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection(port=port)
+            try:
+                writer.write(b'[{"method":"slowecho","params":[1,0.05],"id":1},'
+                             b'{"method":"ping"},{"method":"failure","id":2},'
+                             b'{"method":"ping","id":3}]\n'
+                             b'{"method":"__map__","id":4,'
+                             b'"params":["ping",2,[]]}\n')
+                replies = [ json.loads(await reader.readline()) 
+                            for i in range(2) ]
+                replies.sort(key=lambda reply: type(reply) is list)
+                return replies[1] + [ replies[0] ]
+            finally:
+                writer.close()
+                server.stop()
+        reply = asyncio.run(main())
+        self.assertEqual(reply.pop(), {"id": 4, "result": ["pong"] * 2, 
+                                       "error": None})
+        reply.sort(key=lambda response: response['id'])
+        self.assertEqual([ response['id'] for response in reply ], [1, 2, 3])
+        self.assertEqual(reply[0]['result'], 1)
+        self.assertTrue("expected failure" in reply[1]['error'])
+        self.assertEqual(reply[2]['result'], "pong")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,26 @@ import unittest
 import sys
 sys.path.insert(0, "../")
 import bjsonrpc
-from bjsonrpc.exceptions import ServerError
+from bjsonrpc.exceptions import ServerError, EofError, ServerBusyError
 
 import testserver1
 import math
+import datetime
+import decimal
+import uuid
+from concurrent import futures
+try:
+    import numpy
+except ImportError:
+    numpy = None
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+from bjsonrpc import pollers, compression, msgpacklib, streaming, workers
 
 class TestJSONBasics(unittest.TestCase):
     def setUp(self):
@@ -34,6 +50,22 @@ class TestJSONBasics(unittest.TestCase):
             pong = rcall.ping()
             self.assertEqual(pong, "pong", "Server MUST return 'pong' when ping is called")
     
+    def test_partial_message(self):
+        """
+            A client that sends part of a message doesn't delay the others
+        """
+        sck = socket.socket(self.conn.socket.family)
+        self.addCleanup(sck.close)
+        sck.settimeout(5)
+        sck.connect(self.conn.socket.getpeername())
+        sck.sendall(b'{"method":"ping","id":1')
+        time.sleep(0.1)
+        start = time.time()
+        self.assertEqual(self.conn.call.ping(), "pong")
+        self.assertTrue(time.time() - start < 1)
+        sck.sendall(b'}\n')
+        self.assertTrue(b'"pong"' in sck.recv(1024))
+    
     def test_call2params(self):
         """
             Call to remote with 2 parameters
@@ -158,10 +190,1573 @@ class TestJSONBasics(unittest.TestCase):
         self.assertEqual(result, check, "Server FAILED to pipe result back")
         presult.close()
 
+    def test_remote_object(self):
+        """
+            Methods of objects returned by the server can be called
+        """
+        mylist = self.conn.call.newList()
+        mylist.notify.add(1)
+        mylist.call.add(2)
+        self.assertEqual(mylist.call.items(), [1, 2])
+        mylist.close()
+        self.assertEqual(self.conn.call.ping(), "pong")
+        
+    def test_request(self):
+        """
+            Requests have the interface of a concurrent.futures.Future
+        """
+        request = self.conn.method.add2(1, 2)
+        self.assertFalse(hasattr(request, "__dict__"))
+        done = []
+        request.add_done_callback(done.append)
+        self.assertEqual(request.result(5), 3)
+        self.assertEqual(request.value, 3) # not consumed
+        self.assertTrue(request.done())
+        self.assertEqual(request.exception(), None)
+        self.assertEqual(done, [request])
+        request.add_done_callback(done.append)
+        self.assertEqual(done, [request, request])
+        self.assertTrue(request.future.result() == 3)
+        
+        request = self.conn.method.add2(1, None)
+        self.assertTrue(isinstance(request.exception(), ServerError))
+        self.assertRaises(ServerError, request.future.result)
+        
+    def test_batch(self):
+        """
+            Calls sent in a batch get their responses
+        """
+        with self.conn.batch() as batch:
+            requests = [ batch.method.add2(i, 1) for i in range(50) ]
+            pong = batch.call.ping()
+            batch.notify.ping()
+            failure = batch.method.add2(1, None)
+            self.assertFalse(pong.done())
+        self.assertEqual([ request.value for request in requests ], 
+                         list(range(1, 51)))
+        self.assertEqual(pong.value, "pong")
+        self.assertRaises(ServerError, lambda: failure.value)
+        self.assertEqual(batch.requests, requests + [pong, failure])
+        
+        with self.conn.batch() as batch:
+            batch.notify.ping()
+        self.assertEqual(self.conn.call.ping(), "pong")
+        
+    def test_map(self):
+        """
+            Call a method for each element of an iterable, in chunks
+        """
+        results = self.conn.map.add2(((i, 1) for i in range(2500)), 
+                                     chunk_size=1000)
+        self.assertEqual(list(results), list(range(1, 2501)))
+        self.assertEqual(list(self.conn.map.getabc([1, [2]])), 
+                         [[1, None, None], [[2], None, None]])
+        self.assertEqual(list(self.conn.map.ping([(), ()])), ["pong"] * 2)
+        self.assertEqual(list(self.conn.map.ping([])), [])
+        
+        mylist = self.conn.call.newList()
+        self.assertEqual(list(mylist.map.add(range(5), chunk_size=2)), 
+                         [None] * 5)
+        self.assertEqual(mylist.call.items(), list(range(5)))
+        mylist.close()
+        
+    def test_map_error(self):
+        """
+            The results before the call that failed, then its error
+        """
+        results = self.conn.map.add2([(1, 2), (1, None), (3, 4)], 
+                                     chunk_size=2)
+        self.assertEqual(next(results), 3)
+        self.assertRaises(ServerError, next, results)
+        self.assertRaises(ValueError, self.conn.map.add2, [(1, 2), (1,)])
+        self.assertRaises(ServerError, list, self.conn.map.pipe([[1]]))
+        self.assertEqual(self.conn.call.ping(), "pong")
+        
+    def test_promise(self):
+        """
+            The result of a call is used by the next ones before it arrives
+        """
+        mylist = self.conn.promise.newList()
+        mylist.notify.add(5)
+        mylist.method.add(6)
+        self.assertEqual(mylist.call.items(), [5, 6])
+        self.assertEqual(mylist.value.call.items(), [5, 6])
+        self.assertEqual(self.conn.promise.newList().call.items(), [])
+        
+        total = self.conn.promise.add2(2, 3)
+        self.assertEqual(self.conn.call.add2(total, 10), 15)
+        self.assertEqual(self.conn.call.getabc(b=[total, {"x" : total}]),
+                         [None, [5, {"x" : 5}], None])
+        double = self.conn.promise.add2(total, total)
+        self.assertEqual(self.conn.call.add2(double, 1), 11)
+        self.assertEqual(total.value, 5)
+        
+    def test_promise_error(self):
+        """
+            The calls that depend on a failed call fail too
+        """
+        failed = self.conn.promise.add2(1, None)
+        self.assertRaises(ServerError, self.conn.call.add2, failed, 1)
+        dependent = self.conn.promise.add2(failed, 1)
+        self.assertRaises(ServerError, self.conn.call.add2, dependent, 1)
+        self.assertRaises(ServerError, lambda: failed.value)
+        number = self.conn.promise.add2(1, 2)
+        self.assertRaises(ServerError, number.call.add, 1)
+        number.release()
+        self.assertRaises(ValueError, lambda: number.call)
+        self.assertEqual(self.conn.call.ping(), "pong")
+        
+    def test_batch_abort(self):
+        """
+            A batch is not sent if its block raises an exception
+        """
+        try:
+            with self.conn.batch() as batch:
+                request = batch.method.ping()
+                raise KeyError("x")
+        except KeyError:
+            pass
+        self.assertRaises(ServerError, lambda: request.value)
+        self.assertRaises(ValueError, batch.method.ping)
+        self.assertEqual(self.conn.call.ping(), "pong")
+        
+    def test_batch_unencodable(self):
+        """
+            A batch that can't be encoded fails its requests
+        """
+        batch = self.conn.batch()
+        request = batch.method.ping()
+        batch.method.add2(object(), 1)
+        self.assertRaises(TypeError, batch.send)
+        self.assertFalse(self.conn._requests)
+        self.assertRaises(ServerError, lambda: request.value)
+        self.assertEqual(self.conn.call.ping(), "pong")
+        
+    def test_request_timeout(self):
+        request = self.conn.method.limited(0.2)
+        self.assertRaises(futures.TimeoutError, request.result, 0.01)
+        self.assertFalse(request.wait(0.01))
+        self.assertTrue(request.wait())
+
          
         
         
 
+    def test_table(self):
+        """
+            Columnar results arrive as a Table that behaves as the rows
+        """
+        rows = [ {"id": i, "name": "row %d" % i} for i in range(50) ]
+        table = self.conn.call.records(50)
+        self.assertTrue(isinstance(table, bjsonrpc.table.Table))
+        self.assertEqual(table, rows)
+        self.assertEqual(len(table), 50)
+        self.assertEqual(table[3], rows[3])
+        self.assertEqual(table[-2:], rows[-2:])
+        self.assertEqual(table.column("id"), list(range(50)))
+        self.assertEqual(self.conn.call.records(0), [])
+
+    def test_run_in_process(self):
+        """
+            @run_in_process methods run in another process, without 
+            blocking the other calls
+        """
+        request = self.conn.method.squares(2000000)
+        self.assertEqual(self.conn.call.ping(), "pong")
+        pid, total = request.value
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(total, sum([ i * i for i in range(2000000) ]))
+        self.assertRaises(ServerError, self.conn.call.squares, -1)
+        self.assertEqual(self.conn.call.squares(3)[1], 5)
+        
+    def test_streamed(self):
+        """
+            Results of @streamed handlers arrive as a list, also with errors
+        """
+        rows = [ {"id": i, "name": "row %d" % i} for i in range(20000) ]
+        self.assertEqual(self.conn.call.streamrows(20000), rows)
+        self.assertEqual(self.conn.call.streamrows(0), [])
+        self.assertRaises(ServerError, self.conn.call.streamrows, 10, 
+                          fail=True)
+        self.assertEqual(self.conn.call.ping(), "pong")
+        
+    def test_streamed_unlocked(self):
+        """
+            Values of @streamed handlers aren't produced by the writer
+        """
+        self.assertEqual(self.conn.call.streamlocked(2000), [False] * 2000)
+        
+        
+
+
+class TestJSONBasicsIOLoop(TestJSONBasics):
+    """
+        Same tests, with buffered writes driven by the server loop and the
+        shared client I/O thread instead of a writer thread per connection.
+    """
+    def setUp(self):
+        bjsonrpc.bjsonrpc_options['write_mode'] = 'ioloop'
+        TestJSONBasics.setUp(self)
+        
+    def tearDown(self):
+        TestJSONBasics.tearDown(self)
+        bjsonrpc.bjsonrpc_options['write_mode'] = 'thread'
+        
+    def test_no_write_thread(self):
+        self.assertFalse(hasattr(self.conn, "write_thread_queue"))
+        
+    def test_large_message(self):
+        """
+            Messages bigger than the socket buffers need several flushes
+        """
+        data = ["x" * 1000] * 5000
+        result = self.conn.call.pipe([data])
+        self.assertEqual(result, data)
+
+
+class TestIOLoop(unittest.TestCase):
+    def setUp(self):
+        self.loop = bjsonrpc.ioloop.IOLoop()
+        self.addCleanup(self.loop.close)
+        
+    def call_from_thread(self):
+        """
+            Calls the loop from a new thread. Returns the list where the 
+            thread that ran the call is appended, and the calling thread.
+        """
+        ran = []
+        thread = threading.Thread(target=self.loop._call, 
+            args=(lambda: ran.append(threading.current_thread()),))
+        thread.start()
+        thread.join(5)
+        return ran, thread
+        
+    def test_queue_from_other_threads(self):
+        """
+            Changes requested from other threads run in the loop thread
+        """
+        self.loop.attach()
+        ran, thread = self.call_from_thread()
+        self.assertEqual(ran, [])
+        self.loop.run_once(0)
+        self.assertEqual(ran, [threading.current_thread()])
+        
+    def test_start(self):
+        """
+            Changes requested before the loop thread polls are queued too
+        """
+        loop_thread = self.loop.start()
+        self.addCleanup(loop_thread.join, 5)
+        self.addCleanup(self.loop.stop)
+        ran, thread = self.call_from_thread()
+        for i in range(100):
+            if ran: break
+            time.sleep(0.01)
+        self.assertEqual(ran, [loop_thread])
+        
+    def test_not_running(self):
+        ran, thread = self.call_from_thread()
+        self.assertEqual(ran, [thread])
+
+
+class TestJSONBasicsThreaded(TestJSONBasics):
+    """
+        Same tests, with the calls dispatched by the worker pool of the 
+        server.
+    """
+    def setUp(self):
+        bjsonrpc.bjsonrpc_options['threaded'] = True
+        TestJSONBasics.setUp(self)
+        
+    def tearDown(self):
+        TestJSONBasics.tearDown(self)
+        bjsonrpc.bjsonrpc_options['threaded'] = False
+        
+    def test_worker_pool(self):
+        for i in range(20):
+            self.assertEqual(self.conn.call.add2(i, 1), i + 1)
+        stats = testserver1.server.worker_pool.stats()
+        self.assertTrue(stats['submitted'] >= 20)
+        self.assertTrue(1 <= stats['workers'] <= 
+                        testserver1.server.worker_pool.max_workers)
+        
+    def test_ordered(self):
+        """
+            Calls to an 'ordered' object run in the order they were sent
+        """
+        mylist = self.conn.call.newOrderedList()
+        for i in range(30):
+            mylist.notify.add(i)
+        self.assertEqual(mylist.call.items(), list(range(30)))
+        mylist.close()
+        
+    def test_max_concurrency(self):
+        requests = [ self.conn.method.limited(0.05) for i in range(6) ]
+        results = [ request.value for request in requests ]
+        self.assertEqual(max(results), 2)
+        
+    def test_max_concurrency_flood(self):
+        """
+            Calls over the limit wait in the server up to max_queue
+        """
+        pool = testserver1.server.worker_pool
+        self.addCleanup(setattr, pool, 'max_queue', pool.max_queue)
+        self.addCleanup(setattr, pool, 'overflow', pool.overflow)
+        pool.max_queue, pool.overflow = 3, 'reject'
+        requests = [ self.conn.method.limited(0.3) for i in range(10) ]
+        errors = [ request.exception() for request in requests ]
+        self.assertEqual(errors[:5], [None] * 5)
+        for error in errors[5:]:
+            self.assertTrue("ServerBusyError" in str(error))
+        
+    def test_map_ordered(self):
+        mylist = self.conn.call.newOrderedList()
+        list(mylist.map.add(range(30), chunk_size=3, window=10))
+        self.assertEqual(mylist.call.items(), list(range(30)))
+        mylist.close()
+        
+    def test_inline(self):
+        self.assertFalse(self.conn.call.threadname().startswith(
+            "bjsonrpc-worker"))
+        
+    def test_promise_wait(self):
+        """
+            The calls that depend on a promise wait for it
+        """
+        slow = self.conn.promise.limited(0.2)
+        mylist = self.conn.promise.newList()
+        mylist.notify.add(slow)
+        self.assertEqual(self.conn.call.add2(slow, 0), slow.value)
+        self.assertEqual(mylist.call.items(), [slow.value])
+
+
+class TestJSONBasicsReader(TestJSONBasics):
+    """
+        Same tests, with the client connection read by a background thread.
+    """
+    def setUp(self):
+        testserver1.start()
+        self.conn = bjsonrpc.connect(reader=True)
+        
+    def test_concurrent_callers(self):
+        """
+            Many threads wait for their responses without reading
+        """
+        errors = []
+        def caller(n):
+            try:
+                for i in range(20):
+                    self.assertEqual(self.conn.call.add2(n, i), n + i)
+            except Exception as exc:
+                errors.append(exc)
+        threads = [ threading.Thread(target=caller, args=(n,)) 
+                    for n in range(64) ]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join(30)
+        self.assertEqual(errors, [])
+        
+    def test_as_completed(self):
+        """
+            The futures of the requests complete as the reader receives them
+        """
+        requests = [ self.conn.method.add2(i, 1) for i in range(1000) ]
+        requests.append(self.conn.method.limited(0.2))
+        done = [ future.result() for future in 
+                 futures.as_completed([ r.future for r in requests ], 10) ]
+        self.assertEqual(len(done), 1001)
+        self.assertEqual(sorted(done[:-1]), list(range(1, 1001)))
+        finished, pending = futures.wait([ r.future for r in requests ])
+        self.assertEqual(len(finished), 1001)
+        
+    def test_reader(self):
+        self.assertEqual(self.conn._background_reader.name, 
+                         "bjsonrpc-reader")
+        self.assertTrue(self.conn.reads_in_background())
+        
+    def test_close(self):
+        """
+            The requests still waiting raise EofError when it is closed
+        """
+        request = self.conn.method.limited(0.5)
+        threading.Timer(0.05, self.conn.close).start()
+        self.assertRaises(EofError, lambda: request.value)
+        
+        
+class TestJSONBasicsIOLoopReader(TestJSONBasicsReader):
+    """
+        Same tests, with the client connection read by the shared client 
+        I/O thread.
+    """
+    def setUp(self):
+        bjsonrpc.bjsonrpc_options['write_mode'] = 'ioloop'
+        TestJSONBasicsReader.setUp(self)
+        
+    def tearDown(self):
+        TestJSONBasicsReader.tearDown(self)
+        bjsonrpc.bjsonrpc_options['write_mode'] = 'thread'
+        
+    def test_reader(self):
+        self.assertTrue(self.conn._background_reader is 
+                        bjsonrpc.ioloop.IOLoop.instance())
+        self.assertTrue(self.conn.reads_in_background())
+        
+        
+class TestJSONBasicsUnix(TestJSONBasics):
+    """
+        Same tests, over a Unix domain socket.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, "bjsonrpc.sock")
+        testserver1.start(path=path)
+        self.conn = bjsonrpc.connect(path=path)
+        
+    def tearDown(self):
+        TestJSONBasics.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+        
+        
+@unittest.skipUnless(sys.platform.startswith("linux"), "Linux only")
+class TestJSONBasicsAbstractUnix(TestJSONBasics):
+    """
+        Same tests, over an abstract namespace Unix domain socket.
+    """
+    def setUp(self):
+        path = "\0bjsonrpc-test-%d" % os.getpid()
+        testserver1.start(path=path)
+        self.conn = bjsonrpc.connect(path=path)
+        
+        
+class TestJSONBasicsLengthFraming(TestJSONBasics):
+    """
+        Same tests, with length-prefixed framing negotiated on connect.
+    """
+    def setUp(self):
+        testserver1.start()
+        self.conn = bjsonrpc.connect(framing='length')
+        
+    def test_negotiated(self):
+        self.assertEqual(self.conn._read_framing, 'length')
+        self.assertEqual(self.conn._write_framing, 'length')
+        
+    def test_newline_in_message(self):
+        """
+            Raw newlines can't appear inside JSON, but the payload may be
+            anything once length framing is in use.
+        """
+        self.assertEqual(self.conn.call.getabc("a\nb\n")[0], "a\nb\n")
+        self.conn.write_line('{"method": "ping", "id": null}\n')
+        self.assertEqual(self.conn.call.ping(), "pong")
+
+
+class TestJSONBasicsCompressed(TestJSONBasics):
+    """
+        Same tests, with deflate compression negotiated on connect.
+    """
+    def setUp(self):
+        testserver1.start()
+        self.conn = bjsonrpc.connect(compression='deflate')
+        
+    def test_negotiated(self):
+        self.assertEqual(self.conn._write_framing, 'length')
+        self.assertTrue(self.conn._compressor is not None)
+        self.assertTrue(self.conn._decompressor is not None)
+        
+    def test_ratio(self):
+        """
+            Repetitive messages shrink, and later ones reuse the context
+        """
+        data = [ {"key": "value", "other": i} for i in range(200) ]
+        self.assertEqual(self.conn.call.getabc(data)[0], data)
+        stats = self.conn.compression_stats
+        self.assertEqual(stats['compressed'], 1)
+        self.assertTrue(stats['ratio'] > 5)
+        wire_bytes = stats['wire_bytes']
+        self.assertEqual(self.conn.call.getabc(data)[0], data)
+        stats = self.conn.compression_stats
+        self.assertTrue(stats['wire_bytes'] - wire_bytes < wire_bytes / 3)
+        
+    def test_corrupt_frame(self):
+        """
+            The server drops a connection that sends invalid deflate data
+        """
+        self.conn.socket.sendall(b'\0\0\0\x05\x01\xff\xff\xff\xff')
+        self.assertTrue(pollers.wait_readable(self.conn.socket, 5))
+        self.assertRaises(EofError, self.conn.read_line)
+
+
+class TestCompression(unittest.TestCase):
+    def test_roundtrip(self):
+        compressor = compression.DeflateCompressor(threshold=10)
+        decompressor = compression.DeflateDecompressor()
+        messages = [ b'short', b'{"method": "x"}' * 50, b'tiny', 
+                     b'{"method": "x"}' * 50 ]
+        frames = [ b''.join(compressor.compress(msg)) for msg in messages ]
+        self.assertEqual(frames[0], b'\0short')
+        self.assertTrue(len(frames[3]) < len(frames[1]))
+        self.assertEqual([ decompressor.decompress(frame) for frame in frames ],
+                         messages)
+        self.assertEqual(compressor.messages, 4)
+        self.assertEqual(compressor.compressed, 2)
+
+    def test_max_size(self):
+        """
+            Messages that expand beyond max_size are refused
+        """
+        compressor = compression.DeflateCompressor(threshold=10)
+        decompressor = compression.DeflateDecompressor(max_size=1000)
+        fits = b''.join(compressor.compress(b'x' * 1000))
+        bomb = b''.join(compressor.compress(b'x' * 100000))
+        self.assertTrue(len(bomb) < 1000)
+        self.assertEqual(decompressor.decompress(fits), b'x' * 1000)
+        self.assertRaises(ValueError, decompressor.decompress, bomb)
+        
+    def test_corrupt(self):
+        decompressor = compression.DeflateDecompressor()
+        self.assertRaises(ValueError, decompressor.decompress, 
+                          b'\x01\xff\xff\xff\xff')
+
+
+@unittest.skipUnless("orjson" in bjsonrpc.jsonlib.codecs, "orjson required")
+class TestJSONBasicsOrjson(TestJSONBasics):
+    """
+        Same tests, with orjson on both ends.
+    """
+    def setUp(self):
+        bjsonrpc.bjsonrpc_options['codec'] = 'orjson'
+        TestJSONBasics.setUp(self)
+        
+    def tearDown(self):
+        TestJSONBasics.tearDown(self)
+        bjsonrpc.bjsonrpc_options['codec'] = 'json'
+        
+    def test_codec(self):
+        self.assertEqual(self.conn.codec, 'orjson')
+        
+    def test_bigint(self):
+        """
+            Integers orjson can't encode fall back to the standard module
+        """
+        data = bjsonrpc.jsonlib.dumps([2 ** 70], self.conn)
+        self.assertEqual(data, "[%d]" % 2 ** 70)
+        for value in (2 ** 64, -2 ** 70, 10 ** 30):
+            self.assertEqual(self.conn.call.getabc(value)[0], value)
+            self.assertEqual(bjsonrpc.jsonlib.loads(b"[%d]" % value, 
+                                                    self.conn), [value])
+        
+    def test_uuid(self):
+        """
+            UUIDs are hinted, although orjson encodes them natively
+        """
+        value = uuid.UUID("12345678-1234-5678-1234-567812345678")
+        data = bjsonrpc.jsonlib.dumps([value], self.conn)
+        self.assertEqual(data, '[{"__uuid__":"%s"}]' % value)
+        self.assertEqual(self.conn.call.getabc(value)[0], value)
+
+
+@unittest.skipUnless("ujson" in bjsonrpc.jsonlib.codecs, "ujson required")
+class TestJSONBasicsUjson(TestJSONBasicsOrjson):
+    """
+        Same tests, with ujson on both ends.
+    """
+    def setUp(self):
+        bjsonrpc.bjsonrpc_options['codec'] = 'ujson'
+        TestJSONBasics.setUp(self)
+        
+    def test_codec(self):
+        self.assertEqual(self.conn.codec, 'ujson')
+        
+    def test_decimal(self):
+        """
+            Decimals are hinted, although ujson encodes them as floats
+        """
+        value = decimal.Decimal("1.10")
+        data = bjsonrpc.jsonlib.dumps({"a": [value]}, self.conn)
+        self.assertEqual(data, '{"a":[{"__decimal__":"1.10"}]}')
+        self.assertEqual(self.conn.call.getabc(value)[0], value)
+
+
+@unittest.skipUnless("msgspec" in bjsonrpc.jsonlib.codecs, "msgspec required")
+class TestJSONBasicsMsgspec(TestJSONBasicsOrjson):
+    """
+        Same tests, with msgspec on both ends.
+    """
+    def setUp(self):
+        bjsonrpc.bjsonrpc_options['codec'] = 'msgspec'
+        TestJSONBasics.setUp(self)
+        
+    def test_codec(self):
+        self.assertEqual(self.conn.codec, 'msgspec')
+        
+    def test_uuid(self):
+        value = uuid.UUID("12345678-1234-5678-1234-567812345678")
+        data = bjsonrpc.jsonlib.dumps([value], self.conn)
+        self.assertEqual(data, b'[{"__uuid__":"%s"}]' % str(value).encode())
+        self.assertEqual(self.conn.call.getabc(value)[0], value)
+        
+    def test_bigint(self):
+        for value in (2 ** 64, -2 ** 70, 10 ** 30):
+            self.assertEqual(self.conn.call.getabc(value)[0], value)
+            self.assertEqual(bjsonrpc.jsonlib.loads(b"[%d]" % value, 
+                                                    self.conn), [value])
+        
+    def test_native(self):
+        """
+            Types msgspec encodes natively are hinted, also inside the 
+            objects returned by dump_object
+        """
+        date = datetime.date(2010, 5, 17)
+        data = bjsonrpc.jsonlib.dumps([(date, set([1]))], self.conn)
+        self.assertEqual(data, b'[[{"__date__":"2010-05-17"},'
+                               b'{"__set__":[1]}]]')
+        table = bjsonrpc.table.Table.from_rows([{"day": date}])
+        self.assertEqual(self.conn.call.getabc(table)[0], [{"day": date}])
+
+
+class TestJSONBasicsMsgpack(TestJSONBasics):
+    """
+        Same tests, with the MessagePack codec negotiated on connect.
+    """
+    def setUp(self):
+        testserver1.start()
+        self.conn = bjsonrpc.connect(codec='msgpack')
+        
+    def test_codec(self):
+        self.assertEqual(self.conn.codec, 'msgpack')
+        self.assertEqual(self.conn._read_codec.name, 'msgpack')
+        
+    def test_binary(self):
+        """
+            Bytes and floats travel unchanged
+        """
+        value = [b'\x00\n\xff', 0.1, -2 ** 40, u"\u00f1"]
+        self.assertEqual(self.conn.call.getabc(value)[0], value)
+
+
+class TestMsgpack(unittest.TestCase):
+    vectors = [
+        (None, b'\xc0'), (True, b'\xc3'), (False, b'\xc2'),
+        (1, b'\x01'), (-1, b'\xff'), (-33, b'\xd0\xdf'), (200, b'\xcc\xc8'),
+        (70000, b'\xce\x00\x01\x11\x70'), (-70000, b'\xd2\xff\xfe\xee\x90'),
+        (2 ** 63, b'\xcf\x80\x00\x00\x00\x00\x00\x00\x00'),
+        (1.5, b'\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00'),
+        (u"abc", b'\xa3abc'), (u"x" * 40, b'\xd9\x28' + b'x' * 40),
+        (b'ab', b'\xc4\x02ab'), ([1, [2]], b'\x92\x01\x91\x02'),
+        ({u"a": 1}, b'\x81\xa1a\x01'), (list(range(16)), 
+            b'\xdc\x00\x10' + bytes(bytearray(range(16)))),
+    ]
+    
+    def test_pure_python(self):
+        """
+            The bundled implementation follows the MessagePack spec
+        """
+        for obj, packed in self.vectors:
+            self.assertEqual(msgpacklib._py_packb(obj), packed)
+            self.assertEqual(msgpacklib._py_unpackb(packed), obj)
+            
+    def test_ext(self):
+        ext = msgpacklib.ExtType(1, b'name')
+        packed = msgpacklib._py_packb([ext])
+        self.assertEqual(packed, b'\x91\xd6\x01name')
+        self.assertEqual(msgpacklib._py_unpackb(packed), [ext])
+        self.assertEqual(msgpacklib._py_unpackb(packed, 
+            ext_hook=lambda code, data: (code, data)), [(1, b'name')])
+        
+    def test_errors(self):
+        self.assertRaises(ValueError, msgpacklib._py_unpackb, b'\x92\x01')
+        self.assertRaises(ValueError, msgpacklib._py_unpackb, b'\x01\x01')
+        self.assertRaises(OverflowError, msgpacklib._py_packb, 2 ** 64)
+        self.assertRaises(TypeError, msgpacklib._py_packb, object())
+
+
+class TestCodecs(unittest.TestCase):
+    def setUp(self):
+        self.sck, self.peer = socket.socketpair()
+        self.conn = bjsonrpc.connection.Connection(self.sck, 
+            handler_factory=testserver1.ServerHandler)
+        
+    def tearDown(self):
+        self.conn.close()
+        self.peer.close()
+        
+    def test_get_codec(self):
+        jsonlib = bjsonrpc.jsonlib
+        self.assertEqual(jsonlib.get_codec().name, 'json')
+        self.assertEqual(jsonlib.get_codec('auto').name, 
+            [ name for name in jsonlib.preference if name in jsonlib.codecs ][0])
+        self.assertRaises(ValueError, jsonlib.get_codec, 'nonexistent')
+        
+    def test_hints(self):
+        """
+            Every codec applies the class hinting hooks, innermost first
+        """
+        handler = testserver1.MyList(self.conn)
+        for name in bjsonrpc.jsonlib.codecs:
+            self.conn.set_codec(name)
+            data = bjsonrpc.jsonlib.dumps({"a": [handler, 1], "b": "/"}, self.conn)
+            item = bjsonrpc.jsonlib.loads(data, self.conn)
+            self.assertTrue(isinstance(item["a"][0], 
+                            bjsonrpc.connection.RemoteObject), name)
+            self.assertEqual(item["a"][1], 1)
+            self.assertEqual(item["b"], "/")
+            
+
+class Point(object):
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+        
+    def __eq__(self, other):
+        return (self.x, self.y) == (other.x, other.y)
+
+
+class TestTypes(unittest.TestCase):
+    values = [
+        datetime.datetime(2010, 5, 17, 12, 30, 1, 500), datetime.date(2010, 5, 17),
+        datetime.time(12, 30), datetime.timedelta(1, 2, 3), 
+        uuid.UUID("12345678-1234-5678-1234-567812345678"), 
+        decimal.Decimal("0.1"), set([1, 2]), frozenset(["a"]), 
+        b'\x00\xff\n', bytearray(b'\x01\n'), 
+        [set([decimal.Decimal("1")])],
+    ]
+    
+    def setUp(self):
+        self.conn1, self.conn2 = bjsonrpc.socketpair(
+            peer_handler_factory=testserver1.ServerHandler)
+        def serve():
+            try:
+                self.conn2.serve()
+            except EofError:
+                pass
+        self.thread = threading.Thread(target=serve)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def tearDown(self):
+        self.conn1.close()
+        self.thread.join(5)
+        
+    def test_builtin(self):
+        for value in self.values:
+            result = self.conn1.call.getabc(value)[0]
+            self.assertEqual(type(result), type(value))
+            self.assertEqual(result, value)
+            
+    def test_hint(self):
+        data = bjsonrpc.jsonlib.dumps(decimal.Decimal("1.10"), self.conn1)
+        self.assertEqual(data, '{"__decimal__":"1.10"}')
+        
+    def test_register_type(self):
+        for conn in (self.conn1, self.conn2):
+            conn.register_type(Point, "point", lambda p: [p.x, p.y],
+                               lambda value: Point(*value))
+        point = Point(1, datetime.date(2010, 1, 1))
+        self.assertEqual(self.conn1.call.getabc(point)[0], point)
+        self.assertRaises(ValueError, self.conn1.register_type, Point, 
+                          "remoteobject", None, None)
+        self.assertRaises(ValueError, self.conn1.register_type, Point, 
+                          "promise", None, None)
+        
+    def test_register_global(self):
+        """
+            Global registrations apply to the connections created after them,
+            both to encode and to decode
+        """
+        bjsonrpc.jsonlib.register_type(Point, "point", lambda p: [p.x, p.y],
+                                       lambda value: Point(*value))
+        def unregister():
+            del bjsonrpc.jsonlib._types[Point]
+            del bjsonrpc.jsonlib._hints["__point__"]
+        self.addCleanup(unregister)
+        self.assertRaises(TypeError, bjsonrpc.jsonlib.dumps, Point(1, 2), 
+                          self.conn1)
+        self.assertEqual(self.conn2.load_object({"__point__": [1, 2]}), 
+                         {"__point__": [1, 2]})
+        conn1, conn2 = bjsonrpc.socketpair()
+        self.addCleanup(conn2.close)
+        self.addCleanup(conn1.close)
+        data = bjsonrpc.jsonlib.dumps(Point(1, 2), conn1)
+        self.assertEqual(bjsonrpc.jsonlib.loads(data, conn2), Point(1, 2))
+        
+    def test_lazy(self):
+        """
+            Types can be registered by dotted name
+        """
+        name = "%s.Point" % Point.__module__
+        for conn in (self.conn1, self.conn2):
+            conn.register_type(name, "point", lambda p: [p.x, p.y],
+                               lambda value: Point(*value))
+        self.assertEqual(self.conn1.call.getabc(Point(1, 2))[0], Point(1, 2))
+        
+    @unittest.skipUnless(numpy, "numpy required")
+    def test_ndarray(self):
+        for array in [ numpy.arange(12, dtype='>i4').reshape(3, 4),
+                       numpy.linspace(0, 1, 7)[::2],
+                       numpy.zeros((0, 3)),
+                       numpy.array([1, "a", None], dtype=object) ]:
+            result = self.conn1.call.getabc(array)[0]
+            self.assertEqual(result.dtype, array.dtype)
+            self.assertEqual(result.shape, array.shape)
+            self.assertEqual(result.tolist(), array.tolist())
+            
+    @unittest.skipUnless(numpy, "numpy required")
+    def test_ndarray_structured(self):
+        """
+            Structured arrays keep their fields, also nested or padded
+        """
+        dtype = numpy.dtype([('x', '<i4'), ('y', '>f8', (2,)), ('s', 'U3'), 
+                             ('n', [('a', 'u1'), ('b', '<i2')])])
+        padded = numpy.dtype({'names': ['a', 'b'], 'formats': ['<i4', '<i8'],
+                              'offsets': [0, 8], 'itemsize': 24})
+        for array in [ numpy.array([(1, (0.5, 2.5), "abc", (7, -3)), 
+                                    (2, (1.5, 3.5), "d", (8, 4))], dtype),
+                       numpy.zeros(3, padded) ]:
+            result = self.conn1.call.getabc(array)[0]
+            self.assertEqual(result.dtype, array.dtype)
+            self.assertEqual(result.tobytes(), array.tobytes())
+
+
+@unittest.skipUnless("orjson" in bjsonrpc.jsonlib.codecs, "orjson required")
+class TestTypesOrjson(TestTypes):
+    """
+        Same tests, with orjson on both ends (it encodes UUIDs natively).
+    """
+    def setUp(self):
+        bjsonrpc.bjsonrpc_options['codec'] = 'orjson'
+        self.addCleanup(bjsonrpc.bjsonrpc_options.__setitem__, 'codec', 
+                        'json')
+        TestTypes.setUp(self)
+        
+    def test_codec(self):
+        self.assertEqual(self.conn1._write_codec.name, 'orjson')
+        
+    def test_hint(self):
+        data = bjsonrpc.jsonlib.dumps(decimal.Decimal("1.10"), self.conn1)
+        self.assertEqual(data, b'{"__decimal__":"1.10"}')
+        
+        
+@unittest.skipUnless("ujson" in bjsonrpc.jsonlib.codecs, "ujson required")
+class TestTypesUjson(TestTypes):
+    """
+        Same tests, with ujson on both ends (it encodes decimals natively).
+    """
+    def setUp(self):
+        bjsonrpc.bjsonrpc_options['codec'] = 'ujson'
+        self.addCleanup(bjsonrpc.bjsonrpc_options.__setitem__, 'codec', 
+                        'json')
+        TestTypes.setUp(self)
+        
+    def test_codec(self):
+        self.assertEqual(self.conn1._write_codec.name, 'ujson')
+        
+        
+@unittest.skipUnless("msgspec" in bjsonrpc.jsonlib.codecs, "msgspec required")
+class TestTypesMsgspec(TestTypes):
+    """
+        Same tests, with msgspec on both ends (it encodes most of the hinted
+        types natively).
+    """
+    def setUp(self):
+        bjsonrpc.bjsonrpc_options['codec'] = 'msgspec'
+        self.addCleanup(bjsonrpc.bjsonrpc_options.__setitem__, 'codec', 
+                        'json')
+        TestTypes.setUp(self)
+        
+    def test_codec(self):
+        self.assertEqual(self.conn1._write_codec.name, 'msgspec')
+        
+    def test_hint(self):
+        data = bjsonrpc.jsonlib.dumps(decimal.Decimal("1.10"), self.conn1)
+        self.assertEqual(data, b'{"__decimal__":"1.10"}')
+        
+        
+class TestTypesMsgpack(TestTypes):
+    """
+        Same tests, with the msgpack codec (bytes are sent as binary).
+    """
+    def setUp(self):
+        TestTypes.setUp(self)
+        self.conn1.negotiate(codec='msgpack')
+        
+    def test_hint(self):
+        data = bjsonrpc.jsonlib.dumps(decimal.Decimal("1.10"), self.conn1)
+        self.assertEqual(data, b'\x81\xab__decimal__\xa41.10')
+
+
+class TestTable(unittest.TestCase):
+    def test_from_rows(self):
+        Table = bjsonrpc.table.Table
+        self.assertEqual(Table.from_rows([{"a": 1}, {"a": 2}]).as_dict(),
+                         {"a": [1, 2]})
+        self.assertEqual(Table.from_rows([]), None)
+        self.assertEqual(Table.from_rows([{}]), None)
+        self.assertEqual(Table.from_rows([{"a": 1}, {"b": 2}]), None)
+        self.assertEqual(Table.from_rows([{"a": 1}, {"a": 2, "b": 2}]), None)
+        self.assertEqual(Table.from_rows([{"a": 1}, [1]]), None)
+        
+    def test_auto(self):
+        """
+            Connection.table_min_rows converts plain results too
+        """
+        conn1, conn2 = bjsonrpc.socketpair(
+            peer_handler_factory=testserver1.ServerHandler)
+        conn2.table_min_rows = 3
+        def serve():
+            try:
+                conn2.serve()
+            except EofError:
+                pass
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        rows = [ {"a": 1}, {"a": 2}, {"a": 3} ]
+        self.assertTrue(isinstance(conn1.call.getabc(rows[:2])[0], list))
+        result = conn1.call.pipe([rows])
+        self.assertTrue(isinstance(result, bjsonrpc.table.Table))
+        self.assertEqual(result, rows)
+        conn1.close()
+        thread.join(5)
+        
+
+class TestStreamDecoder(unittest.TestCase):
+    def setUp(self):
+        self.message = {"id": 1, "error": None, "result": [ 
+            {"n": i, "s": u"\u00e9" * (i % 5), "l": [1.5, None, True]} 
+            for i in range(500) ], "other": {"a": list(range(300))}}
+        self.data = bjsonrpc.jsonlib.j.dumps(self.message).encode('utf-8')
+        
+    def decode(self, chunk_size, item_hook=None):
+        decoder = streaming.StreamDecoder(item_hook=item_hook, max_pending=500)
+        for pos in range(0, len(self.data), chunk_size):
+            decoder.feed(self.data[pos:pos + chunk_size])
+        return decoder.close()
+        
+    def test_chunks(self):
+        """
+            Any split of the bytes decodes the same (even inside UTF-8 
+            characters and numbers)
+        """
+        for chunk_size in (1, 3, 64, 1000, len(self.data)):
+            self.assertEqual(self.decode(chunk_size), self.message)
+            
+    def test_item_hook(self):
+        items = []
+        def item_hook(path, value):
+            if path != ('result',): return False
+            items.append(value)
+            return True
+        message = self.decode(1000, item_hook)
+        self.assertEqual(items, self.message['result'])
+        self.assertEqual(message['result'], [])
+        self.assertEqual(message['other'], self.message['other'])
+        
+    def test_walked_numbers(self):
+        """
+            Numbers of a walked list split anywhere, even after '.', 'e' or
+            a sign, decode the same
+        """
+        message = {"id": 1, "result": [1.5, -2.25e-10, 3E+20, 17, -0.5, 1e5,
+                                       12345.678, 0, -3]}
+        data = bjsonrpc.jsonlib.j.dumps(message).encode('utf-8')
+        for split in range(1, len(data)):
+            decoder = streaming.StreamDecoder(max_pending=4)
+            decoder.feed(data[:split])
+            decoder.feed(data[split:])
+            self.assertEqual(decoder.close(), message, data[:split])
+        decoder = streaming.StreamDecoder(max_pending=4)
+        for pos in range(len(data)):
+            decoder.feed(data[pos:pos + 1])
+        self.assertEqual(decoder.close(), message)
+        
+    def test_errors(self):
+        for data in (b'{"a":1', b'{"a":1}x', b'{"a" 1}', b'[1,,2]', 
+                     b'{"a":[1,2}', b'{1:2}'):
+            decoder = streaming.StreamDecoder()
+            decoder.feed(data)
+            self.assertRaises(ValueError, decoder.close)
+            
+            
+class TestStreaming(unittest.TestCase):
+    """
+        Large results decoded while they are received
+    """
+    def setUp(self):
+        self.conn, self.peer = bjsonrpc.socketpair(
+            peer_handler_factory=testserver1.ServerHandler)
+        self.conn.read_chunk_size = 4096
+        self.conn.stream_threshold = 8192
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def serve(self):
+        try:
+            self.peer.serve()
+        except EofError:
+            pass
+            
+    def tearDown(self):
+        self.conn.close()
+        self.thread.join(5)
+        
+    def expected(self, count):
+        return [ {"id": i, "name": "row %d" % i} for i in range(count) ]
+        
+    def test_call(self):
+        self.assertEqual(self.conn.call.rows(5000), self.expected(5000))
+        self.assertEqual(self.conn.call.rows(3), self.expected(3))
+        self.assertEqual(self.conn.stream.rows(5000).value, 
+                         self.expected(5000))
+        
+    def test_iterate(self):
+        """
+            The first elements are available before the response is complete
+        """
+        request = self.conn.stream.rows(20000)
+        result = iter(request)
+        self.assertEqual(next(result), {"id": 0, "name": "row 0"})
+        self.assertFalse(request.done())
+        self.assertEqual([ {"id": 0, "name": "row 0"} ] + list(result), 
+                         self.expected(20000))
+        self.assertEqual(list(self.conn.stream.rows(2)), self.expected(2))
+        
+    def test_length_framing(self):
+        self.conn.negotiate(framing='length')
+        self.assertEqual(list(self.conn.stream.rows(5000)), 
+                         self.expected(5000))
+        self.assertEqual(self.conn.call.ping(), "pong")
+        
+    def test_streamed(self):
+        """
+            Results of @streamed handlers are encoded and sent in parts
+        """
+        self.peer.stream_chunk_size = 1024
+        for framing, method in (('newline', 'none'), ('length', 'none'),
+                                ('length', 'deflate')):
+            self.conn.negotiate(framing=framing, compression=method)
+            self.assertEqual(self.conn.call.streamrows(5000), 
+                             self.expected(5000))
+            self.assertEqual(list(self.conn.stream.streamrows(3000)), 
+                             self.expected(3000))
+            self.assertEqual(self.conn.call.streamrows(0), [])
+            self.assertEqual(self.conn.call.ping(), "pong")
+        
+    def test_streamed_error(self):
+        request = self.conn.stream.streamrows(3000, fail=True)
+        result = []
+        try:
+            for row in request:
+                result.append(row)
+        except ServerError as exc:
+            self.assertTrue("failed after 3000 rows" in str(exc))
+        else:
+            self.fail("ServerError not raised")
+        self.assertEqual(result, self.expected(3000))
+        self.assertEqual(self.conn.call.ping(), "pong")
+        
+    def test_invalid_response(self):
+        """
+            The request of an invalid streamed response gets an error
+        """
+        self.peer.write_line('{"id": %d, "result": [%s}' % (self.conn._id + 1,
+                                                           "1," * 10000))
+        self.assertRaises(ServerError, self.conn.call.ping)
+        self.assertEqual(self.conn.call.ping(), "pong")
+        
+    def test_invalid(self):
+        """
+            An invalid message is skipped, not the ones after it
+        """
+        self.peer.write_line('{"id": 999, "result": [%s}' % ("1," * 10000))
+        self.assertEqual(self.conn.call.ping(), "pong")
+        
+        
+class TestStreamPipe(unittest.TestCase):
+    def test_pipe(self):
+        pipe = streaming.StreamPipe(max_pending=2)
+        parts = iter(pipe)
+        self.assertTrue(pipe.put(b'a'))
+        self.assertEqual(next(parts), b'a')
+        self.assertEqual(next(parts), None)
+        pipe.put(b'b')
+        pipe.close()
+        self.assertEqual(list(parts), [b'b'])
+        
+    def test_abandon(self):
+        """
+            Abandoning the iteration cancels the pipe
+        """
+        pipe = streaming.StreamPipe()
+        parts = iter(pipe)
+        pipe.put(b'a')
+        self.assertEqual(next(parts), b'a')
+        parts.close()
+        self.assertTrue(pipe.cancelled)
+        self.assertFalse(pipe.put(b'b'))
+        
+    def test_backpressure(self):
+        """
+            The producer waits while the pipe is full, until it is cancelled
+        """
+        pipe = streaming.StreamPipe(max_pending=2)
+        results = []
+        def produce():
+            for part in (b'a', b'b', b'c', b'd'):
+                results.append(pipe.put(part))
+        thread = threading.Thread(target=produce)
+        thread.start()
+        for i in range(100):
+            if len(results) == 2: break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.assertEqual(results, [True, True])
+        pipe.cancel()
+        thread.join(5)
+        self.assertEqual(results, [True, True, False, False])
+        
+        
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.pool = workers.WorkerPool(max_workers=2, max_queue=2)
+        
+    def tearDown(self):
+        self.release.set()
+        self.pool.shutdown()
+        
+    def fill(self, overflow):
+        """ 
+            Keeps both threads busy and fills the queue, then switches to 
+            the **overflow** policy.
+        """
+        for i in range(2):
+            self.pool.submit(self.release.wait)
+            while self.pool.stats()['busy'] <= i:
+                time.sleep(0.01)
+        for i in range(2):
+            self.pool.submit(self.release.wait)
+        self.pool.overflow = overflow
+        
+    def test_run(self):
+        results = []
+        done = threading.Event()
+        for i in range(10):
+            self.pool.submit(results.append, i)
+        self.pool.submit(done.set)
+        self.assertTrue(done.wait(5))
+        self.pool.shutdown()
+        self.assertEqual(sorted(results), list(range(10)))
+        stats = self.pool.stats()
+        self.assertEqual(stats['submitted'], 11)
+        self.assertEqual(stats['completed'], 11)
+        self.assertEqual(stats['workers'], 0)
+        self.assertEqual(stats['busy'], 0)
+        self.assertTrue(stats['max_queue_depth'] >= 1)
+        
+    def test_reject(self):
+        self.fill('reject')
+        self.assertEqual(self.pool.queue_depth, 2)
+        self.assertRaises(ServerBusyError, self.pool.submit, len, "")
+        self.assertEqual(self.pool.stats()['rejected'], 1)
+        
+    def test_limit(self):
+        """
+            A ConcurrencyLimit of 1 runs the items one at a time, in order
+        """
+        limit = workers.ConcurrencyLimit(1)
+        results = []
+        done = threading.Event()
+        def add(i):
+            time.sleep(0.001 * (i % 3))
+            results.append(i)
+        for i in range(20):
+            limit.submit(self.pool, add, i)
+        limit.submit(self.pool, done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(results, list(range(20)))
+        self.assertTrue(self.pool.stats()['submitted'] < 21)
+        
+    def test_limit_flood(self):
+        """
+            The items waiting for a ConcurrencyLimit are bounded too
+        """
+        limit = workers.ConcurrencyLimit(1) # as for an ordered method
+        self.pool.overflow = 'reject'
+        for i in range(3):
+            limit.submit(self.pool, self.release.wait)
+        self.assertEqual(limit.waiting, 2)
+        self.assertRaises(ServerBusyError, limit.submit, self.pool, len, "")
+        self.assertEqual(self.pool.stats()['rejected'], 1)
+        self.pool.overflow = 'block'
+        queued = threading.Event()
+        def submit():
+            limit.submit(self.pool, len, "")
+            queued.set()
+        threading.Thread(target=submit).start()
+        self.assertFalse(queued.wait(0.2))
+        self.release.set()
+        self.assertTrue(queued.wait(5))
+        
+    def test_inline(self):
+        self.fill('inline')
+        thread = []
+        self.assertFalse(self.pool.submit(
+            lambda: thread.append(threading.current_thread())))
+        self.assertEqual(thread, [ threading.current_thread() ])
+        self.assertEqual(self.pool.stats()['inlined'], 1)
+        
+    def test_block(self):
+        self.fill('block')
+        queued = threading.Event()
+        def submit():
+            self.pool.submit(len, "")
+            queued.set()
+        threading.Thread(target=submit).start()
+        self.assertFalse(queued.wait(0.2))
+        self.release.set()
+        self.assertTrue(queued.wait(5))
+        self.assertTrue(self.pool.stats()['wait_max'] >= 0.2)
+        
+        
+class TestNegotiation(unittest.TestCase):
+    def test_fallback(self):
+        """
+            A peer that doesn't support an option keeps newline framing
+        """
+        class NewlineOnly(bjsonrpc.connection.Connection):
+            negotiation = { 'framing' : ('newline',) }
+        conn1, conn2 = bjsonrpc.socketpair(
+            peer_handler_factory=testserver1.ServerHandler)
+        conn2.__class__ = NewlineOnly
+        def serve():
+            try:
+                conn2.serve()
+            except EofError:
+                pass
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        self.assertEqual(conn1.negotiate(framing=['length', 'newline']), 
+                         {'framing': 'newline'})
+        self.assertEqual(conn1._write_framing, 'newline')
+        self.assertEqual(conn1.call.add2(2, 3), 5)
+        self.assertEqual(conn1.negotiate(compression='zlib'), {})
+        conn1.close()
+        thread.join(5)
+        
+        
+@unittest.skipUnless(hasattr(os, "fork"), "os.fork required")
+class TestPrefork(unittest.TestCase):
+    def serve(self, **kwargs):
+        server = bjsonrpc.createserver(port=0, 
+            handler_factory=testserver1.ServerHandler, workers=2, **kwargs)
+        thread = threading.Thread(target=server.serve)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join, 10)
+        self.addCleanup(server.stop)
+        return server, server.socket.getsockname()[1]
+        
+    def wait_workers(self, server, count):
+        for i in range(100):
+            if len(server.workers) == count: break
+            threading.Event().wait(0.05)
+        return server.workers
+        
+    def connect(self, port):
+        """
+            Workers listen a moment after they are forked.
+        """
+        for i in range(100):
+            try:
+                return bjsonrpc.connect(port=port)
+            except socket.error:
+                threading.Event().wait(0.05)
+        return bjsonrpc.connect(port=port)
+        
+    def check_calls(self, port):
+        pids = set()
+        for i in range(10):
+            conn = self.connect(port)
+            self.assertEqual(conn.call.add2(i, 1), i + 1)
+            pids.add(conn.call.getpid())
+            conn.close()
+        self.assertFalse(os.getpid() in pids)
+        return pids
+        
+    def test_reuseport(self):
+        server, port = self.serve()
+        workers = self.wait_workers(server, 2)
+        self.assertTrue(self.check_calls(port) <= set(workers))
+        
+    def test_shared_socket(self):
+        server, port = self.serve(reuseport=False)
+        workers = self.wait_workers(server, 2)
+        self.assertTrue(self.check_calls(port) <= set(workers))
+        
+    def test_restart(self):
+        """
+            A worker that dies is replaced, and stop() ends all of them
+        """
+        server, port = self.serve()
+        old = self.wait_workers(server, 2)
+        os.kill(old[0], signal.SIGKILL)
+        for i in range(100):
+            workers = server.workers
+            if len(workers) == 2 and old[0] not in workers: break
+            threading.Event().wait(0.05)
+        self.assertFalse(old[0] in workers)
+        self.assertEqual(len(workers), 2)
+        self.check_calls(port)
+        server.stop()
+        for i in range(100):
+            if not server.workers: break
+            threading.Event().wait(0.05)
+        self.assertEqual(server.workers, [])
+        for pid in workers:
+            self.assertRaises(OSError, os.kill, pid, 0)
+        
+    def test_restart_shared_socket(self):
+        """
+            A worker that exits doesn't stop the listener shared by the rest
+        """
+        server, port = self.serve(reuseport=False)
+        old = self.wait_workers(server, 2)
+        conn = self.connect(port)
+        pid = conn.call.getpid()
+        self.assertTrue(pid in old)
+        conn.notify.exit(1)
+        self.assertRaises(EofError, conn.read_line)
+        conn.close()
+        for i in range(100):
+            workers = server.workers
+            if len(workers) == 2 and pid not in workers: break
+            threading.Event().wait(0.05)
+        self.assertFalse(pid in workers)
+        self.assertEqual(len(workers), 2)
+        for i in range(10):
+            conn = bjsonrpc.connect(port=port)
+            self.assertEqual(conn.call.add2(i, 1), i + 1)
+            conn.close()
+        
+        
+class TestSocketPair(unittest.TestCase):
+    def test_socketpair(self):
+        conn1, conn2 = bjsonrpc.socketpair(
+            handler_factory=bjsonrpc.handlers.NullHandler,
+            peer_handler_factory=testserver1.ServerHandler)
+        def serve():
+            try:
+                conn2.serve()
+            except EofError:
+                pass
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        self.assertEqual(conn1.call.add2(2, 3), 5)
+        conn1.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.conn, self.peer = bjsonrpc.socketpair(
+            handler_factory=bjsonrpc.handlers.NullHandler,
+            peer_handler_factory=testserver1.ServerHandler)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def serve(self):
+        try:
+            self.peer.serve()
+        except EofError:
+            pass
+        
+    def tearDown(self):
+        self.conn.close()
+        self.thread.join(5)
+        
+    def check_reply(self):
+        """
+            The responses of a batch come back in one message
+        """
+        with self.conn.batch() as batch:
+            for i in range(50):
+                batch.method.add2(i, 1)
+            batch.method.newList()
+            batch.notify.ping()
+        reply = bjsonrpc.jsonlib.loads(self.conn.read_line(), self.conn)
+        self.assertEqual(type(reply), list)
+        self.assertEqual(sorted([ response['result'] for response in reply
+                                  if response['id'] <= 50 ]), 
+                         list(range(1, 51)))
+        self.assertEqual(len(reply), 51)
+        
+    def test_reply(self):
+        self.check_reply()
+        
+    def test_reply_threaded(self):
+        self.peer.threaded = True
+        self.check_reply()
+        
+        
+class TestReadBuffer(unittest.TestCase):
+    def setUp(self):
+        self.sck, self.peer = socket.socketpair()
+        self.conn = bjsonrpc.connection.Connection(self.sck, 
+            handler_factory=bjsonrpc.handlers.NullHandler)
+        
+    def tearDown(self):
+        self.conn.close()
+        self.peer.close()
+        
+    def test_split_lines(self):
+        """
+            Several lines in one chunk and lines spread over several chunks
+        """
+        self.conn.read_chunk_size = 7
+        self.peer.sendall(b'{"a":1}\n{"b":[1,2,3]}\n{"c"')
+        self.assertEqual(self.conn.read_line(), '{"a":1}')
+        self.assertEqual(self.conn.read_line(), '{"b":[1,2,3]}')
+        self.peer.sendall(b':3}\n')
+        self.assertEqual(self.conn.read_line(), '{"c":3}')
+        
+    def test_split_length(self):
+        """
+            Length framing: frames with newlines, split over several chunks
+        """
+        self.conn.read_chunk_size = 5
+        self.conn._set_read_framing('length')
+        self.peer.sendall(b'\0\0\0\x03a\nb\0\0\0\x02{}\0\0')
+        self.assertEqual(self.conn.read_line(), 'a\nb')
+        self.assertEqual(self.conn.read_line(), '{}')
+        self.peer.sendall(b'\0\x01x')
+        self.assertEqual(self.conn.read_line(), 'x')
+        
+    def test_split_fragments(self):
+        """
+            Length framing: a message sent in fragments (high bit set)
+        """
+        self.conn.read_chunk_size = 5
+        self.conn._set_read_framing('length')
+        self.peer.sendall(b'\x80\0\0\x02[1\x80\0\0\x02,2\0\0\0\x01]'
+                          b'\0\0\0\x02{}')
+        self.assertEqual(self.conn.read_line(), '[1,2]')
+        self.assertEqual(self.conn.read_line(), '{}')
+        
+    def test_frame_too_big(self):
+        """
+            A header bigger than max_frame_size closes the connection 
+            before the buffer grows
+        """
+        self.conn._set_read_framing('length')
+        self.peer.sendall(b'\x7f\xff\xff\xf0' + b'x' * 10)
+        self.assertRaises(EofError, self.conn.read_line)
+        self.assertEqual(self.conn.connection_status, "closed")
+        self.assertTrue(len(self.conn._rbuf) <= self.conn.read_chunk_size)
+        
+    def test_fragments_too_big(self):
+        """
+            The fragments of a message are bounded together
+        """
+        self.conn.max_frame_size = 4
+        self.conn._set_read_framing('length')
+        self.peer.sendall(b'\x80\0\0\x03[1,\x80\0\0\x022,')
+        self.assertRaises(EofError, self.conn.read_line)
+        self.assertEqual(self.conn.connection_status, "closed")
+        
+    def test_line_too_big(self):
+        """
+            Newline framing: a line longer than max_frame_size
+        """
+        self.conn.max_frame_size = 5
+        self.peer.sendall(b'{}\n[1,2,3]')
+        self.assertEqual(self.conn.read_line(), '{}')
+        self.assertRaises(EofError, self.conn.read_line)
+        self.assertEqual(self.conn.connection_status, "closed")
+        
+    def test_complete_line_too_big(self):
+        """
+            Newline framing: complete lines are checked too
+        """
+        self.conn.max_frame_size = 5
+        self.peer.sendall(b'{}\n[1,2,3]\n{}\n')
+        self.assertEqual(self.conn.read_line(), '{}')
+        self.assertRaises(EofError, self.conn.read_line)
+        self.assertEqual(self.conn.connection_status, "closed")
+        
+    def test_change_framing(self):
+        """
+            Lines split before the framing changes are split again
+        """
+        self.peer.sendall(b'{"a":1}\n\0\0\0\x01x\0\0\0\x02\n\n')
+        self.assertEqual(self.conn.read_line(), '{"a":1}')
+        self.conn._set_read_framing('length')
+        self.assertEqual(self.conn.read_line(), 'x')
+        self.assertEqual(self.conn.read_line(), '\n\n')
+        
+    def test_dispatch_batch(self):
+        """
+            All the lines received at once are dispatched in one call
+        """
+        msgs = [b'{"method":"x%d"}' % i for i in range(5)]
+        self.peer.sendall(b'\n'.join(msgs) + b'\n')
+        pollers.wait_readable(self.sck, 1)
+        self.assertEqual(self.conn.dispatch_until_empty(), 5)
+        
+        
+class TestWriteCoalescing(unittest.TestCase):
+    def test_order_and_content(self):
+        """
+            Coalesced messages arrive complete and in order
+        """
+        sck, peer = socket.socketpair()
+        conn = bjsonrpc.connection.Connection(sck, 
+            handler_factory=bjsonrpc.handlers.NullHandler)
+        conn.write_coalesce_delay = 0.01
+        expected = b''.join([ b'{"n":%d}\n' % i for i in range(500) ])
+        for i in range(500):
+            conn.write('{"n":%d}' % i)
+        received = b''
+        peer.settimeout(5)
+        while len(received) < len(expected):
+            received += peer.recv(65536)
+        self.assertEqual(received, expected)
+        conn.close()
+        peer.close()
+        
+        
+class TestPollers(unittest.TestCase):
+    def check_poller(self, poller):
+        a, b = socket.socketpair()
+        try:
+            poller.register(a, pollers.READ)
+            self.assertEqual(poller.poll(0), [], "Idle socket reported as ready")
+            b.send(b'x')
+            self.assertEqual(poller.poll(1), [(a, pollers.READ)])
+            poller.modify(a, pollers.READ | pollers.WRITE)
+            self.assertEqual(poller.poll(1), [(a, pollers.READ | pollers.WRITE)])
+            poller.unregister(a)
+            self.assertEqual(len(poller), 0)
+        finally:
+            poller.close()
+            a.close()
+            b.close()
+
+    def test_select_poller(self):
+        self.check_poller(pollers.SelectPoller())
+
+    def test_default_poller(self):
+        self.check_poller(pollers.default_poller())
+        
+    def test_wait_readable(self):
+        a, b = socket.socketpair()
+        self.assertFalse(pollers.wait_readable(a, 0))
+        b.send(b'x')
+        self.assertTrue(pollers.wait_readable(a, 1))
+        a.close()
+        b.close()
 
 
 if __name__ == '__main__':
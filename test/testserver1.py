@@ -1,6 +1,34 @@
 from bjsonrpc.handlers import BaseHandler
 from bjsonrpc import createserver
+import os
+import sys
 import threading
+import time
+from bjsonrpc.handlers import columnar, streamed, run_in_process
+from bjsonrpc.handlers import inline, max_concurrency
+
+class MyList(BaseHandler):
+    def _setup(self):
+        self._list = []
+        
+    def add(self, item):
+        self._list.append(item)
+        
+    def items(self):
+        return self._list
+        
+
+class OrderedList(MyList):
+    execution = 'ordered'
+    
+    def add(self, item):
+        time.sleep(0.001 * (item % 3)) # would reorder concurrent calls
+        self._list.append(item)
+
+
+running = 0
+max_running = 0
+running_lock = threading.Lock()
 
 class ServerHandler(BaseHandler):
     def ping(self):
@@ -22,15 +50,68 @@ class ServerHandler(BaseHandler):
     def getabc(self, a=None, b=None, c=None):
         return (a, b, c)
 
+    def newList(self):
+        return MyList(self)
+
+    def newOrderedList(self):
+        return OrderedList(self)
+
+    @max_concurrency(2)
+    def limited(self, delay):
+        global running, max_running
+        with running_lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(delay)
+        with running_lock:
+            running -= 1
+        return max_running
+
+    @inline
+    def threadname(self):
+        return threading.current_thread().name
+
+    def getpid(self):
+        return os.getpid()
+
+    def exit(self, status):
+        sys.exit(status)
+
+    def rows(self, count):
+        return [ {"id": i, "name": "row %d" % i} for i in range(count) ]
+
+    @streamed
+    def streamrows(self, count, fail=False):
+        for i in range(count):
+            yield {"id": i, "name": "row %d" % i}
+        if fail:
+            raise ValueError("failed after %d rows" % count)
+
+    @streamed
+    def streamlocked(self, count):
+        # Whether each value is produced while holding the write lock.
+        for i in range(count):
+            yield self._conn.write_lock._is_owned()
+
+    @run_in_process
+    def squares(count):
+        if count < 0:
+            raise ValueError("negative count")
+        return os.getpid(), sum([ i * i for i in range(count) ])
+
+    @columnar
+    def records(self, count):
+        return [ {"id": i, "name": "row %d" % i} for i in range(count) ]
+
     def pipe(self, arr):
         for element in arr:
             yield element
 
 server = None
-def start():
+def start(path=None):
     global server,  server_thread
     if server: return
-    server = createserver(handler_factory=ServerHandler)
+    server = createserver(handler_factory=ServerHandler, path=path)
     server.debug_socket(True)
     server.debug_dispatch(True)
     server_thread = threading.Thread(target=server.serve)